@@ -2,7 +2,7 @@ import logging
 import smc.api.session
 
 __author__ = 'David LePage'
-__version__ = '0.6.1'
+__version__ = '0.6.2'
 
 # Default SMC Session
 session = smc.api.session.Session()
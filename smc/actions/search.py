@@ -21,12 +21,24 @@ Get element reference::
 All elements by type::
 
     smc.actions.search.all_elements_by_type('host')
+
+Resolve a large number of names to href using :class:`NameResolver`::
+
+    resolver = smc.actions.search.NameResolver()
+    result = resolver.resolve(['host1', 'host2', ('web', 'network')])
+    result.resolved     # {'host1': 'http://...', ('web', 'network'): 'http://...'}
+    result.not_found    # ['host2']
+    result.ambiguous    # {}
+    result.failed       # {}
 """
 import logging
-from smc.api.common import fetch_href_by_name, fetch_json_by_href,\
-    fetch_json_by_name, fetch_entry_point, fetch_json_by_post
+import collections
+from smc.api.common import SMCRequest, fetch_href_by_name, \
+    fetch_json_by_href, fetch_json_by_name, fetch_entry_point, \
+    fetch_json_by_post
 from smc import session
-from smc.api.exceptions import UnsupportedEntryPoint
+from smc.api.exceptions import UnsupportedEntryPoint, FetchElementFailed
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
 
 logger = logging.getLogger(__name__)
 
@@ -262,19 +274,163 @@ def element_as_smcresult_use_filter(name, _filter):
 
 def element_href_by_batch(list_to_find, filter=None):  # @ReservedAssignment
     """ Find batch of entries by name. Reduces number of find calls from
-    calling class.
+    calling class. Names are resolved concurrently using a
+    :class:`NameResolver`.
 
     :param list list_to_find: list of names to find
     :param filter: optional filter, i.e. 'tcp_service', 'host', etc
     :return: list: {name: href, name: href}, href may be None if not found
     """
     try:
-        if filter:
-            return [{k: element_href_use_filter(k, filter)
-                     for k in list_to_find}]
-        return [{k: element_href(k) for k in list_to_find}]
+        names = list(list_to_find)
     except TypeError:
         logger.error("{} is not iterable".format(list_to_find))
+        return
+    result = NameResolver().resolve(names, filter_context=filter)
+    hrefs = {name: result.resolved.get(name) for name in names}
+    if filter: # Filtered lookups return the last match when ambiguous
+        for name, matches in result.ambiguous.items():
+            hrefs[name] = matches[-1].get('href')
+    return [hrefs]
+
+
+#: Result of :meth:`NameResolver.resolve`
+ResolveResult = collections.namedtuple(
+    'ResolveResult', 'resolved not_found ambiguous failed')
+ResolveResult.__doc__ = """
+Result of resolving names to href.
+
+:ivar dict resolved: name to href for names with exactly one match
+:ivar list not_found: names with no match
+:ivar dict ambiguous: name to list of matches (dict with href, name
+    and type) for names with more than one match
+:ivar dict failed: name to exception for names that could not be
+    searched for. Failed names are not cached and are searched again
+    by the next call to resolve
+"""
+
+
+class NameResolver(object):
+    """
+    Resolve element names to href in bulk. Names are grouped by filter
+    context (element type) and resolved using concurrent search requests.
+    When many names are resolved for the same filter context, all
+    elements of that context are retrieved in a single request and
+    matched by name instead of searching for each name. Results are
+    cached by the resolver, so re-use the same instance to avoid
+    searching for the same name twice. Names that could not be searched
+    for are reported in ``failed`` and are not cached.
+    ::
+
+        >>> resolver = NameResolver(max_workers=10)
+        >>> result = resolver.resolve(names, filter_context='host')
+        >>> len(result.resolved), len(result.not_found), len(result.ambiguous)
+        (19876, 121, 3)
+        >>> result.failed
+        {}
+
+    Names in the list may also be provided as a tuple of (name,
+    filter_context) to resolve names of different element types in
+    the same call. Results are keyed by the value provided.
+
+    :param int max_workers: maximum number of concurrent search requests
+    :param int listing_threshold: number of names for the same filter
+        context at which all elements of the context are retrieved
+        instead of searching per name. Set to 0 to always search per
+        name (default: 50)
+    """
+    def __init__(self, max_workers=DEFAULT_WORKERS, listing_threshold=50):
+        self.max_workers = max_workers
+        self.listing_threshold = listing_threshold
+        self._cache = {}  # (filter_context, name) -> list of matches
+
+    def clear(self):
+        """
+        Clear cached results
+        """
+        self._cache.clear()
+
+    def _search(self, key):
+        filter_context, name = key
+        result = SMCRequest(params={'filter': name,
+                                    'filter_context': filter_context,
+                                    'exact_match': True}).read()
+        if result.msg:
+            raise FetchElementFailed(result.msg)
+        matches = result.json or []
+        return [match for match in matches if match.get('name') == name] \
+            or matches
+
+    def _listing(self, filter_context):
+        result = SMCRequest(params={'filter_context': filter_context}).read()
+        if result.msg:
+            raise FetchElementFailed(result.msg)
+        matches = collections.defaultdict(list)
+        for match in result.json or []:
+            matches[match.get('name')].append(match)
+        return matches
+
+    def resolve(self, names, filter_context=None):
+        """
+        Resolve names to href.
+
+        :param list names: names to resolve, or tuples of (name,
+            filter_context)
+        :param str filter_context: filter context for names provided
+            without one, i.e. 'host', 'network_elements', 'services'
+        :rtype: ResolveResult
+        """
+        keys = collections.OrderedDict()
+        for name in names:
+            if isinstance(name, tuple):
+                keys[name] = (name[1], name[0])
+            else:
+                keys[name] = (filter_context, name)
+
+        contexts = collections.defaultdict(set)
+        for key in keys.values():
+            if key not in self._cache:
+                contexts[key[0]].add(key)
+
+        searches = []
+        failed = {} # Not cached so the name is searched again next time
+        for context, context_keys in contexts.items():
+            if context and self.listing_threshold and \
+                len(context_keys) >= self.listing_threshold:
+                try:
+                    matches = self._listing(context)
+                except FetchElementFailed as e:
+                    logger.error('Failed listing elements of: %s, %s',
+                        context, e)
+                    for key in context_keys:
+                        failed[key] = e
+                    continue
+                for key in context_keys:
+                    self._cache[key] = matches.get(key[1], [])
+            else:
+                searches.extend(context_keys)
+
+        for work in concurrent_map(self._search, searches, self.max_workers):
+            if work.ok:
+                self._cache[work.item] = work.result
+            else:
+                logger.error('Failed resolving name: %s, %s', work.item[1],
+                    work.exception)
+                failed[work.item] = work.exception
+
+        result = ResolveResult({}, [], {}, {})
+        for name, key in keys.items():
+            if key in failed:
+                result.failed[name] = failed[key]
+                continue
+            matches = self._cache[key]
+            if len(matches) == 1:
+                result.resolved[name] = matches[0].get('href')
+            elif matches:
+                result.ambiguous[name] = matches
+            else:
+                result.not_found.append(name)
+        return result
 
 
 def all_elements_by_type(name):
@@ -0,0 +1,277 @@
+"""
+.. versionadded:: 0.6.2
+
+Client side analysis of network and service elements to find duplicate and
+unused elements.
+
+:meth:`smc.base.collection.Search.duplicates` and
+:meth:`~smc.base.collection.Search.unused` return the result of a single
+server query. The :class:`ElementAnalyzer` instead retrieves every network and
+service element, compares elements by their normalized value and optionally
+checks the references of each element. Elements are retrieved in pages and
+processed concurrently, and findings are returned as they are found so the
+analysis can run against very large databases::
+
+    >>> from smc.administration.analyzer import ElementAnalyzer
+    >>> analyzer = ElementAnalyzer(check_references=True, max_workers=10)
+    >>> for finding in analyzer.analyze():
+    ...   print(finding)
+    Finding(kind=duplicate, element=Host(name=web01-copy), value=10.0.0.1, duplicate_of=Host(name=web01))
+    Finding(kind=unused, element=TCPService(name=tcp-8443), value=tcp/8443)
+    ...
+    >>> analyzer.summary
+    AnalysisSummary(scanned=104233, duplicates=812, unused=5120)
+
+Write the findings to a JSON lines file as they are found::
+
+    >>> analyzer.write_report('/tmp/analysis.jsonl')
+    AnalysisSummary(scanned=104233, duplicates=812, unused=5120)
+
+Elements are duplicates when their normalized values are equal:
+
+* Host, Router, Network and AddressRange elements are compared by the
+  addresses they cover, so a host 10.0.0.1 and a network 10.0.0.1/32 are
+  duplicates, as are a network 10.0.0.0/30 and a range 10.0.0.0-10.0.0.3.
+* TCP and UDP services are compared by protocol, port ranges and protocol
+  agent; IP services by protocol number; ICMP services by type and code.
+
+Only a fixed size digest of each unique value is kept in memory, with the
+name, href and type of the first element found for that value. Element data
+is released after each element has been processed.
+"""
+import json
+import hashlib
+import logging
+import collections
+from itertools import chain
+from smc.base.model import Element
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+from smc.elements.network import Host, Router, Network, AddressRange
+from smc.elements.service import TCPService, UDPService, IPService, \
+    ICMPService, ICMPIPv6Service, EthernetService
+from smc.elements.ip_index import ip_range, element_addresses
+
+logger = logging.getLogger(__name__)
+
+
+#: Element classes analyzed by default
+DEFAULT_TYPES = (Host, Router, Network, AddressRange, TCPService, UDPService,
+                 IPService, ICMPService, ICMPIPv6Service, EthernetService)
+
+_NETWORK_TYPES = ('host', 'router', 'network', 'address_range')
+
+
+def _port_range(data, prefix):
+    low = data.get('min_%s_port' % prefix)
+    high = data.get('max_%s_port' % prefix)
+    if low in (None, ''):
+        return None
+    return (int(low), int(high) if high not in (None, '') else int(low))
+
+
+def _ports(port_range):
+    if port_range is None:
+        return 'any'
+    low, high = port_range
+    return '%s' % low if low == high else '%s-%s' % (low, high)
+
+
+def normalized_value(typeof, data):
+    """
+    Return the normalized value of an element and a display value. The
+    normalized value is used to compare elements, elements with the
+    same normalized value are duplicates.
+    ::
+
+        >>> normalized_value('host', {'address': '10.0.0.1'})
+        (('address', ((4, 167772161, 167772161),)), '10.0.0.1')
+
+    :param str typeof: element type
+    :param dict data: element json
+    :return: tuple of (value, display), or None if the element type
+        is not compared
+    :rtype: tuple
+    """
+    if typeof in _NETWORK_TYPES:
+        addresses = element_addresses(typeof, data)
+        ranges = set()
+        for address in addresses:
+            try:
+                ranges.add(ip_range(address))
+            except ValueError:
+                ranges.add(address)
+        if not ranges:
+            return None
+        return ('address', tuple(sorted(ranges, key=repr))), ','.join(addresses)
+
+    if typeof in ('tcp_service', 'udp_service'):
+        dst, src = _port_range(data, 'dst'), _port_range(data, 'src')
+        protocol = typeof.split('_')[0]
+        display = '%s/%s' % (protocol, _ports(dst))
+        if src is not None:
+            display += ' src %s' % _ports(src)
+        return (protocol, dst, src, data.get('protocol_agent_ref')), display
+    if typeof == 'ip_service':
+        number = data.get('protocol_number')
+        return ('ip', '%s' % number), 'ip/%s' % number
+    if typeof in ('icmp_service', 'icmp_ipv6_service'):
+        icmp_type, icmp_code = data.get('icmp_type'), data.get('icmp_code')
+        code = None if icmp_code in (None, '') else '%s' % icmp_code
+        return (typeof, '%s' % icmp_type, code), \
+            '%s/%s%s' % (typeof.split('_service')[0], icmp_type,
+                         '' if code is None else '/%s' % code)
+    if typeof == 'ethernet_service':
+        return (typeof, data.get('frame_type'), data.get('value1')), \
+            '%s/%s' % (data.get('frame_type'), data.get('value1'))
+
+
+def _digest(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).digest()
+
+
+class Finding(collections.namedtuple(
+        'Finding', 'kind element value duplicate_of')):
+    """
+    A duplicate or unused element.
+
+    :ivar str kind: 'duplicate' or 'unused'
+    :ivar Element element: the element
+    :ivar str value: display value of the element, i.e. 10.0.0.1, tcp/80
+    :ivar Element duplicate_of: for duplicates, the first element found
+        with the same value
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        """
+        Return the finding as a dict suitable for serializing
+
+        :rtype: dict
+        """
+        finding = {'kind': self.kind, 'href': self.element.href,
+                   'name': self.element.name, 'type': self.element.typeof,
+                   'value': self.value}
+        if self.duplicate_of is not None:
+            finding.update(duplicate_of=self.duplicate_of.href)
+        return finding
+
+    def __repr__(self):
+        finding = 'Finding(kind=%s, element=%s, value=%s' % (
+            self.kind, self.element, self.value)
+        if self.duplicate_of is not None:
+            finding += ', duplicate_of=%s' % self.duplicate_of
+        return finding + ')'
+
+
+class AnalysisSummary(object):
+    """
+    Counts for an analysis.
+
+    :ivar int scanned: number of elements processed
+    :ivar int duplicates: number of duplicate elements found
+    :ivar int unused: number of unused elements found
+    :ivar list failed: list of tuple (element, exception) for elements
+        that could not be processed
+    """
+    def __init__(self):
+        self.scanned = 0
+        self.duplicates = 0
+        self.unused = 0
+        self.failed = []
+
+    def __repr__(self):
+        return 'AnalysisSummary(scanned=%s, duplicates=%s, unused=%s)' % (
+            self.scanned, self.duplicates, self.unused)
+
+
+class ElementAnalyzer(object):
+    """
+    Find duplicate and unused network and service elements.
+
+    :param tuple types: element classes to analyze
+    :param bool check_references: find unused elements by retrieving the
+        references of every element. This adds a request per element
+        (default: True)
+    :param bool include_system: include system defined elements
+        (default: False)
+    :param int max_workers: maximum number of concurrent requests
+    :param int page_size: number of elements retrieved per page
+    """
+    def __init__(self, types=DEFAULT_TYPES, check_references=True,
+                 include_system=False, max_workers=DEFAULT_WORKERS,
+                 page_size=1000):
+        self.types = types
+        self.check_references = check_references
+        self.include_system = include_system
+        self.max_workers = max_workers
+        self.page_size = page_size
+        self.summary = None
+
+    def _process(self, element):
+        data = element.data
+        if data.get('system') and not self.include_system:
+            return None
+        value = normalized_value(element.typeof, data)
+        references = None
+        if self.check_references:
+            references = len(element.referenced_by)
+        element._del_cache()
+        return value, references
+
+    def analyze(self):
+        """
+        Analyze all elements and return findings as they are found. The
+        summary is available from the `summary` attribute once all
+        findings have been returned.
+
+        :return: generator of findings
+        :rtype: Finding
+        """
+        summary = self.summary = AnalysisSummary()
+        first_seen = {}  # digest -> (name, href, type) of first element
+        elements = chain.from_iterable(
+            cls.objects.all().paged(self.page_size) for cls in self.types)
+
+        for work in concurrent_map(self._process, elements, self.max_workers):
+            element = work.item
+            if not work.ok:
+                logger.error('Failed analyzing element: %s, %s', element,
+                    work.exception)
+                summary.failed.append((element, work.exception))
+                continue
+            if work.result is None:
+                continue
+            summary.scanned += 1
+            value, references = work.result
+            display = value[1] if value else None
+            if value is not None:
+                digest = _digest(value[0])
+                original = first_seen.get(digest)
+                if original is None:
+                    first_seen[digest] = (element.name, element.href,
+                                          element.typeof)
+                else:
+                    summary.duplicates += 1
+                    name, href, typeof = original
+                    yield Finding('duplicate', element, display,
+                        Element.from_meta(name=name, href=href, type=typeof))
+            if references == 0:
+                summary.unused += 1
+                yield Finding('unused', element, display, None)
+        logger.debug('Element analysis complete: %s', summary)
+
+    def write_report(self, filename):
+        """
+        Analyze all elements and write each finding to the file as a
+        line of json as it is found.
+
+        :param str filename: name of file to write
+        :raises IOError: failure writing the file
+        :rtype: AnalysisSummary
+        """
+        with open(filename, 'w') as report:
+            for finding in self.analyze():
+                report.write(json.dumps(finding.to_dict(), sort_keys=True))
+                report.write('\n')
+                report.flush()
+        return self.summary
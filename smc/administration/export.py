@@ -0,0 +1,327 @@
+"""
+.. versionadded:: 0.6.2
+
+Client side export of element json to JSON lines files.
+
+:meth:`smc.base.model.Element.export` and
+:meth:`smc.administration.system.System.export_elements` create a zip archive
+using a server side task. The :class:`JSONExporter` instead lists the elements
+of each filter context, retrieves the json of each element concurrently and
+writes one line of json per element. This is suited for backups and for
+tracking configuration changes in a version control system::
+
+    >>> from smc.administration.export import JSONExporter
+    >>> exporter = JSONExporter('/var/backups/smc',
+    ...     contexts=('network_elements', 'services', 'fw_policy'))
+    >>> exporter.export()
+    ExportSummary(exported=10233, resumed=0, failed=0)
+
+A file named after each context is created in the directory, i.e.
+``network_elements.jsonl``. Each line contains the type, name, href and json
+of an element::
+
+    {"data": {"address": "10.0.0.1", "name": "web01", ...}, "href": "/elements/host/707", "name": "web01", "type": "host"}
+
+To keep files stable between exports, lines are sorted by type, name and href
+and keys are sorted. Values that change without the element changing are
+normalized: ``link`` entries are removed and hrefs are made relative to the
+SMC API url, so exports taken from different SMC addresses or API versions can
+be compared.
+
+Elements are written to a partial file as they are retrieved. If an export is
+interrupted, elements fail to be retrieved or the elements of a context cannot
+be listed, calling ``export`` again resumes where it stopped and only retrieves
+the elements that are missing. Once every element of a context is retrieved,
+the partial file is sorted into the final file. The sort holds at most
+:data:`SORT_CHUNK_SIZE` records in memory.
+"""
+import os
+import json
+import heapq
+import logging
+import collections
+from itertools import islice
+from smc import session
+from smc.api.common import SMCRequest
+from smc.api.exceptions import FetchElementFailed
+from smc.base.collection import ElementCollection
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+from smc.base.util import replace_file
+from smc.compat import string_types
+
+logger = logging.getLogger(__name__)
+
+
+#: Filter contexts exported by default
+DEFAULT_CONTEXTS = ('network_elements', 'services')
+
+#: Keys removed from element json
+VOLATILE_KEYS = ('link',)
+
+CHECKPOINT = '.export-checkpoint'
+
+#: Number of records sorted in memory when writing the final file
+SORT_CHUNK_SIZE = 10000
+
+
+class ExportSummary(collections.namedtuple(
+        'ExportSummary', 'exported resumed failed')):
+    """
+    Summary of an export.
+
+    :ivar int exported: number of elements retrieved and written
+    :ivar int resumed: number of elements skipped because they were
+        written by a previous export
+    :ivar list failed: list of tuple (href, exception) for elements that
+        could not be retrieved, or (context, exception) for contexts that
+        could not be listed
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'ExportSummary(exported=%s, resumed=%s, failed=%s)' % (
+            self.exported, self.resumed, len(self.failed))
+
+
+def normalize(data, base_url=None, volatile_keys=VOLATILE_KEYS):
+    """
+    Return a copy of element json with volatile keys removed and hrefs
+    made relative to the base url.
+    ::
+
+        >>> normalize({'name': 'grp', 'element': ['http://1.1.1.1:8082/6.4/elements/host/1'],
+        ...     'link': [...]}, base_url='http://1.1.1.1:8082/6.4')
+        {'name': 'grp', 'element': ['/elements/host/1']}
+
+    :param dict data: element json
+    :param str base_url: url removed from the start of hrefs, typically the
+        SMC url and API version
+    :param tuple volatile_keys: keys removed from dicts at any level
+    :rtype: dict
+    """
+    if isinstance(data, dict):
+        return {key: normalize(value, base_url, volatile_keys)
+                for key, value in data.items() if key not in volatile_keys}
+    if isinstance(data, list):
+        return [normalize(value, base_url, volatile_keys) for value in data]
+    if base_url and isinstance(data, string_types) and \
+            data.startswith(base_url + '/'):
+        return data[len(base_url):]
+    return data
+
+
+def _sort_key(line):
+    record = json.loads(line)
+    return (record.get('type') or '', record.get('name') or '', record['href'])
+
+
+def _sort_lines(source, target, chunk_size=SORT_CHUNK_SIZE):
+    """
+    Write the lines of a JSON lines export file sorted by type, name and
+    href. Lines are sorted in chunks written to temporary files which are
+    then merged, so at most chunk_size lines are held in memory.
+    """
+    chunks = []
+    try:
+        with open(source, 'r') as f:
+            while True:
+                lines = list(islice(f, chunk_size))
+                if not lines:
+                    break
+                chunk = sorted((_sort_key(line), line.rstrip('\n') + '\n')
+                               for line in lines if line.strip())
+                path = '%s.%s' % (target, len(chunks))
+                chunks.append(path)
+                with open(path, 'w') as out:
+                    out.writelines(line for _, line in chunk)
+        files = [open(path, 'r') for path in chunks]
+        try:
+            merged = heapq.merge(*[((_sort_key(line), line) for line in f)
+                                   for f in files])
+            with open(target, 'w') as out:
+                out.writelines(line for _, line in merged)
+        finally:
+            for f in files:
+                f.close()
+    finally:
+        for path in chunks:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class JSONExporter(object):
+    """
+    Export the json of elements to JSON lines files, one file per filter
+    context.
+
+    :param str directory: directory to write files to. It is created if it
+        does not exist
+    :param tuple contexts: filter contexts or element types to export, i.e.
+        'network_elements', 'services', 'host' or 'fw_policy'
+    :param int max_workers: maximum number of concurrent requests
+    :param int page_size: number of elements listed per request
+    :param tuple volatile_keys: keys removed from element json
+    """
+    def __init__(self, directory, contexts=DEFAULT_CONTEXTS,
+                 max_workers=DEFAULT_WORKERS, page_size=1000,
+                 volatile_keys=VOLATILE_KEYS):
+        self.directory = directory
+        self.contexts = tuple(contexts)
+        self.max_workers = max_workers
+        self.page_size = page_size
+        self.volatile_keys = volatile_keys
+
+    def __repr__(self):
+        return 'JSONExporter(directory=%s, contexts=%s)' % (
+            self.directory, ','.join(self.contexts))
+
+    def filename(self, context):
+        """
+        Name of the export file for the context
+
+        :param str context: filter context
+        :rtype: str
+        """
+        return os.path.join(self.directory, '%s.jsonl' % context)
+
+    @property
+    def _checkpoint(self):
+        return os.path.join(self.directory, CHECKPOINT)
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._checkpoint, 'r') as f:
+                checkpoint = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if checkpoint.get('contexts') != list(self.contexts):
+            return None
+        return checkpoint
+
+    def _write_checkpoint(self, completed):
+        tmp = self._checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'contexts': list(self.contexts),
+                       'completed': completed}, f)
+        replace_file(tmp, self._checkpoint)
+
+    def _record(self, meta, base_url):
+        result = SMCRequest(href=meta.href).read()
+        if not result.json:
+            raise FetchElementFailed(result.msg)
+        record = {'type': meta.type, 'name': meta.name,
+                  'href': normalize(meta.href, base_url),
+                  'data': normalize(result.json, base_url, self.volatile_keys)}
+        return json.dumps(record, sort_keys=True)
+
+    def _clean_partial(self, partial):
+        """
+        Rewrite a partial file without the lines truncated by an
+        interrupted export.
+        """
+        tmp = partial + '.tmp'
+        with open(partial, 'r') as f, open(tmp, 'w') as out:
+            for line in f:
+                try:
+                    json.loads(line)['href']
+                except (ValueError, KeyError):
+                    continue
+                out.write(line if line.endswith('\n') else line + '\n')
+        replace_file(tmp, partial)
+
+    def _export_context(self, context, base_url, summary):
+        """
+        Export a single context. Returns True if every element was
+        exported and the final file was written.
+        """
+        partial = self.filename(context) + '.partial'
+        done = set()
+        if os.path.exists(partial):
+            truncated = False
+            with open(partial, 'r') as f:
+                for line in f:
+                    try:
+                        done.add(json.loads(line)['href'])
+                    except (ValueError, KeyError):
+                        truncated = True  # Interrupted export
+            if truncated:
+                self._clean_partial(partial)
+
+        listing = {'complete': True}
+
+        def pending():
+            collection = ElementCollection(filter_context=context)
+            try:
+                for element in collection.paged(self.page_size):
+                    if normalize(element.href, base_url) in done:
+                        summary['resumed'] += 1
+                    else:
+                        yield element._meta
+            except FetchElementFailed as e:
+                logger.error('Failed to list elements of %s: %s', context, e)
+                summary['failed'].append((context, e))
+                listing['complete'] = False
+
+        complete = True
+        with open(partial, 'a') as f:
+            for work in concurrent_map(lambda meta: self._record(meta, base_url),
+                                       pending(), self.max_workers):
+                if not work.ok:
+                    logger.error('Failed to export element: %s, %s',
+                        work.item.href, work.exception)
+                    summary['failed'].append((work.item.href, work.exception))
+                    complete = False
+                    continue
+                f.write(work.result)
+                f.write('\n')
+                summary['exported'] += 1
+            f.flush()
+        if not complete or not listing['complete']:
+            return False
+
+        tmp = self.filename(context) + '.tmp'
+        _sort_lines(partial, tmp)
+        replace_file(tmp, self.filename(context))
+        os.remove(partial)
+        return True
+
+    def export(self, resume=True):
+        """
+        Export the elements of each context. If a previous export of the
+        same contexts did not complete and resume is True, completed
+        contexts are skipped and elements already retrieved are not
+        retrieved again.
+
+        :param bool resume: resume an incomplete export (default: True)
+        :raises IOError: failure writing files
+        :return: number of elements exported, skipped because they were
+            exported by a previous run, and elements that failed
+        :rtype: ExportSummary
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        checkpoint = self._read_checkpoint() if resume else None
+        completed = checkpoint['completed'] if checkpoint else []
+        if checkpoint is None:
+            for context in self.contexts:
+                if os.path.exists(self.filename(context) + '.partial'):
+                    os.remove(self.filename(context) + '.partial')
+        self._write_checkpoint(completed)
+
+        base_url = '%s/%s' % (session.url, session.api_version) \
+            if session.url else None
+        summary = {'exported': 0, 'resumed': 0, 'failed': []}
+        for context in self.contexts:
+            if context in completed:
+                logger.debug('Skipping completed context: %s', context)
+                continue
+            if self._export_context(context, base_url, summary):
+                completed.append(context)
+                self._write_checkpoint(completed)
+
+        if len(completed) == len(self.contexts):
+            os.remove(self._checkpoint)
+        result = ExportSummary(summary['exported'], summary['resumed'],
+                               summary['failed'])
+        logger.debug('Export complete: %s', result)
+        return result
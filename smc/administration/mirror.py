@@ -0,0 +1,397 @@
+"""
+.. versionadded:: 0.6.2
+
+Local mirror of SMC elements stored in a SQLite database.
+
+Reporting and validation scripts often retrieve the same configuration from
+the SMC each time they run. A :class:`ConfigMirror` stores the meta, json and
+ETag of each element in a local SQLite database so queries can be answered
+without making requests to the SMC.
+
+The initial load retrieves each element concurrently. Subsequent loads only
+retrieve elements that changed since the last load (checked by ETag) and
+remove elements that no longer exist. If the elements of a context cannot
+be listed completely, no elements are removed for that context::
+
+    >>> from smc.administration.mirror import ConfigMirror
+    >>> mirror = ConfigMirror('/var/tmp/smc-mirror.db')
+    >>> mirror.load()           # network elements and services by default
+    MirrorLoad(loaded=10233, unchanged=0, removed=0)
+    >>> mirror.load()
+    MirrorLoad(loaded=12, unchanged=10221, removed=3)
+
+Query the mirror. Elements returned have their data served from the mirror,
+accessing element attributes does not make a request to the SMC::
+
+    >>> mirror.count('host')
+    5120
+    >>> mirror.get_by_name('web01')
+    [Host(name=web01)]
+    >>> mirror.get_by_name('web01')[0].address
+    '10.0.0.1'
+    >>> for network in mirror.elements('network', name_contains='10.0'):
+    ...   print(network.ipv4_network)
+
+The mirror can be kept current by following the SMC notification socket.
+This requires the `smc-python-monitoring` package::
+
+    >>> for action, href in mirror.follow():
+    ...   print(action, href)
+    update http://1.1.1.1:8082/6.4/elements/host/707
+
+``follow`` runs until the socket is closed; run it in a separate thread to
+keep the mirror current while it is being queried.
+"""
+import json
+import time
+import sqlite3
+import logging
+import threading
+import collections
+from itertools import chain
+from smc.api.common import SMCRequest
+from smc.api.exceptions import FetchElementFailed
+from smc.base.cache import conditional_fetch
+from smc.base.collection import ElementCollection
+from smc.base.model import ElementCache, lookup_class
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+#: Filter contexts loaded by default
+DEFAULT_CONTEXTS = ('network_elements', 'services')
+
+#: Notification actions that add or modify an element
+UPDATE_ACTIONS = ('create', 'update', 'untrashed')
+
+#: Notification actions that remove an element
+DELETE_ACTIONS = ('delete', 'trashed')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS elements ('
+    'href TEXT PRIMARY KEY, type TEXT, name TEXT, etag TEXT, '
+    'context TEXT, data TEXT, synced REAL)',
+    'CREATE INDEX IF NOT EXISTS elements_type ON elements (type)',
+    'CREATE INDEX IF NOT EXISTS elements_name ON elements (name)',
+    'CREATE INDEX IF NOT EXISTS elements_context ON elements (context)')
+
+
+#: Summary of a mirror load
+MirrorLoad = collections.namedtuple('MirrorLoad', 'loaded unchanged removed')
+
+
+class ConfigMirror(object):
+    """
+    Mirror of SMC elements in a SQLite database.
+
+    :param str path: path of the SQLite database. The database is created
+        if it does not exist. Use ':memory:' for an in memory mirror
+    :param int max_workers: maximum number of concurrent requests used
+        when loading
+    :param int page_size: number of elements listed per request
+    """
+    def __init__(self, path, max_workers=DEFAULT_WORKERS, page_size=1000):
+        self.path = path
+        self.max_workers = max_workers
+        self.page_size = page_size
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            for statement in _SCHEMA:
+                self._conn.execute(statement)
+
+    def close(self):
+        """
+        Close the database
+        """
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, href):
+        return self.json(href) is not None
+
+    def __repr__(self):
+        return 'ConfigMirror(path=%s, elements=%s)' % (self.path, len(self))
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _upsert(self, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO elements '
+                '(href, type, name, etag, context, data, synced) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _delete(self, hrefs):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'DELETE FROM elements WHERE href = ?',
+                [(href,) for href in hrefs])
+
+    @staticmethod
+    def _row(meta, context, result):
+        return (meta.get('href'), meta.get('type'),
+                result.json.get('name', meta.get('name')), result.etag,
+                context, json.dumps(result.json), time.time())
+
+    def load(self, contexts=DEFAULT_CONTEXTS):
+        """
+        Load elements into the mirror. Each context is a filter context
+        or element type, i.e. 'network_elements', 'services', 'host' or
+        'fw_policy'. Elements already in the mirror are only retrieved
+        if their ETag changed. Elements previously loaded for a context
+        that no longer exist are removed, unless the listing of the
+        context failed.
+
+        :param tuple contexts: filter contexts or element types to load
+        :return: number of elements loaded, unchanged and removed
+        :rtype: MirrorLoad
+        """
+        etags = {href: etag for href, etag in self._execute(
+            'SELECT href, etag FROM elements')}
+
+        incomplete = set()
+
+        def listing(context):
+            collection = ElementCollection(filter_context=context)
+            try:
+                for element in collection.paged(self.page_size):
+                    yield context, element._meta._asdict()
+            except FetchElementFailed as e:
+                logger.error('Failed to list elements of %s, elements will '
+                    'not be removed: %s', context, e)
+                incomplete.add(context)
+
+        def fetch(entry):
+            context, meta = entry
+            href = meta.get('href')
+            if href in etags:
+                result = conditional_fetch(href, etags[href])
+                if result is None:
+                    return None
+            else:
+                result = SMCRequest(href=href).read()
+            if not result.json:
+                raise FetchElementFailed(result.msg)
+            return self._row(meta, context, result)
+
+        seen = collections.defaultdict(set)
+        rows, loaded, unchanged = [], 0, 0
+        entries = chain.from_iterable(listing(context) for context in contexts)
+        for work in concurrent_map(fetch, entries, self.max_workers):
+            context, meta = work.item
+            seen[context].add(meta.get('href'))
+            if not work.ok:
+                logger.error('Failed to load element: %s, %s',
+                    meta.get('href'), work.exception)
+            elif work.result is None:
+                unchanged += 1
+            else:
+                rows.append(work.result)
+                loaded += 1
+                if len(rows) >= self.page_size:
+                    self._upsert(rows)
+                    rows = []
+        self._upsert(rows)
+
+        removed = []
+        for context in contexts:
+            if context in incomplete:
+                continue
+            removed.extend(
+                href for href, in self._execute(
+                    'SELECT href FROM elements WHERE context = ?', (context,))
+                if href not in seen[context])
+        self._delete(removed)
+        load = MirrorLoad(loaded, unchanged, len(removed))
+        logger.debug('Mirror load complete: %s', load)
+        return load
+
+    def apply(self, action, href):
+        """
+        Apply a change notification to the mirror. Elements that are
+        created or updated are retrieved from the SMC, elements that are
+        deleted are removed.
+
+        :param str action: notification action, i.e. 'create', 'update',
+            'delete'
+        :param str href: href of the element
+        :return: True if the mirror was modified
+        :rtype: bool
+        """
+        if action in DELETE_ACTIONS:
+            self._delete([href])
+            return True
+        if action in UPDATE_ACTIONS:
+            result = SMCRequest(href=href).read()
+            if not result.json:
+                self._delete([href])
+                return True
+            links = [link for link in result.json.get('link', [])
+                     if link.get('rel') == 'self']
+            meta = {'href': href,
+                    'type': links[0].get('type') if links else None}
+            self._upsert([self._row(meta, self._context(meta), result)])
+            return True
+        return False
+
+    def _context(self, meta):
+        """
+        Context of an element applied from a notification. This is the
+        context the element was loaded from or, for a new element, the
+        context of mirrored elements of the same type. If no element of
+        the type is mirrored, the type is used as the context.
+        """
+        for context, in self._execute(
+                'SELECT context FROM elements WHERE href = ?', (meta['href'],)):
+            return context
+        if meta['type'] is not None:
+            for context, in self._execute(
+                    'SELECT context FROM elements WHERE type = ? AND '
+                    'context IS NOT NULL LIMIT 1', (meta['type'],)):
+                return context
+        return meta['type']
+
+    def follow(self, entry_points='', **sockopt):
+        """
+        Follow the SMC notification socket and apply changes to the
+        mirror. This is a generator that yields the action and href of
+        each change after it has been applied, and runs until the socket
+        is closed. Requires the smc-python-monitoring package.
+
+        :param str entry_points: comma separated entry points to follow,
+            an empty string follows all elements
+        :param sockopt: socket options, see
+            :class:`smc_monitoring.pubsub.subscribers.Notification`
+        :raises ImportError: smc-python-monitoring is not installed
+        :return: generator of tuple (action, href)
+        """
+        try:
+            from smc_monitoring.pubsub.subscribers import Notification
+        except ImportError:
+            raise ImportError('Following notifications requires the '
+                'smc-python-monitoring package')
+
+        notification = Notification(entry_points, **sockopt)
+        for result in notification.notify():
+            for event in result.get('events', []):
+                action, href = event.get('type'), event.get('element')
+                try:
+                    if self.apply(action, href):
+                        yield action, href
+                except Exception as e:
+                    logger.error('Failed to apply notification: %s %s, %s',
+                        action, href, e)
+
+    def json(self, href):
+        """
+        Return the json of an element from the mirror.
+
+        :param str href: href of element
+        :return: element json, or None if not mirrored
+        :rtype: dict
+        """
+        rows = self._execute(
+            'SELECT data FROM elements WHERE href = ?', (href,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def _element(self, href, typeof, name, etag, data):
+        element = lookup_class(typeof)(name=name, href=href, type=typeof)
+        element.data = ElementCache(json.loads(data), etag=etag)
+        return element
+
+    def get(self, href):
+        """
+        Return the element from the mirror.
+
+        :param str href: href of element
+        :return: element with data from the mirror, or None
+        :rtype: Element
+        """
+        for row in self._execute(
+                'SELECT href, type, name, etag, data FROM elements '
+                'WHERE href = ?', (href,)):
+            return self._element(*row)
+
+    def get_by_name(self, name, typeof=None):
+        """
+        Return elements from the mirror with the exact name.
+
+        :param str name: name of element
+        :param str typeof: optional element type
+        :rtype: list(Element)
+        """
+        return list(self.elements(typeof, name=name))
+
+    def elements(self, typeof=None, name=None, name_contains=None):
+        """
+        Iterate elements in the mirror, optionally filtered by type and
+        name.
+
+        :param str typeof: element type, i.e. 'host'
+        :param str name: exact name
+        :param str name_contains: partial name, case insensitive
+        :return: generator of elements with data from the mirror
+        :rtype: Element
+        """
+        clauses, params = [], []
+        if typeof is not None:
+            clauses.append('type = ?')
+            params.append(typeof)
+        if name is not None:
+            clauses.append('name = ?')
+            params.append(name)
+        if name_contains is not None:
+            clauses.append("name LIKE ? ESCAPE '\\'")
+            params.append('%%%s%%' % name_contains.replace('\\', '\\\\')
+                .replace('%', '\\%').replace('_', '\\_'))
+        sql = 'SELECT href, type, name, etag, data FROM elements'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        for row in self._execute(sql + ' ORDER BY type, name', params):
+            yield self._element(*row)
+
+    def count(self, typeof=None):
+        """
+        Number of elements in the mirror.
+
+        :param str typeof: optionally count only this element type
+        :rtype: int
+        """
+        if typeof is None:
+            return self._execute('SELECT COUNT(*) FROM elements')[0][0]
+        return self._execute(
+            'SELECT COUNT(*) FROM elements WHERE type = ?', (typeof,))[0][0]
+
+    def types(self):
+        """
+        Element types in the mirror with the number of elements of each.
+
+        :rtype: dict
+        """
+        return dict(self._execute(
+            'SELECT type, COUNT(*) FROM elements GROUP BY type'))
+
+    def query(self, sql, params=()):
+        """
+        Run a SQL query against the mirror. The ``elements``
+        table has the columns href, type, name, etag, context, data
+        (json) and synced (time of last update).
+
+        :param str sql: SQL statement
+        :param tuple params: query parameters
+        :rtype: list(tuple)
+        """
+        return self._execute(sql, params)
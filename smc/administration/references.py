@@ -0,0 +1,380 @@
+"""
+.. versionadded:: 0.6.2
+
+Reference graph of SMC elements used for impact analysis.
+
+:attr:`smc.base.model.Element.referenced_by` returns the elements that
+directly reference a single element. Before deleting or changing shared
+elements it is often necessary to know everything that depends on an element,
+directly or through groups and other elements. A :class:`ReferenceGraph`
+retrieves the references of many elements concurrently and answers
+dependency queries locally::
+
+    >>> from smc.administration.references import ReferenceGraph
+    >>> graph = ReferenceGraph('/var/tmp/smc-references.json')
+    >>> graph.build()       # network elements and services by default
+    ReferenceGraph(elements=10233, references=22140)
+    >>> graph.save()
+    >>> graph.dependents(Host('web01'))
+    [Group(name=web-servers), FirewallPolicy(name=Corporate)]
+    >>> graph.dependents(Host('web01'), transitive=False)
+    [Group(name=web-servers)]
+
+Once saved, the graph is loaded from disk when created. Call
+:meth:`ReferenceGraph.refresh` to update the graph. Elements that changed
+since the graph was built are found by ETag, and only the references of the
+elements affected by those changes are retrieved again::
+
+    >>> graph = ReferenceGraph('/var/tmp/smc-references.json')
+    >>> graph.refresh()
+    GraphRefresh(added=3, removed=1, recomputed=17)
+    >>> graph.save()
+
+Only elements of the graph contexts are listed and checked for changes.
+Referrers of other types, such as policies when building the graph for
+network elements, are found when the references of an element they
+reference are retrieved, but a new or changed referrer of another type is
+not detected by :meth:`~ReferenceGraph.refresh`. Include the type in the
+contexts (i.e. ``contexts=('network_elements', 'services', 'fw_policy')``)
+to track it, or call :meth:`~ReferenceGraph.update` with the elements it
+references.
+"""
+import os
+import json
+import logging
+import collections
+from smc.api.common import SMCRequest, fetch_entry_point
+from smc.api.exceptions import FetchElementFailed
+from smc.base.cache import conditional_fetch
+from smc.base.collection import ElementCollection
+from smc.base.model import Element
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+from smc.base.util import replace_file
+from smc.compat import string_types
+
+logger = logging.getLogger(__name__)
+
+
+#: Filter contexts built by default
+DEFAULT_CONTEXTS = ('network_elements', 'services')
+
+#: Summary of a graph refresh
+GraphRefresh = collections.namedtuple('GraphRefresh', 'added removed recomputed')
+
+
+def _href(element):
+    return getattr(element, 'href', element)
+
+
+def element_hrefs(data):
+    """
+    Return the element hrefs referenced in element json, excluding the
+    elements own links.
+
+    :param dict data: element json
+    :rtype: set
+    """
+    hrefs = set()
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(v for k, v in value.items() if k != 'link')
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, string_types) and '/elements/' in value:
+            hrefs.add(value)
+    return hrefs
+
+
+class ReferenceGraph(object):
+    """
+    Graph of references between elements. An edge from A to B means A
+    references (depends on) B, for example a group referencing a host or
+    a policy referencing a network.
+
+    :param str path: optional file used to save the graph. If the file
+        exists, the graph is loaded from it
+    :param tuple contexts: filter contexts of the elements to build the
+        graph for
+    :param int max_workers: maximum number of concurrent requests
+    """
+    def __init__(self, path=None, contexts=DEFAULT_CONTEXTS,
+                 max_workers=DEFAULT_WORKERS):
+        self.path = path
+        self.contexts = contexts
+        self.max_workers = max_workers
+        self._nodes = {}            # href -> (name, type)
+        self._etags = {}            # href -> etag
+        self._targets = set()       # hrefs with references retrieved
+        self._referenced_by = {}    # href -> set of referring hrefs
+        self._references = None    # href -> set of referenced hrefs
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, element):
+        return _href(element) in self._nodes
+
+    def __repr__(self):
+        return 'ReferenceGraph(elements=%s, references=%s)' % (
+            len(self._nodes), sum(len(r) for r in self._referenced_by.values()))
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            graph = json.load(f)
+        self.contexts = tuple(graph.get('contexts', self.contexts))
+        for href, (name, typeof, etag) in graph['nodes'].items():
+            self._nodes[href] = (name, typeof)
+            if etag:
+                self._etags[href] = etag
+        self._targets = set(graph['targets'])
+        self._referenced_by = {href: set(refs) for href, refs in
+                               graph['referenced_by'].items()}
+        logger.debug('Loaded reference graph: %s, %s', self.path, self)
+
+    def save(self, path=None):
+        """
+        Save the graph to disk.
+
+        :param str path: file to save to, defaults to the path provided
+            when the graph was created
+        :raises IOError: failure writing the file
+        :return: None
+        """
+        path = path or self.path
+        graph = {
+            'version': 1,
+            'contexts': list(self.contexts),
+            'nodes': {href: [name, typeof, self._etags.get(href)]
+                      for href, (name, typeof) in self._nodes.items()},
+            'targets': sorted(self._targets),
+            'referenced_by': {href: sorted(refs) for href, refs in
+                              self._referenced_by.items()}}
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(graph, f)
+        replace_file(tmp, path)
+
+    def _fetch_references(self, href):
+        result = SMCRequest(
+            href=fetch_entry_point('references_by_element'),
+            json={'value': href}).create()
+        if result.msg:
+            raise FetchElementFailed(result.msg)
+        return result.json or []
+
+    def _fetch(self, href):
+        """
+        Retrieve the references of the element, and its ETag if the ETag
+        is not known so later refreshes can detect changes.
+        """
+        references = self._fetch_references(href)
+        etag = None
+        if href not in self._etags:
+            etag = SMCRequest(href=href).read().etag
+        return references, etag
+
+    def _compute(self, hrefs):
+        """
+        Retrieve the references of each href concurrently and replace
+        the references in the graph.
+        """
+        for work in concurrent_map(self._fetch, hrefs, self.max_workers):
+            if not work.ok:
+                logger.error('Failed retrieving references for: %s, %s',
+                    work.item, work.exception)
+                continue
+            references, etag = work.result
+            if etag:
+                self._etags[work.item] = etag
+            referrers = set()
+            for ref in references:
+                self._nodes.setdefault(ref['href'], (ref.get('name'),
+                                                     ref.get('type')))
+                referrers.add(ref['href'])
+            self._referenced_by[work.item] = referrers
+            self._targets.add(work.item)
+        self._references = None
+
+    def _listing(self, elements):
+        if elements is None:
+            elements = (element for context in self.contexts
+                        for element in ElementCollection(
+                            filter_context=context).paged())
+        listed = {}
+        for element in elements:
+            listed[element.href] = (element.name, element.typeof)
+        return listed
+
+    def build(self, elements=None):
+        """
+        Build the graph for the specified elements, or all elements of
+        the graph contexts. Any existing graph is replaced.
+
+        :param list elements: elements to retrieve references for
+        :rtype: ReferenceGraph
+        """
+        self._nodes, self._etags = {}, {}
+        self._targets, self._referenced_by = set(), {}
+        listed = self._listing(elements)
+        self._nodes.update(listed)
+        self._compute(list(listed))
+        logger.debug('Built reference graph: %s', self)
+        return self
+
+    def update(self, elements):
+        """
+        Retrieve the references for the specified elements again, adding
+        them to the graph if they are not already present.
+
+        :param list elements: elements or hrefs to update
+        :return: None
+        """
+        hrefs = []
+        for element in elements:
+            if isinstance(element, Element):
+                self._nodes[element.href] = (element.name, element.typeof)
+            hrefs.append(_href(element))
+        self._compute(hrefs)
+
+    def _remove(self, href):
+        self._nodes.pop(href, None)
+        self._etags.pop(href, None)
+        self._targets.discard(href)
+        self._referenced_by.pop(href, None)
+        for referrers in self._referenced_by.values():
+            referrers.discard(href)
+        self._references = None
+
+    def refresh(self, elements=None):
+        """
+        Update the graph with changes made since it was built. Elements of
+        the graph contexts (or the elements provided) are listed to find
+        added and removed elements. Every element in the graph with a
+        known ETag is checked for changes. References are retrieved again
+        for added elements, changed elements, and the elements referenced
+        by an added element or by a changed element before or after the
+        change.
+
+        :param list elements: elements to track, defaults to all elements
+            of the graph contexts
+        :return: number of elements added, removed and recomputed
+        :rtype: GraphRefresh
+        """
+        listed = self._listing(elements)
+        removed = [href for href in self._targets if href not in listed]
+        for href in removed:
+            self._remove(href)
+        added = [href for href in listed if href not in self._targets]
+        for href in added:
+            self._nodes[href] = listed[href]
+        new = set(added)
+
+        def check(href):
+            if href in new:
+                return SMCRequest(href=href).read()
+            return conditional_fetch(href, self._etags[href])
+
+        references = self.references_map()
+        affected = set(added)
+        known = [href for href in self._nodes
+                 if href in self._etags and href not in new]
+        for work in concurrent_map(check, added + known, self.max_workers):
+            href, result = work.item, work.result
+            if not work.ok or result is None:
+                continue
+            if not result.json:
+                if href not in new:
+                    self._remove(href)
+                    removed.append(href)
+                continue
+            self._etags[href] = result.etag
+            affected.update(references.get(href, ()))
+            affected.update(element_hrefs(result.json))
+            affected.add(href)
+
+        recompute = [href for href in affected
+                     if href in self._targets or href in new]
+        self._compute(recompute)
+        refresh = GraphRefresh(len(added), len(removed), len(recompute))
+        logger.debug('Refreshed reference graph: %s, %s', self, refresh)
+        return refresh
+
+    def references_map(self):
+        """
+        Return the forward references of the graph, mapping each href to
+        the hrefs it references.
+
+        :rtype: dict
+        """
+        if self._references is None:
+            references = {}
+            for href, referrers in self._referenced_by.items():
+                for referrer in referrers:
+                    references.setdefault(referrer, set()).add(href)
+            self._references = references
+        return self._references
+
+    def _walk(self, href, edges, transitive):
+        seen, stack = set(), [href]
+        while stack:
+            for adjacent in edges.get(stack.pop(), ()):
+                if adjacent not in seen and adjacent != href:
+                    seen.add(adjacent)
+                    if transitive:
+                        stack.append(adjacent)
+        return seen
+
+    def _elements(self, hrefs):
+        elements = []
+        for href in sorted(hrefs):
+            name, typeof = self._nodes.get(href, (None, None))
+            elements.append(Element.from_meta(name=name, href=href, type=typeof))
+        return elements
+
+    def dependents(self, element, transitive=True):
+        """
+        Return the elements that depend on the element, i.e. groups and
+        policies that reference it. With transitive, elements that
+        depend on those elements are also returned.
+
+        :param element: element or href
+        :param bool transitive: include indirect dependents (default: True)
+        :rtype: list(Element)
+        """
+        return self._elements(self._walk(
+            _href(element), self._referenced_by, transitive))
+
+    def dependencies(self, element, transitive=True):
+        """
+        Return the elements the element depends on, i.e. the members of a
+        group. Only references to elements in the graph are known.
+
+        :param element: element or href
+        :param bool transitive: include indirect dependencies (default: True)
+        :rtype: list(Element)
+        """
+        return self._elements(self._walk(
+            _href(element), self.references_map(), transitive))
+
+    def is_referenced(self, element):
+        """
+        Whether any element references the element.
+
+        :param element: element or href
+        :rtype: bool
+        """
+        return bool(self._referenced_by.get(_href(element)))
+
+    def unreferenced(self):
+        """
+        Return elements in the graph whose references were retrieved
+        and are not referenced by any element.
+
+        :rtype: list(Element)
+        """
+        return self._elements(href for href in self._targets
+                              if not self._referenced_by.get(href))
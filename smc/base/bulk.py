@@ -0,0 +1,335 @@
+"""
+Concurrent creation and deletion of many elements.
+
+Creating elements with the elements ``create`` classmethod sends one request
+per element and waits for each response before sending the next. When
+importing large numbers of elements, for example hosts and networks from an
+IPAM, use :meth:`~smc.base.model.Element.bulk_create` to send the create
+requests concurrently using a bounded pool of threads::
+
+    >>> hosts = [{'name': 'host-%s' % i, 'address': '10.0.%s.%s' % (i // 256, i % 256)}
+    ...          for i in range(5000)]
+    >>> result = Host.bulk_create(hosts, max_workers=10)
+    >>> result
+    BulkCreateResult(created=4998, existing=1, updated=0, failed=1)
+    >>> for kwargs, error in result.failed:
+    ...     print(kwargs['name'], error)
+
+Existing elements are found by name with a single query for the element type
+before any create requests are sent. By default, existing elements are
+skipped. Set ``on_existing='update'`` to update existing elements that differ
+from the provided values using :meth:`~smc.base.model.Element.update_or_create`, or
+``on_existing='fail'`` to skip the query and send every create request.
+
+:meth:`~smc.base.model.Element.bulk_get_or_create` returns every element by
+name whether it was created or already existed::
+
+    >>> result = Network.bulk_get_or_create(networks)
+    >>> result.elements['mynetwork']
+    Network(name=mynetwork)
+
+Elements that are referenced by other elements cannot be deleted until the
+referencing elements are deleted. :func:`bulk_delete` retrieves the
+references of each element and deletes the elements in waves; elements in
+a wave are not referenced by any element still to be deleted and are deleted
+concurrently. Elements referenced by an element that is not being deleted
+are not attempted::
+
+    >>> from smc.base.bulk import bulk_delete
+    >>> lab = list(Search.objects.entry_point('host').filter('lab-')) + \
+    ...     list(Search.objects.entry_point('group').filter('lab-'))
+    >>> result = bulk_delete(lab, empty_trash=True)
+    >>> result
+    BulkDeleteResult(deleted=212, blocked=1, failed=0, waves=3)
+    >>> for element, referrers in result.blocked:
+    ...     print(element, referrers)
+    Host(name=lab-dns) [FirewallPolicy(name=Corporate)]
+
+Use :func:`delete_plan` to see the waves without deleting anything.
+"""
+import logging
+from smc.api.exceptions import CreateElementFailed, DeleteElementFailed
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+#: Valid options for handling elements that already exist
+ON_EXISTING = ('skip', 'update', 'fail')
+
+
+class BulkCreateResult(object):
+    """
+    Result of a bulk create operation.
+
+    :ivar list created: elements created
+    :ivar list existing: elements that already existed and were not modified
+    :ivar list updated: elements that already existed and were updated
+    :ivar list failed: list of tuple (kwargs, exception) for each element
+        that could not be created or updated
+    """
+    def __init__(self):
+        self.created = []
+        self.existing = []
+        self.updated = []
+        self.failed = []
+
+    @property
+    def ok(self):
+        """
+        Whether all elements were created or found
+
+        :rtype: bool
+        """
+        return not self.failed
+
+    @property
+    def elements(self):
+        """
+        All created, existing and updated elements by name
+
+        :rtype: dict
+        """
+        return {element.name: element
+                for element in self.created + self.existing + self.updated}
+
+    def __len__(self):
+        return len(self.created) + len(self.existing) + len(self.updated) + \
+            len(self.failed)
+
+    def __repr__(self):
+        return 'BulkCreateResult(created=%s, existing=%s, updated=%s, ' \
+            'failed=%s)' % (len(self.created), len(self.existing),
+                            len(self.updated), len(self.failed))
+
+
+def bulk_create(cls, elements, on_existing='skip', max_workers=DEFAULT_WORKERS):
+    """
+    Create elements of type cls concurrently. See
+    :meth:`smc.base.model.Element.bulk_create`.
+
+    :rtype: BulkCreateResult
+    """
+    if on_existing not in ON_EXISTING:
+        raise ValueError('on_existing must be one of %s, got: %r' %
+            (', '.join(ON_EXISTING), on_existing))
+    if not hasattr(cls, 'create'):
+        raise CreateElementFailed('%s is a read-only element and cannot be '
+            'created' % cls.__name__)
+
+    result = BulkCreateResult()
+    existing = {}
+    if on_existing != 'fail':
+        existing = {element.name: element for element in cls.objects.all()}
+
+    seen = set()
+    work = []
+    for kwargs in elements:
+        name = kwargs.get('name')
+        if not name:
+            result.failed.append((kwargs, CreateElementFailed(
+                'Name field is a required parameter for all create type '
+                'operations on an element')))
+        elif name in seen:
+            result.failed.append((kwargs, CreateElementFailed(
+                'Element %r is specified more than once' % name)))
+        else:
+            seen.add(name)
+            work.append(kwargs)
+
+    def create(kwargs):
+        element = existing.get(kwargs['name'])
+        if element is not None:
+            if on_existing == 'update':
+                element, updated, _ = cls.update_or_create(
+                    with_status=True, **kwargs)
+                return 'updated' if updated else 'existing', element
+            return 'existing', element
+        params = {k: v() if callable(v) else v for k, v in kwargs.items()}
+        try:
+            return 'created', cls.create(**params)
+        except TypeError as e:
+            raise CreateElementFailed('%s: %r missing constructor arguments '
+                'to properly create: %s' % (cls.__name__, kwargs['name'], e))
+
+    for outcome in concurrent_map(create, work, max_workers, ordered=True):
+        if outcome.ok:
+            status, element = outcome.result
+            getattr(result, status).append(element)
+        else:
+            result.failed.append((outcome.item, outcome.exception))
+
+    logger.debug('Bulk create of %s: %s', cls.__name__, result)
+    return result
+
+
+class DeletePlan(object):
+    """
+    Order in which a set of elements can be deleted.
+
+    :ivar list waves: list of lists of elements. Elements in a wave are
+        only referenced by elements in earlier waves
+    :ivar list blocked: list of tuple (element, referrers) for elements
+        referenced by elements that are not being deleted. Referrers are
+        the elements outside of the set, or blocked elements, that
+        reference the element
+    :ivar list failed: list of tuple (element, exception) for elements
+        whose references could not be retrieved
+    """
+    def __init__(self):
+        self.waves = []
+        self.blocked = []
+        self.failed = []
+        self.referrers = {}  # href -> set of hrefs of referrers in the set
+
+    def __iter__(self):
+        return iter(self.waves)
+
+    def __len__(self):
+        return sum(len(wave) for wave in self.waves)
+
+    def __repr__(self):
+        return 'DeletePlan(elements=%s, blocked=%s, failed=%s, waves=%s)' % (
+            len(self), len(self.blocked), len(self.failed), len(self.waves))
+
+
+class BulkDeleteResult(object):
+    """
+    Result of a bulk delete operation.
+
+    :ivar list deleted: elements deleted
+    :ivar list blocked: list of tuple (element, referrers) for elements not
+        deleted because they are referenced by elements not being deleted
+    :ivar list failed: list of tuple (element, exception) for elements
+        that could not be deleted
+    :ivar int waves: number of waves of concurrent deletes
+    """
+    def __init__(self):
+        self.deleted = []
+        self.blocked = []
+        self.failed = []
+        self.waves = 0
+
+    @property
+    def ok(self):
+        """
+        Whether all elements were deleted
+
+        :rtype: bool
+        """
+        return not self.blocked and not self.failed
+
+    def __repr__(self):
+        return 'BulkDeleteResult(deleted=%s, blocked=%s, failed=%s, ' \
+            'waves=%s)' % (len(self.deleted), len(self.blocked),
+                           len(self.failed), self.waves)
+
+
+def delete_plan(elements, max_workers=DEFAULT_WORKERS):
+    """
+    Plan the deletion of elements. The references of each element are
+    retrieved concurrently and the elements are ordered into waves so
+    that each element is deleted after every element that references it.
+    Elements that reference each other in a cycle are placed in the last
+    wave.
+
+    :param list elements: elements to delete
+    :param int max_workers: maximum number of concurrent requests
+    :rtype: DeletePlan
+    """
+    plan = DeletePlan()
+    elements = {element.href: element for element in elements}
+    references = {}
+    for work in concurrent_map(lambda e: e.referenced_by, elements.values(),
+                               max_workers):
+        if work.ok:
+            references[work.item.href] = work.result
+        else:
+            plan.failed.append((work.item, work.exception))
+
+    # Elements referenced from outside of the set are blocked, as are
+    # elements referenced by a blocked element
+    blocked = {}
+    for href, referrers in references.items():
+        outside = [ref for ref in referrers if ref.href not in references]
+        if outside:
+            blocked[href] = outside
+        plan.referrers[href] = set(ref.href for ref in referrers
+                                   if ref.href in references)
+    referenced = {}  # href -> hrefs in the set it references
+    for href, referrers in plan.referrers.items():
+        for referrer in referrers:
+            referenced.setdefault(referrer, []).append(href)
+    stack = list(blocked)
+    while stack:
+        href = stack.pop()
+        for other in referenced.get(href, ()):
+            if other not in blocked:
+                blocked[other] = [elements[href]]
+                stack.append(other)
+    plan.blocked = [(elements[href], referrers)
+                    for href, referrers in blocked.items()]
+
+    remaining = {href: set(referrers) for href, referrers in
+                 plan.referrers.items() if href not in blocked}
+    while remaining:
+        wave = [href for href, referrers in remaining.items() if not referrers]
+        if not wave:
+            # Reference cycle, attempt the remaining elements together
+            wave = list(remaining)
+        for href in wave:
+            del remaining[href]
+        for referrers in remaining.values():
+            referrers.difference_update(wave)
+        plan.waves.append([elements[href] for href in wave])
+    logger.debug('Delete plan: %s', plan)
+    return plan
+
+
+def bulk_delete(elements, max_workers=DEFAULT_WORKERS, empty_trash=False):
+    """
+    Delete elements concurrently in the order given by :func:`delete_plan`.
+    Each wave is deleted concurrently once the previous wave is complete.
+    Elements referenced by an element that failed to be deleted are not
+    attempted and are reported as failed. An ETag conflict when deleting
+    is retried with the current ETag by the request layer.
+
+    :param list elements: elements to delete
+    :param int max_workers: maximum number of concurrent requests
+    :param bool empty_trash: empty the system trash bin once all waves
+        complete (default: False)
+    :raises ActionCommandFailed: failed to empty the trash bin
+    :rtype: BulkDeleteResult
+    """
+    plan = delete_plan(elements, max_workers)
+    result = BulkDeleteResult()
+    result.blocked = plan.blocked
+    result.failed = list(plan.failed)
+    failed = set(element.href for element, _ in plan.failed)
+
+    for wave in plan:
+        pending = []
+        for element in wave:
+            unresolved = plan.referrers[element.href] & failed
+            if unresolved:
+                failed.add(element.href)
+                result.failed.append((element, DeleteElementFailed(
+                    'Element is referenced by elements that could not be '
+                    'deleted: %s' % ', '.join(sorted(unresolved)))))
+            else:
+                pending.append(element)
+        if not pending:
+            continue
+        result.waves += 1
+        for work in concurrent_map(lambda e: e.delete(), pending, max_workers):
+            if work.ok:
+                result.deleted.append(work.item)
+            else:
+                failed.add(work.item.href)
+                result.failed.append((work.item, work.exception))
+
+    if empty_trash and result.deleted:
+        from smc.administration.system import System
+        System().empty_trash_bin()
+    logger.debug('Bulk delete: %s', result)
+    return result
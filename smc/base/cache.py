@@ -0,0 +1,592 @@
+"""
+Persistent element store used to warm start long running or periodic jobs.
+
+Element data is normally fetched from the SMC the first time an element's
+``data`` attribute is accessed and is only kept for the life of the instance.
+Jobs that run repeatedly against the same elements will therefore download
+the same json on every run. An :class:`ElementStore` persists the meta, data
+and ETag of every element loaded while the store is active into a JSON lines
+file on disk. On the next run, element data is read lazily from the store
+(the data file is memory mapped and indexed by href) and is revalidated by
+ETag on first access. Only elements that have changed since the last run are
+downloaded again.
+
+Activate a store by using it as a context manager. Any element loaded while
+the store is active will be served from, or saved into, the store::
+
+    from smc.base.cache import ElementStore
+
+    with ElementStore('/var/tmp/smc-store'):
+        for host in Host.objects.all():
+            print(host.address)    # <-- served from store after ETag check
+
+Elements previously saved in the store can also be iterated without making
+a search query to the SMC::
+
+    with ElementStore('/var/tmp/smc-store') as store:
+        for element in store.elements(typeof='host'):
+            ...
+
+If the data can be considered current (for example, it was saved moments
+ago by another job), set ``revalidate=False`` to skip the ETag check and serve
+entries directly from disk.
+
+.. note:: Revalidation issues a conditional GET with the stored ETag. If the
+    SMC does not honor the ``If-None-Match`` header, the element is returned
+    in full and the store is refreshed with the latest copy.
+"""
+import os
+import io
+import copy
+import json
+import mmap
+import logging
+import threading
+import collections
+from smc.api.common import SMCRequest
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+from smc.base.util import find_type_from_self, replace_file
+
+logger = logging.getLogger(__name__)
+
+
+#: The currently active store, set when a store is opened
+_active = None
+
+
+def active_store():
+    """
+    Return the currently active element store, or None if a store
+    has not been opened.
+
+    :rtype: ElementStore
+    """
+    return _active
+
+
+def conditional_fetch(href, etag):
+    """
+    Fetch an element only if it has changed since the specified ETag
+    was obtained. A conditional GET is sent using the ``If-None-Match``
+    header. If the SMC does not honor the header, the ETag of the
+    returned element is compared instead.
+
+    :param str href: href of element
+    :param str etag: etag of the element when last retrieved
+    :return: None if the element is unchanged, otherwise the result of
+        the fetch. The result ``json`` is empty if the element could
+        not be retrieved, i.e. it was deleted
+    :rtype: SMCResult
+    """
+    request = SMCRequest(
+        href=href,
+        headers={'Content-Type': 'application/json',
+                 'If-None-Match': etag})
+    result = request.read()
+    if result.code == 304 or (result.etag and result.etag == etag):
+        return None
+    return result
+
+
+class StoreRecord(object):
+    """
+    A single entry in the element store. Records are stored one per line
+    in the stores data file.
+
+    :ivar str href: href of the element
+    :ivar str name: name of the element
+    :ivar str type: element type, maps to the class `typeof` attribute
+    :ivar str etag: etag of the element when it was stored
+    :ivar dict data: the elements json
+    """
+    __slots__ = ('href', 'name', 'type', 'etag', 'data')
+
+    def __init__(self, href, data, etag=None, name=None, type=None):  # @ReservedAssignment
+        self.href = href
+        self.data = data
+        self.etag = etag
+        self.name = name if name is not None else data.get('name')
+        if type is None:
+            try:
+                type = find_type_from_self(data.get('link', []))  # @ReservedAssignment
+            except Exception:
+                pass
+        self.type = type
+
+    @classmethod
+    def from_line(cls, line):
+        return cls(**json.loads(line.decode('utf-8')))
+
+    def to_line(self):
+        return json.dumps(
+            {'href': self.href, 'name': self.name, 'type': self.type,
+             'etag': self.etag, 'data': self.data},
+            separators=(',', ':')).encode('utf-8') + b'\n'
+
+    @property
+    def meta(self):
+        return {'href': self.href, 'name': self.name, 'type': self.type}
+
+    def __repr__(self):
+        return 'StoreRecord(href=%s, etag=%s)' % (self.href, self.etag)
+
+
+class ElementStore(object):
+    """
+    On-disk store for element data. The store is a directory holding a
+    JSON lines data file and a json index that maps each href to the
+    offset and length of its record in the data file. The index is loaded
+    when the store is opened, records are only decoded when the element
+    is accessed.
+
+    :param str path: directory for the store. It will be created if it
+        does not exist
+    :param bool revalidate: revalidate entries by ETag on first access
+        (default: True)
+    :param bool autosave: save the store when the context manager exits
+        (default: True)
+    """
+    DATA_FILE = 'elements.jsonl'
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, path, revalidate=True, autosave=True):
+        self.path = os.path.abspath(path)
+        self.revalidate = revalidate
+        self.autosave = autosave
+        self._index = {}        # href -> (offset, length) in data file
+        self._pending = {}      # href -> StoreRecord, added or changed
+        self._removed = set()   # hrefs removed since open
+        self._validated = set() # hrefs revalidated in this run
+        self._handle = None
+        self._mmap = None
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.autosave:
+                self.save()
+        finally:
+            self.close()
+
+    @property
+    def data_file(self):
+        return os.path.join(self.path, self.DATA_FILE)
+
+    @property
+    def index_file(self):
+        return os.path.join(self.path, self.INDEX_FILE)
+
+    def open(self):
+        """
+        Open the store and make it the active store. Element data loaded
+        after opening will be served from and saved into this store.
+
+        :raises IOError: failure creating or reading the store
+        :rtype: ElementStore
+        """
+        global _active
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._load()
+        _active = self
+        return self
+
+    def close(self):
+        """
+        Close the store and release the memory map. Unsaved changes are
+        discarded; call :meth:`save` first to persist them.
+        """
+        global _active
+        with self._lock:
+            self._unmap()
+            self._index, self._pending = {}, {}
+            self._removed, self._validated = set(), set()
+        if _active is self:
+            _active = None
+
+    def _load(self):
+        with self._lock:
+            self._unmap()
+            self._index = {}
+            if os.path.exists(self.index_file) and os.path.exists(self.data_file):
+                with open(self.index_file, 'r') as f:
+                    index = json.load(f).get('index', {})
+                self._index = {href: tuple(location)
+                               for href, location in index.items()}
+                if os.path.getsize(self.data_file):
+                    self._handle = open(self.data_file, 'rb')
+                    self._mmap = mmap.mmap(
+                        self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+            logger.debug('Opened element store: %s, entries: %s',
+                self.path, len(self._index))
+
+    def _unmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _read(self, href):
+        offset, length = self._index[href]
+        return StoreRecord.from_line(self._mmap[offset:offset + length])
+
+    def __contains__(self, href):
+        return href not in self._removed and (
+            href in self._pending or href in self._index)
+
+    def __len__(self):
+        return len(set(self._index).union(self._pending) - self._removed)
+
+    def __iter__(self):
+        return iter(self.hrefs())
+
+    def hrefs(self):
+        """
+        All hrefs held in the store
+
+        :rtype: list(str)
+        """
+        with self._lock:
+            return sorted(set(self._index).union(self._pending) - self._removed)
+
+    def get(self, href):
+        """
+        Get the stored record for the specified href without revalidating
+        it against the SMC.
+
+        :param str href: href of element
+        :return: the stored record or None
+        :rtype: StoreRecord
+        """
+        with self._lock:
+            if href in self._removed:
+                return None
+            if href in self._pending:
+                return self._pending[href]
+            if href in self._index and self._mmap is not None:
+                return self._read(href)
+
+    def add(self, href, data, etag=None):
+        """
+        Add or replace the element data for the specified href. A copy
+        of the data is stored so later changes to the element do not
+        modify the stored record.
+
+        :param str href: href of element
+        :param dict data: element json
+        :param str etag: etag of the element json
+        :rtype: StoreRecord
+        """
+        record = StoreRecord(href, copy.deepcopy(data), etag=etag)
+        with self._lock:
+            self._removed.discard(href)
+            self._pending[href] = record
+            self._validated.add(href)
+        return record
+
+    def discard(self, href):
+        """
+        Remove an element from the store if it exists.
+
+        :param str href: href of element
+        """
+        with self._lock:
+            self._pending.pop(href, None)
+            self._validated.discard(href)
+            if href in self._index:
+                self._removed.add(href)
+
+    def fetch(self, href):
+        """
+        Fetch the element data from the store. If revalidation is enabled,
+        the first access to an entry issues a conditional GET using the
+        stored ETag. If the element changed, the latest copy is stored and
+        returned. If the element no longer exists it is removed from the
+        store and None is returned. The data returned is a copy of the
+        stored record.
+
+        :param str href: href of element
+        :return: tuple of (data, etag) or None if not in the store
+        :rtype: tuple
+        """
+        record = self.get(href)
+        if record is None:
+            self.misses += 1
+            return None
+
+        if self.revalidate and href not in self._validated:
+            record = self._revalidate(record)
+            if record is None:
+                self.misses += 1
+                return None
+
+        self.hits += 1
+        return copy.deepcopy(record.data), record.etag
+
+    def _revalidate(self, record):
+        result = conditional_fetch(record.href, record.etag)
+        if result is None:
+            with self._lock:
+                self._validated.add(record.href)
+            return record
+        if result.json:
+            logger.debug('Element changed since stored, refreshing: %s',
+                record.href)
+            return self.add(record.href, result.json, result.etag)
+        logger.debug('Removing stored element, fetch failed: %s, %s',
+            record.href, result.msg)
+        self.discard(record.href)
+
+    def elements(self, typeof=None):
+        """
+        Iterate the elements held in the store. Elements are returned with
+        only meta; element data is fetched from the store when accessed.
+
+        :param str typeof: optionally only return elements of this type
+        :rtype: Element
+        """
+        from smc.base.model import Element
+        for href in self.hrefs():
+            record = self.get(href)
+            if record and record.type and (typeof is None or
+                                           record.type == typeof):
+                yield Element.from_meta(**record.meta)
+
+    def save(self):
+        """
+        Persist the store to disk. Unchanged records are copied from the
+        existing data file, added and changed records are appended and
+        removed records are dropped. The data file and index are replaced
+        atomically where the platform allows it.
+
+        :raises IOError: failure writing the store
+        :return: None
+        """
+        with self._lock:
+            if not self._pending and not self._removed:
+                return
+            index = {}
+            data_tmp = self.data_file + '.tmp'
+            with io.open(data_tmp, 'wb') as out:
+                offset = 0
+                for href in sorted(self._index):
+                    if href in self._pending or href in self._removed:
+                        continue
+                    start, length = self._index[href]
+                    out.write(self._mmap[start:start + length])
+                    index[href] = (offset, length)
+                    offset += length
+                for href in sorted(self._pending):
+                    line = self._pending[href].to_line()
+                    out.write(line)
+                    index[href] = (offset, len(line))
+                    offset += len(line)
+
+            index_tmp = self.index_file + '.tmp'
+            with open(index_tmp, 'w') as out:
+                json.dump({'version': 1, 'index': index}, out)
+
+            self._unmap()
+            replace_file(data_tmp, self.data_file)
+            replace_file(index_tmp, self.index_file)
+            logger.debug('Saved element store: %s, entries: %s, changed: %s, '
+                'removed: %s', self.path, len(index), len(self._pending),
+                len(self._removed))
+
+            validated = self._validated
+            self._pending, self._removed = {}, set()
+            self._load()
+            self._validated = validated
+
+    def __repr__(self):
+        return 'ElementStore(path=%s, entries=%s)' % (self.path, len(self))
+
+
+#: Default maximum number of elements kept by the shared resolver
+DEFAULT_RESOLVER_SIZE = 10000
+
+#: Rule fields and the key of the element list within each field
+RULE_FIELDS = (('sources', 'src'), ('destinations', 'dst'),
+               ('services', 'service'))
+
+
+class ElementResolver(object):
+    """
+    Bounded cache of elements by href. Resolving the same href returns
+    the same element instance, so element data is only retrieved once
+    regardless of how many rules or groups reference the element. The
+    least recently used elements are discarded when the cache is full, and
+    an element is discarded when it is updated or deleted.
+
+    Rule fields resolve elements through the shared resolver returned by
+    :func:`shared_resolver`. Resolve every element referenced by a policy
+    up front to load the data of each unique element concurrently::
+
+        >>> from smc.base.cache import shared_resolver
+        >>> rules = list(policy.fw_ipv4_access_rules.prefetch())
+        >>> shared_resolver().resolve_rules(rules)
+        >>> for rule in rules:
+        ...   for source in rule.sources.all():    # <-- no requests
+        ...     print(source.name, source.data)
+
+    :param int maxsize: maximum number of elements kept
+    :param int max_workers: maximum number of concurrent requests used to
+        load element data
+    """
+    def __init__(self, maxsize=DEFAULT_RESOLVER_SIZE,
+                 max_workers=DEFAULT_WORKERS):
+        self.maxsize = maxsize
+        self.max_workers = max_workers
+        self._elements = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._elements)
+
+    def __contains__(self, href):
+        return href in self._elements
+
+    def __repr__(self):
+        return 'ElementResolver(elements=%s, maxsize=%s)' % (
+            len(self), self.maxsize)
+
+    def clear(self):
+        """
+        Discard all cached elements
+        """
+        with self._lock:
+            self._elements.clear()
+
+    def discard(self, href):
+        """
+        Discard a single element, i.e. after it was modified
+
+        :param str href: href of element
+        """
+        with self._lock:
+            self._elements.pop(href, None)
+
+    def _get(self, href):
+        with self._lock:
+            element = self._elements.pop(href, None)
+            if element is not None:
+                self._elements[href] = element  # most recently used
+                self.hits += 1
+            return element
+
+    def _put(self, href, element):
+        with self._lock:
+            element = self._elements.setdefault(href, element)
+            self.misses += 1
+            while len(self._elements) > self.maxsize:
+                self._elements.popitem(last=False)
+            return element
+
+    def resolve(self, href):
+        """
+        Return the element for the href.
+
+        :param str href: href of element
+        :rtype: Element
+        """
+        from smc.base.model import Element
+        element = self._get(href)
+        if element is None:
+            element = self._put(href, Element.from_href(href))
+        return element
+
+    def resolve_many(self, hrefs, load=False, shared=True):
+        """
+        Return the elements for a list of hrefs, resolving each unique
+        href once. With load, the data of elements not yet loaded is
+        retrieved using concurrent requests.
+
+        Elements are shared with every other caller of the resolver. Set
+        shared to False to return a separate instance of each element
+        with a copy of its data, so the caller can modify the elements
+        without affecting the cache. The data is loaded once into the
+        cached element before it is copied, so shared is False implies
+        load.
+
+        :param list hrefs: hrefs of elements
+        :param bool load: load element data (default: False)
+        :param bool shared: return the cached instances (default: True)
+        :rtype: list(Element)
+        """
+        from smc.base.model import LoadElement
+        unique = {}
+        for href in hrefs:
+            if href not in unique:
+                unique[href] = self.resolve(href)
+        if load or not shared:
+            unloaded = [element for element in unique.values()
+                        if element is not None and 'data' not in vars(element)]
+            for work in concurrent_map(lambda e: LoadElement(e.href),
+                                       unloaded, self.max_workers):
+                if work.ok:
+                    work.item.data = work.result
+                else:
+                    logger.debug('Failed loading element: %s, %s',
+                        work.item.href, work.exception)
+        if not shared:
+            unique = {href: _copy(element) for href, element in unique.items()}
+        return [unique[href] for href in hrefs]
+
+    def resolve_rules(self, rules, load=True):
+        """
+        Resolve the elements referenced by the sources, destinations and
+        services of each rule. Each unique element is resolved once and,
+        with load, its data is loaded concurrently. Rules that have not
+        been loaded are loaded first; use a prefetching collection to load
+        them concurrently.
+
+        :param list rules: rules, i.e. ``policy.fw_ipv4_access_rules``
+        :param bool load: load element data (default: True)
+        :return: number of unique elements referenced by the rules
+        :rtype: int
+        """
+        hrefs = set()
+        for rule in rules:
+            for field, key in RULE_FIELDS:
+                value = rule.data.get(field) or {}
+                hrefs.update(value.get(key, ()))
+        self.resolve_many(list(hrefs), load=load)
+        return len(hrefs)
+
+
+_resolver = ElementResolver()
+
+
+def _copy(element):
+    """
+    Return a separate instance of the element with a copy of its
+    loaded data. If the data could not be loaded, the copy loads it
+    when accessed.
+    """
+    if element is None:
+        return None
+    from smc.base.model import ElementCache
+    clone = element.__class__.__new__(element.__class__)
+    clone.__dict__.update(vars(element))
+    if 'data' in vars(element):
+        clone.data = ElementCache(copy.deepcopy(element.data.data),
+                                  etag=element.data._etag)
+    return clone
+
+
+def shared_resolver():
+    """
+    Return the resolver shared by rule fields.
+
+    :rtype: ElementResolver
+    """
+    return _resolver
@@ -18,13 +18,32 @@ See :ref:`collection-reference-label` for examples on search capabilities.
 """
 import re
 import copy
+import threading
 from itertools import islice
 import smc.base.model
+from smc.compat import string_types
 from smc.api.entry_point import Resource
+from smc.base.pool import BackgroundCall, concurrent_map, DEFAULT_WORKERS
 from smc.base.decorators import cached_property, classproperty
 from smc.api.exceptions import FetchElementFailed, InvalidSearchFilter
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
     
 
+#: Default number of sub elements loaded per batch when using prefetch
+DEFAULT_PREFETCH_SIZE = 100
+
+#: Maximum number of results buffered by concurrent_search
+SEARCH_BUFFER_SIZE = 1000
+
+
+def _load_data(element):
+    return smc.base.model.LoadElement(element.href)
+
+
 class SubElementCollection(object):
     """
     Collection class providing an iterable interface to sub elements
@@ -68,11 +87,64 @@ class SubElementCollection(object):
         self.href = href
         self.cls = cls
         self._result_cache = None
+        self._prefetch = None
         
     def __iter__(self):
         self._fetch_all()
+        if self._prefetch:
+            return self._prefetched(*self._prefetch)
         return iter(self._result_cache)
 
+    def _prefetched(self, batch_size, max_workers):
+        """
+        Iterate the result cache, loading the data of each batch of
+        elements concurrently. The next batch is loaded in the background
+        while the current batch is being iterated.
+        """
+        batches = [self._result_cache[i:i + batch_size]
+                   for i in range(0, len(self._result_cache), batch_size)]
+
+        def load(batch):
+            unloaded = [element for element in batch
+                        if 'data' not in vars(element)]
+            for work in concurrent_map(_load_data, unloaded, max_workers):
+                if work.ok: # Failures are loaded again on first access
+                    work.item.data = work.result
+            return batch
+
+        pending = BackgroundCall(load, batches[0]) if batches else None
+        for position in range(len(batches)):
+            batch = pending.result()
+            if position + 1 < len(batches):
+                pending = BackgroundCall(load, batches[position + 1])
+            for element in batch:
+                yield element
+
+    def prefetch(self, batch_size=DEFAULT_PREFETCH_SIZE,
+                 max_workers=DEFAULT_WORKERS):
+        """
+        .. versionadded:: 0.6.2
+
+        Load the data of the elements in the collection concurrently
+        while iterating. Without prefetch, each element only contains
+        its meta and the first access to an attribute such as
+        ``rule.sources`` or ``rule.action`` requests the element. With
+        prefetch, elements are loaded in batches using concurrent
+        requests, and the next batch is loaded while the current batch
+        is being iterated::
+
+            >>> for rule in policy.fw_ipv4_access_rules.prefetch():
+            ...   print(rule.name, rule.action.action, rule.sources.all())
+
+        :param int batch_size: number of elements loaded per batch
+        :param int max_workers: maximum number of concurrent requests
+        :return: collection that loads element data while iterating
+        :rtype: SubElementCollection
+        """
+        collection = copy.copy(self)
+        collection._prefetch = (max(1, batch_size), max_workers)
+        return collection
+
     def _fetch_all(self):
         if self._result_cache is None:
             results = smc.base.model.prepared_request(
@@ -279,6 +351,13 @@ def rule_collection(href, cls):
     
         print(help(policy.fw_ipv4_access_rules))
 
+    Iterating a rule collection returns rules containing only their meta.
+    Use :meth:`~SubElementCollection.prefetch` to load the rules
+    concurrently when rule attributes will be accessed::
+
+        for rule in policy.fw_ipv4_access_rules.prefetch():
+            print(rule.name, rule.sources.all(), rule.action.action)
+
     :rtype: SubElementCollection
     """
     instance = cls(href=href)
@@ -289,6 +368,10 @@ def rule_collection(href, cls):
             'create_rule_section': instance.create_rule_section})(href, cls)
 
                 
+#: Default number of results requested per page when using paged results
+DEFAULT_PAGE_SIZE = 1000
+
+
 def _strip_metachars(val):
     """
     When a filter uses a / or - in the search, only the elements
@@ -307,6 +390,111 @@ def _strip_metachars(val):
     return val
 
 
+#: Element attributes available from the search result meta
+META_FIELDS = ('name', 'href', 'type')
+
+
+def _pushdown(kw, exact_match=None):
+    """
+    Select the keyword filter value to send to the SMC as the search
+    filter. A name filter is sent as an exact match unless exact_match
+    is provided. Otherwise the
+    longest string value is preferred, and values containing a / or -
+    are only used if no other value is available since the SMC only
+    matches those against the name and comment fields.
+    
+    :return: tuple of (filter, exact_match)
+    """
+    name = kw.get('name')
+    if isinstance(name, string_types) and name:
+        return name, exact_match is None or exact_match
+    exact_match = bool(exact_match)
+    values = [v for v in kw.values() if isinstance(v, string_types) and v]
+    if values:
+        return sorted(values, key=lambda v: (
+            bool(re.search(r'[/-]', v)), -len(v)))[0], exact_match
+    return next(iter(kw.values())), exact_match
+
+
+class QueryStats(object):
+    """
+    Counters for a collection using keyword filters.
+    
+    :ivar int candidates: results returned by the SMC search
+    :ivar int meta_rejected: results rejected using only the result meta
+    :ivar int loaded: results that required loading the element data
+    :ivar int matched: results matching all filters
+    """
+    def __init__(self):
+        self.candidates = 0
+        self.meta_rejected = 0
+        self.loaded = 0
+        self.matched = 0
+    
+    @property
+    def loads_avoided(self):
+        """
+        Number of results that were evaluated without loading the
+        element data
+        
+        :rtype: int
+        """
+        return self.candidates - self.loaded
+    
+    def __repr__(self):
+        return 'QueryStats(candidates=%s, loaded=%s, matched=%s, ' \
+            'loads_avoided=%s)' % (self.candidates, self.loaded,
+                                   self.matched, self.loads_avoided)
+
+
+class QueryPlan(object):
+    """
+    Plan for evaluating keyword filters on search results. Filters on
+    attributes available in the search result meta (name, href and type)
+    are evaluated first, the element data is only loaded for results
+    that pass those filters and when filters on other attributes exist.
+    
+    :ivar str filter: value sent to the SMC as the search filter
+    :ivar bool exact_match: whether the search filter is an exact match
+    :ivar list meta_predicates: (attribute, value) evaluated on meta
+    :ivar list data_predicates: (attribute, value) evaluated on data
+    """
+    def __init__(self, iexact, filter=None, exact_match=False):  # @ReservedAssignment
+        self.filter = filter
+        self.exact_match = exact_match
+        self.meta_predicates = [(k, v) for k, v in iexact.items()
+                                if k in META_FIELDS]
+        self.data_predicates = [(k, v) for k, v in iexact.items()
+                                if k not in META_FIELDS]
+    
+    def match(self, element, stats):
+        """
+        Evaluate the filters against the element in order of cost.
+        
+        :param Element element: search result
+        :param QueryStats stats: counters to update
+        :rtype: bool
+        """
+        stats.candidates += 1
+        meta = element._meta
+        for key, value in self.meta_predicates:
+            if getattr(meta, key, None) != value:
+                stats.meta_rejected += 1
+                return False
+        if self.data_predicates:
+            stats.loaded += 1
+            data = element.data
+            if not all(data.get(k) == v for k, v in self.data_predicates):
+                return False
+        stats.matched += 1
+        return True
+    
+    def __repr__(self):
+        return 'QueryPlan(filter=%r, exact_match=%s, meta=%s, data=%s)' % (
+            self.filter, self.exact_match, self.meta_predicates,
+            self.data_predicates)
+
+
 class ElementCollection(object):
     """
     ElementCollection is generated dynamically from the CollectionManager
@@ -367,6 +555,13 @@ class ElementCollection(object):
         >>> list(query2)
         [Router(name=Router-10.10.10.1)]
 
+    Large result sets can be retrieved in pages. Each page is requested
+    from the SMC as it is needed, and the next page is fetched in the
+    background while the current page is consumed::
+    
+        >>> for host in Host.objects.all().paged(page_size=500):
+        ...   ...
+    
     .. note:: ``exists`` does not perform filtering when using ``filter_key``.
         Results on filter(kwargs) are only done by retrieving the list of
         results or iterating.
@@ -374,15 +569,25 @@ class ElementCollection(object):
     def __init__(self, **params):
         self._params = params
         self._iexact = params.pop('iexact', None)
+        self._page_size = params.pop('page_size', None)
+        self._prefetch = params.pop('prefetch', True)
+        self.stats = QueryStats()
 
     def __iter__(self):
         limit = self._params.pop('limit', None)
         count = 0
         
-        for item in self._list:
+        if self._page_size and '_list' not in self.__dict__:
+            items = self._paged(limit)
+        else:
+            items = self._list
+        
+        plan = self.plan()
+        self.stats = QueryStats()
+        for item in items:
             element = smc.base.model.Element.from_meta(**item)
             if self._iexact:
-                if all(element.data.get(k) == v for k, v in self._iexact.items()):
+                if plan.match(element, self.stats):
                     yield element
                     count += 1
             else:
@@ -405,11 +610,69 @@ class ElementCollection(object):
             _list = list()
         return _list  
     
+    def _fetch_page(self, offset, size):
+        params = {k:self._params[k] for k in self._params if 'href' not in k}
+        params.update(offset=offset, limit=size)
+        return smc.base.model.prepared_request(
+            FetchElementFailed,
+            href=self._params.get('href'),
+            params=params,
+            ).read().json or []
+    
+    def _paged(self, limit=None):
+        """
+        Generator returning the raw results one page at a time using the
+        limit and offset query parameters. If kwarg filters are not used,
+        the page size is reduced to not request more than `limit` results.
+        If the SMC does not honor the offset parameter, the full result
+        set is fetched and the results already returned are skipped.
+        
+        :raises FetchElementFailed: failed to retrieve a page
+        """
+        page_size = self._page_size
+        if limit and not self._iexact:
+            page_size = min(page_size, limit)
+        
+        offset, first = 0, None
+        page = self._fetch_page(offset, page_size)
+        while page:
+            if len(page) > page_size: # Paging not supported
+                for item in page[offset:]:
+                    yield item
+                return
+            if first is None:
+                first = page[0].get('href')
+            elif offset and page[0].get('href') == first: # Offset ignored
+                for item in self._list[offset:]:
+                    yield item
+                return
+            
+            last_page = len(page) < page_size or (
+                limit and not self._iexact and offset + page_size >= limit)
+            if not last_page and self._prefetch:
+                next_page = BackgroundCall(
+                    self._fetch_page, offset + page_size, page_size)
+            
+            for item in page:
+                yield item
+            
+            if last_page:
+                return
+            offset += page_size
+            page = next_page.result() if self._prefetch else \
+                self._fetch_page(offset, page_size)
+    
     def __bool__(self):
+        if self._page_size and '_list' not in self.__dict__:
+            return bool(self._fetch_page(0, 1))
         return bool(self._list)
     __nonzero__ = __bool__
     
     def __len__(self):
+        if self._page_size and '_list' not in self.__dict__:
+            # Prevent list() from retrieving the full result set as a
+            # length hint before paging
+            raise TypeError('Paged collection has no len(), use count()')
         return len(self._list)
     
     def __repr__(self):
@@ -417,6 +680,29 @@ class ElementCollection(object):
         return '{}(GET /elements?{})'.format(self.__class__.__name__, '&'.join(query) if \
             query else '')
     
+    def plan(self):
+        """
+        Return the plan used to evaluate keyword filters. The plan shows
+        the search filter sent to the SMC and the filters evaluated on
+        the search results.
+        ::
+        
+            >>> Host.objects.filter(name='kali', address='1.1.1.1').plan()
+            QueryPlan(filter='kali', exact_match=True, meta=[('name', 'kali')], data=[('address', '1.1.1.1')])
+        
+        After iterating, the ``stats`` attribute of the collection shows
+        how many results were evaluated without loading element data::
+        
+            >>> query = Host.objects.filter(name='kali', address='1.1.1.1')
+            >>> list(query)
+            >>> query.stats
+            QueryStats(candidates=1, loaded=1, matched=1, loads_avoided=0)
+        
+        :rtype: QueryPlan
+        """
+        return QueryPlan(self._iexact or {}, self._params.get('filter'),
+            self._params.get('exact_match', False))
+    
     def _clone(self, **kwargs):
         """
         Create a clone of this collection. The only param in the
@@ -429,6 +715,8 @@ class ElementCollection(object):
         params = copy.deepcopy(self._params)
         if self._iexact:
             params.update(iexact=self._iexact)
+        if self._page_size:
+            params.update(page_size=self._page_size, prefetch=self._prefetch)
         params.update(**kwargs)
         clone = self.__class__(**params)
         return clone
@@ -443,6 +731,31 @@ class ElementCollection(object):
         """
         return self._clone(limit=count)
 
+    def paged(self, page_size=DEFAULT_PAGE_SIZE, prefetch=True):
+        """
+        Retrieve results from the SMC in pages of the specified size
+        instead of a single request. Pages are requested lazily as the
+        collection is iterated, so the first results are available
+        without waiting for the full result set. Use for queries that
+        may return a large number of results.
+        ::
+        
+            >>> for host in Host.objects.filter('10.').paged(page_size=200):
+            ...   ...
+        
+        .. note:: ``len`` is not supported on a paged collection. ``count``
+            retrieves every page to count the results and ``exists``
+            retrieves a single result. A page that cannot be retrieved
+            raises :class:`~smc.api.exceptions.FetchElementFailed` while
+            iterating.
+        
+        :param int page_size: number of results to request per page
+        :param bool prefetch: fetch the next page in the background while
+            the current page is being consumed (default: True)
+        :return: :class:`.ElementCollection`
+        """
+        return self._clone(page_size=page_size, prefetch=prefetch)
+
     def all(self):
         """
         Retrieve all elements based on element type. When using the ``all``
@@ -478,20 +791,23 @@ class ElementCollection(object):
         :param bool case_sensitive: Can be passed as a keyword arg. Specifies
             whether the match is case sensitive or not. (default: True) 
         :param kw: keyword args can specify an attribute=value to use as an
-            exact match against the elements attribute.
+            exact match against the elements attribute. One value is sent
+            to the SMC as the search filter (a `name` value is sent as an
+            exact match unless `exact_match` is provided). Filters on name, href or type are evaluated
+            without loading the element data. See :meth:`~plan`.
         :return: :class:`.ElementCollection`
         """
         iexact = None
         if filter:
             _filter = filter[0]
             
-        exact_match = kw.pop('exact_match', False)
+        exact_match = kw.pop('exact_match', None)
         case_sensitive = kw.pop('case_sensitive', True)
         
         if kw:
-            _, value = next(iter(kw.items()))
-            _filter = value
+            _filter, exact_match = _pushdown(kw, exact_match)
             iexact = kw
+        exact_match = bool(exact_match)
         
         # Only strip metachars from network and address range
         if not exact_match and self._params.get('filter_context', {})\
@@ -508,13 +824,16 @@ class ElementCollection(object):
         """
         Iterator returning results in batches. When making more general queries
         that might have larger results, specify a batch result that should be
-        returned with each iteration.
+        returned with each iteration. Results are requested from the SMC in
+        pages of the batch size unless a page size was set using
+        :meth:`~paged`.
         
         :param int num: number of results per iteration
         :return: iterator holding list of results
         """
         self._params.pop('limit', None) # Limit and batch are mutually exclusive
-        it = iter(self)
+        collection = self if self._page_size else self._clone(page_size=num)
+        it = iter(collection)
         while True:
             chunk = list(islice(it, num))
             if not chunk:
@@ -543,7 +862,7 @@ class ElementCollection(object):
         
         :return: element or None
         """
-        if len(self):
+        if self:
             self._params.update(limit=1)
             if 'filter' not in self._params:
                 return list(self)[0]
@@ -566,7 +885,7 @@ class ElementCollection(object):
         
         :return: element or None
         """
-        if len(self):
+        if self:
             self._params.update(limit=1)
             if 'filter' not in self._params:
                 return list(self)[-1]
@@ -594,10 +913,13 @@ class ElementCollection(object):
             
     def count(self):
         """
-        Return number of results
+        Return number of results. A paged collection retrieves every page
+        to count the results.
         
         :rtype: int
         """
+        if self._page_size and '_list' not in self.__dict__:
+            return sum(1 for _ in self._paged())
         return len(self)
 
 
@@ -657,6 +979,10 @@ class CollectionManager(object):
         return self.iterator().batch(num)
     batch.__doc__ = ElementCollection.batch.__doc__
     
+    def paged(self, page_size=DEFAULT_PAGE_SIZE, prefetch=True):
+        return self.iterator(page_size=page_size, prefetch=prefetch)
+    paged.__doc__ = ElementCollection.paged.__doc__
+    
     def limit(self, count):
         return self.iterator(limit=count)
     limit.__doc__ = ElementCollection.limit.__doc__
@@ -670,13 +996,13 @@ class CollectionManager(object):
         if filter:
             _filter = filter[0]
         
-        exact_match = kw.pop('exact_match', False)
+        exact_match = kw.pop('exact_match', None)
         case_sensitive = kw.pop('case_sensitive', True)
         
         if kw:
-            _, value = next(iter(kw.items()))
-            _filter = value
+            _filter, exact_match = _pushdown(kw, exact_match)
             iexact = kw
+        exact_match = bool(exact_match)
         
         # Only strip metachars from network and address range
         if not exact_match and hasattr(self, '_cls') and \
@@ -692,6 +1018,76 @@ class CollectionManager(object):
     filter.__doc__ = ElementCollection.filter.__doc__
 
 
+def concurrent_search(collections, max_workers=DEFAULT_WORKERS):
+    """
+    Run multiple element collections concurrently and merge the results.
+    Elements are returned as they arrive from any of the collections, and
+    elements returned by more than one collection are only returned once
+    (compared by href). Use this to search several element types for the
+    same value::
+    
+        >>> from smc.base.collection import concurrent_search
+        >>> for element in concurrent_search([
+        ...     Host.objects.filter('10.0.0'),
+        ...     Network.objects.filter('10.0.0'),
+        ...     AddressRange.objects.filter('10.0.0')]):
+        ...   print(element)
+    
+    If a collection is paged, elements are returned as each page arrives.
+    At most :data:`SEARCH_BUFFER_SIZE` elements are buffered before they
+    are consumed. If iteration stops early, the collections stop retrieving
+    results.
+    
+    :param list collections: ElementCollection instances to iterate
+    :param int max_workers: maximum number of collections to run at
+        the same time
+    :raises: exception raised while iterating any collection
+    :rtype: Element
+    """
+    results = queue.Queue(maxsize=SEARCH_BUFFER_SIZE)
+    stopped = threading.Event()
+    done = object()
+    
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                results.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def drain(collection):
+        for element in collection:
+            if not put((element, None)):
+                return
+    
+    def run():
+        try:
+            for work in concurrent_map(drain, collections, max_workers):
+                if not work.ok:
+                    put((None, work.exception))
+                if stopped.is_set():
+                    break
+        finally:
+            put((done, None))
+    
+    BackgroundCall(run)
+    seen = set()
+    try:
+        while True:
+            element, error = results.get()
+            if error is not None:
+                raise error
+            if element is done:
+                return
+            if element.href not in seen:
+                seen.add(element.href)
+                yield element
+    finally:
+        stopped.set()
+
+
 CONTEXTS = frozenset(['fw_clusters', 'engine_clusters', 'ips_clusters',
                       'layer2_clusters', 'network_elements', 'services',
                       'services_and_applications', 'tags', 'situations'])
@@ -721,6 +1117,14 @@ class Search(ElementCollection):
         ...
         Search.objects.entry_point('router,host').filter('2.2.2.2') # with filter
         
+    When searching multiple element types, use ``parallel`` to run a query
+    for each type concurrently. Results are merged and returned as they
+    arrive::
+    
+        for element in Search.objects.entry_point('host,network,address_range')\
+                .filter('10.0.0.0').parallel():
+            ...
+    
     Search also provides convenience shortcuts to find duplicate and unused elements::
     
         Search.objects.unused()
@@ -778,6 +1182,41 @@ class Search(ElementCollection):
             'Context filter %r was invalid. Available filters: %s' %
             (context, CONTEXTS))
 
+    def parallel(self, max_workers=DEFAULT_WORKERS):
+        """
+        Run the search as a separate query for each element type provided
+        to :meth:`~entry_point` and merge the results. Queries are sent
+        concurrently, so the search completes in the time of the slowest
+        element type instead of the total for all types. Elements are
+        returned as they arrive and duplicates are removed.
+        ::
+        
+            >>> search = Search.objects.entry_point('host,network').filter('10.0.0')
+            >>> list(search.parallel())
+            [Host(name=host-10.0.0.1), Network(name=net-10.0.0.0/24)]
+        
+        If a single element type or no element type was provided, the
+        search is run as a single query.
+        
+        :param int max_workers: maximum number of concurrent queries
+        :return: generator of elements
+        :rtype: Element
+        """
+        params = copy.deepcopy(self._params)
+        contexts = params.pop('filter_context', '')
+        if self._iexact:
+            params.update(iexact=self._iexact)
+        if self._page_size:
+            params.update(page_size=self._page_size, prefetch=self._prefetch)
+        
+        collections = []
+        for context in contexts.split(','):
+            context_params = copy.deepcopy(params)
+            if context.strip():
+                context_params.update(filter_context=context.strip())
+            collections.append(ElementCollection(**context_params))
+        return concurrent_search(collections, max_workers)
+
     def unused(self):
         """
         Return unused user-created elements.
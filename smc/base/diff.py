@@ -0,0 +1,190 @@
+"""
+Structural comparison of element json.
+
+The diff engine compares the current json of an element against a desired
+state and reports each change as a :class:`Change`. It is used by
+:meth:`~smc.base.model.Element.update_or_create` to decide whether an update
+is required, so running a desired-state script against elements that are
+already current does not send any modifications to the SMC.
+
+The desired state is treated as a partial document. Only keys provided in
+the desired state are compared, keys that exist only in the current json are
+left unchanged. Lists are compared as follows:
+
+* Lists of strings, ints or other hashable values are compared regardless of
+  order.
+* Lists of dicts are matched item by item using an identity key. The identity
+  key is the first key in ``identity_keys`` found in every item on both sides
+  with unique values, i.e. ``href`` or ``name``. Matched items are compared
+  recursively. If no identity key is found, an item is considered matched if
+  an existing item contains all of the desired items values.
+
+Example of comparing and patching element json::
+
+    >>> from smc.base.diff import diff, patch
+    >>> current = {'name': 'foo', 'address': '1.1.1.1', 'comment': None}
+    >>> diff(current, {'address': '2.2.2.2', 'comment': None})
+    [Change(path='address', kind='changed', old='1.1.1.1', new='2.2.2.2')]
+    >>> patch(current, {'address': '2.2.2.2'})
+    {'name': 'foo', 'address': '2.2.2.2', 'comment': None}
+"""
+import copy
+import collections
+from smc.compat import string_types
+
+
+#: Keys used to match dicts within lists, in order of preference
+IDENTITY_KEYS = ('href', 'key', 'name', 'nicid', 'interface_id')
+
+#: Change kinds
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+class Change(collections.namedtuple('Change', 'path kind old new')):
+    """
+    A single difference between the current and desired state.
+
+    :ivar str path: dotted path to the value, list items are referenced
+        by index in the current json, i.e. ``ospfv2_area.0.name``
+    :ivar str kind: one of 'added', 'removed' or 'changed'
+    :ivar old: current value, None if added
+    :ivar new: desired value, None if removed
+    """
+    __slots__ = ()
+
+
+def _join(path, key):
+    return '%s.%s' % (path, key) if path else '%s' % key
+
+
+def _hashable(value):
+    return isinstance(value, (string_types, int, float, bool, type(None)))
+
+
+def _identity(current, desired, identity_keys):
+    """
+    Find the identity key for matching lists of dicts. The key must
+    exist in all items on both sides and be unique on each side.
+    """
+    items = current + desired
+    if not items or not all(isinstance(item, dict) for item in items):
+        return None
+    for key in identity_keys:
+        if all(key in item and _hashable(item[key]) for item in items):
+            if len(set(item[key] for item in current)) == len(current) and \
+                len(set(item[key] for item in desired)) == len(desired):
+                return key
+
+
+def _match(current, desired, identity_keys):
+    """
+    Match desired list items to current list items. Return a list of
+    (desired_item, current_index) and a list of unmatched current
+    indexes. current_index is None if the desired item was not found.
+    """
+    key = _identity(current, desired, identity_keys)
+    if key is not None:
+        positions = {item[key]: index for index, item in enumerate(current)}
+        matched = [(item, positions.get(item[key])) for item in desired]
+    else:
+        available = list(range(len(current)))
+        matched = []
+        for item in desired:
+            found = None
+            for index in available:
+                if not diff(current[index], item, identity_keys=identity_keys):
+                    found = index
+                    break
+            if found is not None:
+                available.remove(found)
+            matched.append((item, found))
+    used = set(index for _, index in matched if index is not None)
+    return matched, [i for i in range(len(current)) if i not in used]
+
+
+def _diff_list(current, desired, path, identity_keys):
+    if all(_hashable(item) for item in current + desired):
+        current_set, desired_set = set(current), set(desired)
+        changes = [Change(path, REMOVED, item, None)
+                   for item in current if item not in desired_set]
+        changes.extend(Change(path, ADDED, None, item)
+                       for item in desired if item not in current_set)
+        return changes
+
+    if not all(isinstance(item, dict) for item in current + desired):
+        return [] if current == desired else \
+            [Change(path, CHANGED, current, desired)]
+
+    matched, unmatched = _match(current, desired, identity_keys)
+    changes = []
+    for item, index in matched:
+        if index is None:
+            changes.append(Change(path, ADDED, None, item))
+        else:
+            changes.extend(_diff(
+                current[index], item, _join(path, index), identity_keys))
+    changes.extend(Change(_join(path, index), REMOVED, current[index], None)
+                   for index in unmatched)
+    return changes
+
+
+def _diff(current, desired, path, identity_keys):
+    if isinstance(desired, dict) and isinstance(current, dict):
+        changes = []
+        for key, value in desired.items():
+            if key not in current:
+                changes.append(Change(_join(path, key), ADDED, None, value))
+            else:
+                changes.extend(_diff(
+                    current[key], value, _join(path, key), identity_keys))
+        return changes
+    if isinstance(desired, list) and isinstance(current, list):
+        return _diff_list(current, desired, path, identity_keys)
+    if current != desired:
+        return [Change(path, CHANGED, current, desired)]
+    return []
+
+
+def diff(current, desired, path='', identity_keys=IDENTITY_KEYS):
+    """
+    Compare the current value against the desired value and return the
+    changes required to reach the desired value. An empty list indicates
+    the values are equivalent.
+
+    :param current: current value, typically element json
+    :param desired: desired value; dicts are treated as partial documents
+    :param str path: prefix for change paths
+    :param tuple identity_keys: keys used to match dicts within lists
+    :rtype: list(Change)
+    """
+    return _diff(current, desired, path, identity_keys)
+
+
+def patch(current, desired, identity_keys=IDENTITY_KEYS):
+    """
+    Return a copy of the current value with the desired value applied.
+    Dicts are merged recursively so keys not provided in the desired
+    value are kept. Lists take the items of the desired list; dict items
+    that match an existing item are merged into a copy of that item so
+    attributes set by the SMC are retained.
+
+    :param current: current value, typically element json
+    :param desired: desired value
+    :param tuple identity_keys: keys used to match dicts within lists
+    :return: the patched value
+    """
+    if isinstance(desired, dict) and isinstance(current, dict):
+        result = copy.deepcopy(current)
+        for key, value in desired.items():
+            result[key] = patch(current[key], value, identity_keys) \
+                if key in current else copy.deepcopy(value)
+        return result
+    if isinstance(desired, list) and isinstance(current, list) and \
+        all(isinstance(item, dict) for item in current + desired):
+        matched, _ = _match(current, desired, identity_keys)
+        return [patch(current[index], item, identity_keys)
+                if index is not None else copy.deepcopy(item)
+                for item, index in matched]
+    return copy.deepcopy(desired)
@@ -52,7 +52,6 @@ container functionality may inherit from object.
 """
 import collections
 import smc.base.collection
-from smc.compat import string_types
 from smc.base.structs import NestedDict
 from smc.base.decorators import cached_property, classproperty, exception,\
     create_hook, with_metaclass
@@ -62,9 +61,14 @@ from smc.api.exceptions import ElementNotFound, \
     DeleteElementFailed, FetchElementFailed, UpdateElementFailed,\
     UserElementNotFound, UnsupportedEntryPoint
 from .util import bytes_to_unicode, unicode_to_bytes, merge_dicts,\
-    find_type_from_self
+    find_type_from_self, find_type_from_href
 from smc.base.mixins import RequestAction, UnicodeMixin
 from smc.base.util import b64encode, element_resolver
+from smc.base.cache import active_store, shared_resolver
+from smc.base.transaction import current_unit_of_work
+from smc.base import diff
+from smc.base.bulk import bulk_create
+from smc.base.pool import DEFAULT_WORKERS
 
 
 @exception
@@ -81,15 +85,26 @@ def prepared_request(*exception, **kwargs):  # @UnusedVariable
 def LoadElement(href, only_etag=False):
     """
     Return an instance of a element as a ElementCache dict
-    used as a cache.
+    used as a cache. If an :class:`smc.base.cache.ElementStore` is
+    active, the element data is served from the store when available
+    and saved into the store after being fetched.
     
     :rtype ElementCache
     """
+    store = active_store()
+    if store is not None and not only_etag:
+        stored = store.fetch(href)
+        if stored is not None:
+            data, etag = stored
+            return ElementCache(data, etag=etag)
+    
     request = SMCRequest(href=href)
     request.exception = FetchElementFailed
     result = request.read()
     if only_etag:
         return result.etag
+    if store is not None and result.json:
+        store.add(href, result.json, result.etag)
     return ElementCache(
         result.json, etag=result.etag)
     
@@ -151,8 +166,22 @@ def ElementFactory(href, raise_exc=None):
     :param Exception raise_exc: exception to raise if fetch
         failed
     """
+    store = active_store()
+    stored = store.fetch(href) if store is not None else None
+    if stored is not None:
+        data, etag = stored
+        istype = find_type_from_self(data.get('link'))
+        e = lookup_class(istype)(
+            name=data.get('name'),
+            href=href,
+            type=istype)
+        e.data = ElementCache(data, etag=etag)
+        return e
+    
     element = SMCRequest(href=href).read()
     if element.json:
+        if store is not None:
+            store.add(href, element.json, element.etag)
         istype = find_type_from_self(element.json.get('link'))
         typeof = lookup_class(istype)
         e = typeof(name=element.json.get('name'),
@@ -165,6 +194,24 @@ def ElementFactory(href, raise_exc=None):
         raise raise_exc(element.msg)
 
 
+def LazyElementFactory(href):
+    """
+    Factory returns an object of type Element without fetching the
+    element when the element type can be derived from the entry point
+    segment of the href. Element data, including the name, is loaded
+    when first accessed. None is returned if the type cannot be
+    determined reliably from the href.
+    
+    :param str href: string href of the element
+    :rtype: Element
+    """
+    typeof = find_type_from_href(href)
+    if typeof and typeof not in ElementMeta._ambiguous:
+        cls = ElementMeta._map.get(typeof)
+        if cls is not None and issubclass(cls, Element):
+            return cls(name=None, href=href, type=typeof)
+
+
 class ElementCache(NestedDict):
     def __init__(self, data=None, **kw):
         self._etag = kw.pop('etag', None)
@@ -263,13 +310,20 @@ class ElementLocator(object):
 class ElementMeta(type):
     """
     Element metaclass that registers classes with the typeof
-    attribute into a registry for later lookups.
+    attribute into a registry for later lookups. If more than one
+    class registers the same typeof, the type is considered ambiguous
+    and will not be resolved from an href alone.
     """
     _map = {}
+    _ambiguous = set()
     def __new__(meta, name, bases, clsdict):  # @NoSelf
         cls = super(ElementMeta, meta).__new__(meta, name, bases, clsdict)
         if 'typeof' in clsdict:
-            meta._map[clsdict['typeof']] = cls
+            typeof = clsdict['typeof']
+            existing = meta._map.get(typeof)
+            if existing is not None and existing.__name__ != name:
+                meta._ambiguous.add(typeof)
+            meta._map[typeof] = cls
         return cls
 
 
@@ -308,13 +362,24 @@ class ElementBase(RequestAction, UnicodeMixin):
             self._meta = Meta(**meta) if meta else None
     
     @classmethod
-    def from_href(cls, href):
+    def from_href(cls, href, lazy=True):
         """
-        Return an instance of an Element based on the href
-
+        Return an instance of an Element based on the href. When the
+        element type can be derived from the href, i.e.
+        ``http://1.1.1.1:8082/6.4/elements/host/707``, the instance is
+        returned without a query and the element is loaded when an
+        attribute is accessed. Otherwise the element is fetched to
+        determine its type.
+        
+        :param str href: href of the element
+        :param bool lazy: derive the element type from the href when
+            possible instead of fetching the element (default: True)
         :rtype: Element
         """
-        return ElementFactory(href) if href else None
+        if not href:
+            return None
+        element = LazyElementFactory(href) if lazy else None
+        return element if element is not None else ElementFactory(href)
 
     @classmethod
     def from_meta(cls, **meta):
@@ -351,6 +416,10 @@ class ElementBase(RequestAction, UnicodeMixin):
             del self.data
         except AttributeError:
             pass
+        store = active_store()
+        if store is not None:
+            store.discard(self.href)
+        shared_resolver().discard(self.href)
     
     def __getstate__(self):
         state = self.__dict__.copy()
@@ -383,6 +452,10 @@ class ElementBase(RequestAction, UnicodeMixin):
             headers={'if-match': self.etag})
         request.exception = DeleteElementFailed
         request.delete()
+        store = active_store()
+        if store is not None:
+            store.discard(self.href)
+        shared_resolver().discard(self.href)
 
     def update(self, *exception, **kwargs):
         """
@@ -399,6 +472,9 @@ class ElementBase(RequestAction, UnicodeMixin):
         For kwargs, if attribute values are a list, you can pass
         'append_lists=True' to add to an existing list, otherwise overwrite
         (default: overwrite)
+        
+        If called within a :class:`smc.base.transaction.UnitOfWork`, the
+        modification is queued and sent when the unit of work is flushed.
 
         .. seealso:: To see different ways to utilize this method for updating,
             see: :ref:`update-elements-label`.
@@ -418,6 +494,10 @@ class ElementBase(RequestAction, UnicodeMixin):
             exception = UpdateElementFailed
         else:
             exception = exception[0]
+        
+        uow = current_unit_of_work()
+        if uow is not None:
+            return uow.add(self, exception, **kwargs)
 
         params = {
             'href': self.href,
@@ -447,6 +527,11 @@ class ElementBase(RequestAction, UnicodeMixin):
         request.exception = exception
         result = request.update()
         
+        store = active_store()
+        if store is not None:   # Stored copy and ETag are no longer current
+            store.discard(params['href'])
+        shared_resolver().discard(params['href'])
+        
         if name: # Reset instance name
             self._meta = Meta(name=name, href=self.href, type=self._meta.type)
             self._name = name
@@ -570,13 +655,16 @@ class Element(ElementBase):
     @classmethod
     def update_or_create(cls, filter_key=None, with_status=False, **kwargs):
         """
-        Update or create the element. If the element exists, update it using the
-        kwargs provided if the provided kwargs after resolving differences from
-        existing values. When comparing values, strings and ints are compared
-        directly. If a list is provided and is a list of strings, it will be 
-        compared and updated if different. If the list contains unhashable elements,
-        it is skipped. To handle complex comparisons, override this method on
-        the subclass and process the comparison seperately.
+        Update or create the element. If the element exists, the kwargs
+        provided are compared against the existing element and the element
+        is only updated if there are differences. Values are compared
+        structurally using :func:`smc.base.diff.diff`; strings and ints are
+        compared directly, lists of strings are compared regardless of order,
+        dicts are compared only by the keys provided and lists of dicts are
+        matched by an identity key such as `href` or `name`. Use :meth:`diff`
+        to view the changes that would be made. To handle comparisons of
+        values that do not map directly to the element json, override this
+        method on the subclass and process the comparison seperately.
         If an element does not have a `create` classmethod, then it
         is considered read-only and the request will be redirected to
         :meth:`~get`. Provide a ``filter_key`` dict key/value if you want to
@@ -614,54 +702,118 @@ class Element(ElementBase):
         
         element, created = cls.get_or_create(filter_key=filter_key, with_status=True, **kwargs)
         if not created:
-            #params = {}
             for key, value in kwargs.items():
-                # Callable, Element or string
-                if callable(value):
-                    value = value()
-                elif isinstance(value, Element):
-                    value = value.href
-                # Get value from element being modified
-                val = getattr(element, key, None)
-                if isinstance(val, (string_types, int)):
-                    if val != value:
-                        element.data[key] = value
-                        updated = True
-                elif isinstance(val, Element):
-                    if val.href != value:
-                        element.data[key] = value
-                        updated = True
-                elif isinstance(val, list) and isinstance(value, list):
-                    try: # Try matching lists of strings
-                        if set(val) ^ set(value):
-                            element.data[key] = value
-                            updated = True
-                    except TypeError:
-                        # Unhashable, list of dicts. You should override
-                        # this method in the child class and resolve differences
-                        # based on the data structure since each will be unique
-                        pass
-                else:
-                    # Last ditch effort, might be comparing None to None
-                    if val != value:
-                        element.data[key] = value
-                        updated = True
+                current, value = element._diff_values(key, value)
+                if diff.diff(current, value, path=key):
+                    element.data[key] = diff.patch(current, value)
+                    updated = True
             
             if updated and not defer_update:
                 element.update()
-            #if params:
-            #    element.update(**params)
-            #    updated = True
         
         if with_status:
             return element, updated, created
         return element
 
+    @classmethod
+    def bulk_create(cls, elements, on_existing='skip',
+                    max_workers=DEFAULT_WORKERS):
+        """
+        Create many elements of this type concurrently. Each item in
+        elements is a dict of keyword arguments for the elements ``create``
+        classmethod. Existing elements are found by name before sending
+        create requests. A failure creating a single element does not stop
+        the remaining elements from being created.
+        ::
+
+            >>> result = Host.bulk_create([
+                    {'name': 'host1', 'address': '1.1.1.1'},
+                    {'name': 'host2', 'address': '2.2.2.2'}])
+            >>> result
+            BulkCreateResult(created=1, existing=1, updated=0, failed=0)
+
+        :param list elements: list of dict, keyword arguments for create
+        :param str on_existing: how to handle elements that already exist;
+            'skip' to leave the element unchanged, 'update' to update the
+            element using :meth:`~update_or_create`, or 'fail' to send the
+            create request regardless (default: 'skip')
+        :param int max_workers: maximum number of concurrent requests
+        :raises CreateElementFailed: element type is read-only
+        :rtype: smc.base.bulk.BulkCreateResult
+        """
+        return bulk_create(cls, elements, on_existing, max_workers)
+
+    @classmethod
+    def bulk_get_or_create(cls, elements, max_workers=DEFAULT_WORKERS):
+        """
+        Get or create many elements of this type concurrently. This is
+        the bulk equivalent of :meth:`~get_or_create`. All elements,
+        whether created or existing, are available by name from the
+        result ``elements`` attribute.
+        ::
+
+            >>> result = Network.bulk_get_or_create(networks)
+            >>> result.elements['mynetwork']
+            Network(name=mynetwork)
+
+        :param list elements: list of dict, keyword arguments for create
+        :param int max_workers: maximum number of concurrent requests
+        :raises CreateElementFailed: element type is read-only
+        :rtype: smc.base.bulk.BulkCreateResult
+        """
+        return bulk_create(cls, elements, 'skip', max_workers)
+
+    def _diff_values(self, key, value):
+        """
+        Return a tuple of the current and desired value for the given
+        attribute, resolving callables and elements to their json value.
+        """
+        if callable(value):
+            value = value()
+        if isinstance(value, Element):
+            value = value.href
+        elif isinstance(value, list):
+            value = [v.href if isinstance(v, Element) else v for v in value]
+        
+        if key in self.data:
+            current = self.data[key]
+        else:
+            current = getattr(self, key, None)
+            if isinstance(current, Element):
+                current = current.href
+        return current, value
+
+    def diff(self, **kwargs):
+        """
+        Compare the provided attributes against the existing element and
+        return the changes that would be made by
+        :meth:`~update_or_create`. No changes are made to the element.
+        ::
+
+            >>> host = Host('kali')
+            >>> host.diff(address='10.10.10.10', secondary=['1.1.1.1'])
+            [Change(path='address', kind='changed', old='12.12.12.12', new='10.10.10.10'),
+             Change(path='secondary', kind='added', old=None, new='1.1.1.1')]
+
+        :param kwargs: attributes to compare, same as used for
+            ``update_or_create``
+        :return: list of changes, empty if the element already matches
+        :rtype: list(smc.base.diff.Change)
+        """
+        changes = []
+        for key, value in kwargs.items():
+            current, value = self._diff_values(key, value)
+            changes.extend(diff.diff(current, value, path=key))
+        return changes
+
     @property
     def name(self):
         """
         Name of element
         """
+        if self._name is None and self._meta is not None and \
+            self._meta.href:
+            self._name = self.data.get('name')
         return bytes_to_unicode(self._name)
 
     @property
@@ -0,0 +1,206 @@
+"""
+Thread pool helpers used to run SMC requests concurrently.
+
+Most bulk operations are bound by HTTP latency rather than CPU, so running
+requests in a small pool of threads sharing the same session gives a near
+linear speed up until the SMC itself becomes the bottleneck. The number of
+workers should be kept reasonably small to avoid overloading the SMC.
+
+Results are returned as :class:`WorkResult` so a failure on a single item
+does not abort the remaining work::
+
+    from smc.base.pool import concurrent_map
+
+    for work in concurrent_map(lambda host: host.address, Host.objects.all()):
+        if work.ok:
+            print(work.item, work.result)
+        else:
+            print('Failed: %s, %s' % (work.item, work.exception))
+"""
+import logging
+import threading
+import collections
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+
+#: Default number of worker threads used by bulk operations
+DEFAULT_WORKERS = 8
+
+
+class WorkResult(collections.namedtuple('WorkResult', 'item result exception')):
+    """
+    Result of running a function against a single item.
+
+    :ivar item: the item provided as input
+    :ivar result: return value of the function, None if it raised
+    :ivar Exception exception: exception raised, None if successful
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """
+        Whether the function completed without raising
+
+        :rtype: bool
+        """
+        return self.exception is None
+
+
+_stop = object()
+
+
+def concurrent_map(func, items, max_workers=DEFAULT_WORKERS, ordered=False):
+    """
+    Run func against each item using a bounded pool of threads and yield
+    a :class:`WorkResult` for every item as it completes. Items are consumed
+    lazily from the input so generators of any size can be provided without
+    loading them in memory. If the caller stops iterating, remaining items
+    are not started.
+
+    :param callable func: callable taking a single item
+    :param iterable items: items to process
+    :param int max_workers: maximum number of concurrent threads
+    :param bool ordered: yield results in input order instead of in
+        order of completion (default: False)
+    :raises: any exception raised while iterating ``items``
+    :rtype: WorkResult
+    """
+    max_workers = max(1, int(max_workers or 1))
+    if isinstance(items, (list, tuple)):
+        max_workers = max(1, min(max_workers, len(items)))
+
+    inbound = queue.Queue(maxsize=max_workers * 2)
+    outbound = queue.Queue()
+    stopped = threading.Event()
+    feed_errors = []
+
+    def feed():
+        try:
+            for entry in enumerate(items):
+                while not stopped.is_set():
+                    try:
+                        inbound.put(entry, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stopped.is_set():
+                    break
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            for _ in range(max_workers):
+                inbound.put(_stop)
+
+    def work():
+        while True:
+            entry = inbound.get()
+            if entry is _stop:
+                break
+            if stopped.is_set():
+                continue
+            index, item = entry
+            try:
+                outbound.put((index, WorkResult(item, func(item), None)))
+            except Exception as e:
+                logger.debug('Concurrent call failed for item: %s, %s', item, e)
+                outbound.put((index, WorkResult(item, None, e)))
+        outbound.put(_stop)
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for _ in range(max_workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = 0
+    buffered = {}
+    next_index = 0
+    try:
+        while finished < max_workers:
+            entry = outbound.get()
+            if entry is _stop:
+                finished += 1
+                continue
+            index, result = entry
+            if not ordered:
+                yield result
+                continue
+            buffered[index] = result
+            while next_index in buffered:
+                yield buffered.pop(next_index)
+                next_index += 1
+        for index in sorted(buffered):
+            yield buffered[index]
+    finally:
+        stopped.set()
+
+    if feed_errors:
+        raise feed_errors[0]
+
+
+class BackgroundCall(object):
+    """
+    Run a single function call in a background thread. Used to prefetch
+    the next result while the current one is being processed::
+
+        call = BackgroundCall(fetch_page, offset=100)
+        ...
+        page = call.result()    # <-- waits for completion
+
+    :param callable func: function to call
+    :param args: positional arguments for func
+    :param kwargs: keyword arguments for func
+    """
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._exception = None
+        self._thread = threading.Thread(
+            target=self._run, args=(func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception as e:
+            self._exception = e
+
+    def done(self):
+        """
+        Whether the call has completed
+
+        :rtype: bool
+        """
+        return not self._thread.is_alive()
+
+    def result(self):
+        """
+        Wait for the call to complete and return the result.
+
+        :raises: exception raised by the function
+        :return: return value of the function
+        """
+        self._thread.join()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def concurrent_apply(func, items, max_workers=DEFAULT_WORKERS):
+    """
+    Convenience to run func against all items and return the results
+    as a list in input order.
+
+    :param callable func: callable taking a single item
+    :param iterable items: items to process
+    :param int max_workers: maximum number of concurrent threads
+    :rtype: list(WorkResult)
+    """
+    return list(concurrent_map(func, items, max_workers, ordered=True))
@@ -0,0 +1,314 @@
+"""
+A unit of work collects element modifications and sends them to the SMC
+together when the unit of work completes.
+
+Normally :meth:`~smc.base.model.ElementBase.update` sends the modification
+immediately, so scripts that modify many elements are serialized on HTTP
+latency. While a unit of work is active in the current thread, calls to
+``update`` (including those made by ``update_or_create`` and rule ``save``)
+are queued instead. When the context manager exits, the queued updates are
+flushed concurrently::
+
+    from smc.base.transaction import UnitOfWork
+
+    with UnitOfWork(max_workers=10) as uow:
+        for host in Host.objects.filter('lab-'):
+            host.comment = 'decommissioned'
+            host.update()                          # <-- queued
+        Network.update_or_create(name='lab', ipv4_network='10.0.0.0/8')
+
+    print(uow.report)
+    UnitOfWorkReport(succeeded=153, failed=1, retried=2)
+    for element, error in uow.report.failed:
+        print(element, error)
+
+Multiple updates to the same element are collapsed into a single request.
+If an update fails because the element was changed by another client since
+it was read (ETag conflict), the latest copy of the element is read and the
+modification is re-applied before retrying. Modifications made by passing
+keyword arguments to ``update`` are replayed onto the latest copy. For
+modifications made directly to the element cache, only top level attributes
+changed after the element was first queued are re-applied. Changes made to
+the cache before the element was first queued cannot be told apart from
+changes made by the other client, so the conflict is reported as a failure.
+
+If an exception is raised within the block, queued modifications are
+discarded and the cache of the affected elements is cleared.
+"""
+import copy
+import logging
+import threading
+from smc.api.common import SMCRequest
+from smc.api.exceptions import UpdateElementFailed
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+from smc.base.util import merge_dicts
+from smc.base.cache import active_store
+
+logger = logging.getLogger(__name__)
+
+
+#: HTTP status codes returned when the ETag sent is no longer current
+CONFLICT_CODES = (409, 412)
+
+_local = threading.local()
+
+
+def current_unit_of_work():
+    """
+    Return the unit of work active in the current thread, or None.
+
+    :rtype: UnitOfWork
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+
+
+class PendingUpdate(object):
+    """
+    A queued modification to a single element.
+
+    :ivar element: the element being modified
+    :ivar str href: href of the element
+    :ivar str etag: etag of the element when the modification was queued
+    :ivar dict json: payload that will be sent
+    :ivar dict base: copy of the element json when first queued, None if
+        the element cache may have been modified before it was queued
+    :ivar list changes: keyword modifications as (kwargs, append_lists)
+    :ivar bool direct: whether the element cache was submitted directly
+    """
+    def __init__(self, element, href, etag, exception):
+        self.element = element
+        self.href = href
+        self.etag = etag
+        self.exception = exception
+        self.json = None
+        self.base = None
+        self.changes = []
+        self.direct = False
+        self.attempts = 0
+
+    def reapply(self, latest):
+        """
+        Re-apply this modification onto the latest copy of the element.
+        Returns None if the modification was made directly to the element
+        cache before it was queued, as the attributes changed by this
+        modification are not known.
+
+        :param dict latest: latest element json
+        :rtype: dict
+        """
+        if self.direct and self.base is None:
+            return None
+        json = copy.deepcopy(latest)
+        for kwargs, append_lists in self.changes:
+            merge_dicts(json, copy.deepcopy(kwargs), append_lists)
+        if self.direct:
+            # Attributes that differ from the keyword modifications applied
+            # to the copy queued were changed directly in the element cache
+            expected = copy.deepcopy(self.base)
+            for kwargs, append_lists in self.changes:
+                merge_dicts(expected, copy.deepcopy(kwargs), append_lists)
+            for key in set(self.json).union(expected):
+                if self.json.get(key) == expected.get(key):
+                    continue
+                if key in self.json:
+                    json[key] = copy.deepcopy(self.json[key])
+                else:
+                    json.pop(key, None)
+        return json
+
+    def __repr__(self):
+        return 'PendingUpdate(element=%s)' % self.element
+
+
+class UnitOfWorkReport(object):
+    """
+    Summary of a unit of work flush.
+
+    :ivar list succeeded: elements updated successfully
+    :ivar list failed: list of tuple (element, exception) for failed updates
+    :ivar int retried: number of retries made due to ETag conflicts
+    """
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+        self.retried = 0
+
+    @property
+    def ok(self):
+        """
+        Whether all modifications were applied
+
+        :rtype: bool
+        """
+        return not self.failed
+
+    def __len__(self):
+        return len(self.succeeded) + len(self.failed)
+
+    def __repr__(self):
+        return 'UnitOfWorkReport(succeeded=%s, failed=%s, retried=%s)' % (
+            len(self.succeeded), len(self.failed), self.retried)
+
+
+class UnitOfWork(object):
+    """
+    Collect element modifications in the current thread and flush them
+    concurrently when the context manager exits or :meth:`flush` is
+    called.
+
+    :param int max_workers: maximum number of concurrent update requests
+    :param int retries: number of times to re-read and re-apply a
+        modification on ETag conflict (default: 2)
+    :param bool raise_on_failure: raise UpdateElementFailed after flushing
+        if any modification failed (default: False). The report is always
+        available from the `report` attribute.
+    """
+    def __init__(self, max_workers=DEFAULT_WORKERS, retries=2,
+                 raise_on_failure=False):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.raise_on_failure = raise_on_failure
+        self.report = None
+        self._pending = {}  # href -> PendingUpdate, insertion order kept
+        self._order = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.stack.remove(self)
+        if exc_type is not None:
+            self.rollback()
+            return
+        self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def pending(self):
+        """
+        Modifications waiting to be flushed
+
+        :rtype: list(PendingUpdate)
+        """
+        return [self._pending[href] for href in self._order]
+
+    def add(self, element, exception=UpdateElementFailed, **kwargs):
+        """
+        Queue a modification for the element. This is called by
+        :meth:`~smc.base.model.ElementBase.update` when a unit of work is
+        active but can also be called directly with an element that was
+        modified through attribute setters.
+
+        :param element: element to modify
+        :param exception: exception to raise on failure
+        :param kwargs: modifications, same as ``update`` keyword arguments
+        :return: href of the element
+        :rtype: str
+        """
+        href = kwargs.pop('href', element.href)
+        with self._lock:
+            pending = self._pending.get(href)
+            if pending is None:
+                pending = PendingUpdate(
+                    element, href, kwargs.pop('etag', None) or element.etag,
+                    exception)
+                self._pending[href] = pending
+                self._order.append(href)
+            else:
+                kwargs.pop('etag', None)
+
+            if 'json' in kwargs:
+                pending.json = kwargs.pop('json')
+                pending.direct = True
+            elif pending.json is None:
+                pending.json = element.data
+                if kwargs:
+                    pending.base = copy.deepcopy(dict(pending.json))
+
+            if kwargs:
+                append_lists = kwargs.pop('append_lists', False)
+                merge_dicts(pending.json, kwargs, append_lists)
+                pending.changes.append((kwargs, append_lists))
+            else:
+                pending.direct = True
+        return href
+
+    def rollback(self):
+        """
+        Discard queued modifications and clear the cache of each element
+        so the next access fetches the current copy from the SMC.
+        """
+        with self._lock:
+            for pending in self._pending.values():
+                pending.element._del_cache()
+            self._pending, self._order = {}, []
+
+    def flush(self):
+        """
+        Send all queued modifications concurrently.
+
+        :raises UpdateElementFailed: if raise_on_failure is set and one or
+            more modifications failed
+        :rtype: UnitOfWorkReport
+        """
+        with self._lock:
+            pending = self.pending
+            self._pending, self._order = {}, []
+
+        report = UnitOfWorkReport()
+        for work in concurrent_map(self._send, pending, self.max_workers):
+            update = work.item
+            report.retried += max(0, update.attempts - 1)
+            if work.ok:
+                report.succeeded.append(update.element)
+            else:
+                report.failed.append((update.element, work.exception))
+
+        self.report = report
+        logger.debug('Unit of work flushed: %s', report)
+        if self.raise_on_failure and report.failed:
+            raise UpdateElementFailed(
+                'Failed to update %s of %s elements: %s' % (
+                    len(report.failed), len(report), '; '.join(
+                        '%s: %s' % (element, error)
+                        for element, error in report.failed)))
+        return report
+
+    def _send(self, update):
+        from smc.base.model import LoadElement, Meta
+        json, etag = update.json, update.etag
+        while True:
+            update.attempts += 1
+            result = SMCRequest(href=update.href, etag=etag, json=json).update()
+            if not result.msg:
+                break
+            if result.code in CONFLICT_CODES and update.attempts <= self.retries:
+                store = active_store()
+                if store is not None:
+                    store.discard(update.href)
+                latest = LoadElement(update.href)
+                json = update.reapply(latest.data)
+                if json is None:
+                    raise update.exception(result.msg)
+                logger.debug('ETag conflict updating %s, re-applying to the '
+                    'latest copy', update.href)
+                etag = latest.etag(update.href)
+                continue
+            raise update.exception(result.msg)
+
+        element = update.element
+        element._del_cache()
+        name = json.get('name')
+        if name and getattr(element, '_meta', None) is not None:
+            element._meta = Meta(name=name, href=element._meta.href,
+                                 type=element._meta.type)
+            element._name = name
+        return result.href
@@ -1,6 +1,7 @@
 """
 Utility functions used in different areas of smc-python
 """
+import os
 import time
 import base64
 import datetime
@@ -68,6 +69,25 @@ def save_to_file(filename, content):
         text_file.write("{}".format(content))
 
 
+def replace_file(src, dst):
+    """
+    Rename src to dst, replacing dst if it exists. Used to replace a
+    file with a completely written temporary file. Python 2 on Windows
+    does not allow os.rename to overwrite an existing file, in which
+    case dst is removed first.
+
+    :param str src: file to rename
+    :param str dst: file to replace
+    :raises OSError: failure renaming the file
+    :return: None
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
 def element_resolver(elements, do_raise=True):
     """
     Element resolver takes either a single class instance
@@ -134,6 +154,24 @@ def find_type_from_self(linklist):
     raise smc.api.exceptions.ResourceNotFound('Self link not found.')
 
 
+def find_type_from_href(href):
+    """
+    Return the type of element from the entry point segment of the
+    elements href. For example, the href
+    http://1.1.1.1:8082/6.4/elements/host/707 would return 'host'.
+    Only hrefs referencing a top level element by id are matched,
+    references to nested resources return None.
+
+    :param str href: href of element
+    :return: str element type or None
+    """
+    _, sep, path = href.partition('/elements/')
+    if sep:
+        segments = path.split('?')[0].strip('/').split('/')
+        if len(segments) == 2 and segments[1].isdigit():
+            return segments[0]
+
+
 def merge_dicts(dict1, dict2, append_lists=False):
     """
     Merge the second dict into the first
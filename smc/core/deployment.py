@@ -0,0 +1,402 @@
+"""
+.. versionadded:: 0.6.2
+
+Deploy policies to many engines concurrently.
+
+:meth:`smc.core.engine.Engine.upload` and :meth:`~smc.core.engine.Engine.refresh`
+start a task on a single engine. A :class:`PolicyDeployment` runs the uploads
+and refreshes of many engines with a bounded number of tasks in progress,
+limits the rate at which tasks are started, retries tasks that fail for
+transient reasons and reports the progress of the deployment as a whole::
+
+    >>> from smc.core.deployment import PolicyDeployment
+    >>> deployment = PolicyDeployment(max_concurrent=5, rate=1, canaries=1,
+    ...     wave_size=20)
+    >>> deployment.add_many(Engine.objects.filter('branch-'), policy='Branch')
+    >>> deployment.add(Engine('dc-fw'))    # refresh the installed policy
+    >>> result = deployment.run(callback=lambda task: print(task))
+    DeploymentTask(engine=branch-001, policy=Branch, state=running, progress=40)
+    ...
+    >>> result
+    DeploymentResult(succeeded=40, failed=1, skipped=0)
+    >>> for task in result.failed:
+    ...   print(task.engine.name, task.message)
+
+Engines are deployed in waves. The first ``canaries`` engines are deployed
+first, then the remaining engines in waves of ``wave_size``. Each wave
+completes before the next starts. If a canary fails, or more than
+``max_failures`` engines have failed after a wave, the deployment stops and
+the remaining engines are skipped.
+
+A task is retried up to ``retries`` times with exponential backoff when it
+could not be started because of a connection error, or when the start or
+the task itself failed with a message indicating a transient condition such
+as a locked policy or a busy engine (see :data:`TRANSIENT_ERRORS`). Provide
+``retry_on`` to decide which failures are retried.
+
+:meth:`PolicyDeployment.progress` can be called from another thread while
+the deployment runs.
+"""
+import re
+import time
+import logging
+import threading
+import collections
+from smc.api.exceptions import SMCConnectionError, TaskRunFailed
+from smc.base.pool import concurrent_map
+
+logger = logging.getLogger(__name__)
+
+
+#: Task states
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+#: Patterns of failure messages retried by default
+TRANSIENT_ERRORS = ('locked', 'busy', 'in progress', 'try again',
+                    'temporarily', 'unavailable', 'not connected')
+
+_TRANSIENT = re.compile('|'.join(TRANSIENT_ERRORS), re.IGNORECASE)
+
+#: Consecutive failures to retrieve the status of a running task
+#: before the task is considered failed
+MAX_POLL_ERRORS = 3
+
+
+def is_transient(message):
+    """
+    Whether a failure message indicates a transient condition. This is
+    the default for ``retry_on``.
+
+    :param str message: failure message of the task
+    :rtype: bool
+    """
+    return bool(message and _TRANSIENT.search(message))
+
+
+#: Progress of a deployment. Percent is the average progress of all tasks,
+#: where finished and skipped tasks count as complete
+DeploymentProgress = collections.namedtuple(
+    'DeploymentProgress', 'pending running succeeded failed skipped percent')
+
+
+class DeploymentTask(object):
+    """
+    The deployment of a single engine.
+
+    :ivar Engine engine: engine to deploy to
+    :ivar policy: policy to upload, or None to refresh the installed policy
+    :ivar str state: one of pending, running, succeeded, failed or skipped
+    :ivar int attempts: number of times the task was started
+    :ivar int progress: progress of the current attempt in percent
+    :ivar str message: last message of the task, or reason for failure
+    :ivar Task task: the SMC task of the current attempt
+    :ivar int wave: wave of the deployment the engine is deployed in
+    """
+    def __init__(self, engine, policy=None):
+        self.engine = engine
+        self.policy = policy
+        self.state = PENDING
+        self.attempts = 0
+        self.progress = 0
+        self.message = None
+        self.task = None
+        self.wave = None
+
+    @property
+    def policy_name(self):
+        """
+        Name of the policy to upload, None for a refresh
+
+        :rtype: str
+        """
+        return getattr(self.policy, 'name', self.policy)
+
+    def __repr__(self):
+        return 'DeploymentTask(engine=%s, policy=%s, state=%s, progress=%s)' % (
+            self.engine.name, self.policy_name, self.state, self.progress)
+
+
+class DeploymentResult(object):
+    """
+    Result of a deployment.
+
+    :ivar list tasks: all tasks of the deployment
+    :ivar int waves: number of waves started
+    """
+    def __init__(self, tasks, waves):
+        self.tasks = tasks
+        self.waves = waves
+
+    def _state(self, state):
+        return [task for task in self.tasks if task.state == state]
+
+    @property
+    def succeeded(self):
+        """
+        :rtype: list(DeploymentTask)
+        """
+        return self._state(SUCCEEDED)
+
+    @property
+    def failed(self):
+        """
+        :rtype: list(DeploymentTask)
+        """
+        return self._state(FAILED)
+
+    @property
+    def skipped(self):
+        """
+        Tasks not started because the deployment stopped
+
+        :rtype: list(DeploymentTask)
+        """
+        return self._state(SKIPPED)
+
+    @property
+    def ok(self):
+        """
+        Whether every engine was deployed
+
+        :rtype: bool
+        """
+        return len(self.succeeded) == len(self.tasks)
+
+    def __repr__(self):
+        return 'DeploymentResult(succeeded=%s, failed=%s, skipped=%s)' % (
+            len(self.succeeded), len(self.failed), len(self.skipped))
+
+
+class _Throttle(object):
+    """
+    Limit the rate of calls to :meth:`wait` across threads.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class PolicyDeployment(object):
+    """
+    Upload or refresh policies on many engines.
+
+    :param int max_concurrent: maximum number of tasks in progress
+    :param float rate: maximum number of tasks started per second, None
+        for no limit
+    :param int canaries: number of engines deployed in a first wave
+    :param int wave_size: number of engines per wave after the canaries,
+        None to deploy the remaining engines in one wave
+    :param int max_failures: number of failed engines tolerated before
+        the deployment stops (default: 0)
+    :param int retries: number of times a task failing for a transient
+        reason is retried (default: 2)
+    :param float backoff: seconds to wait before the first retry, doubled
+        for each retry
+    :param float poll_interval: seconds between task status queries
+    :param float timeout: seconds to wait for a task to complete. A task
+        not complete after the timeout is aborted and fails
+    :param retry_on: callable taking a failure message and returning True
+        if the task should be retried (default: :func:`is_transient`)
+    """
+    def __init__(self, max_concurrent=5, rate=None, canaries=0, wave_size=None,
+                 max_failures=0, retries=2, backoff=10, poll_interval=5,
+                 timeout=1800, retry_on=is_transient):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.canaries = canaries
+        self.wave_size = wave_size
+        self.max_failures = max_failures
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.retry_on = retry_on
+        self.tasks = []
+        self._callback = None
+        self._callback_lock = threading.Lock()
+
+    def __repr__(self):
+        return 'PolicyDeployment(engines=%s)' % len(self.tasks)
+
+    def add(self, engine, policy=None):
+        """
+        Add an engine to the deployment.
+
+        :param Engine engine: engine to deploy to
+        :param policy: policy or policy name to upload, None to refresh
+            the installed policy
+        :rtype: DeploymentTask
+        """
+        task = DeploymentTask(engine, policy)
+        self.tasks.append(task)
+        return task
+
+    def add_many(self, engines, policy=None):
+        """
+        Add engines to the deployment with the same policy.
+
+        :param list engines: engines to deploy to
+        :param policy: policy or policy name to upload, None to refresh
+            the installed policy of each engine
+        :rtype: list(DeploymentTask)
+        """
+        return [self.add(engine, policy) for engine in engines]
+
+    def waves(self):
+        """
+        Split the tasks into waves
+
+        :rtype: list(list(DeploymentTask))
+        """
+        tasks = list(self.tasks)
+        waves = []
+        if self.canaries:
+            waves.append(tasks[:self.canaries])
+            tasks = tasks[self.canaries:]
+        size = self.wave_size or len(tasks)
+        waves.extend(tasks[i:i + size] for i in range(0, len(tasks), size))
+        return [wave for wave in waves if wave]
+
+    def progress(self):
+        """
+        Current progress of the deployment
+
+        :rtype: DeploymentProgress
+        """
+        counts = collections.Counter(task.state for task in self.tasks)
+        complete = sum(100 if task.state in (SUCCEEDED, FAILED, SKIPPED)
+                       else task.progress for task in self.tasks)
+        return DeploymentProgress(
+            counts[PENDING], counts[RUNNING], counts[SUCCEEDED],
+            counts[FAILED], counts[SKIPPED],
+            complete // len(self.tasks) if self.tasks else 100)
+
+    def _notify(self, task):
+        if self._callback is not None:
+            with self._callback_lock:
+                try:
+                    self._callback(task)
+                except Exception as e:
+                    logger.error('Deployment callback failed: %s', e)
+
+    def _start(self, task):
+        if task.policy is None:
+            return task.engine.refresh(wait_for_finish=False)
+        return task.engine.upload(task.policy_name, wait_for_finish=False)
+
+    def _attempt(self, task, throttle):
+        """
+        Start and monitor a single attempt of the task. Returns None if
+        the task succeeded, otherwise (message, retryable).
+        """
+        throttle.wait()
+        task.attempts += 1
+        task.progress = 0
+        try:
+            task.task = self._start(task).task
+        except SMCConnectionError as e:
+            return str(e), True
+        except TaskRunFailed as e:
+            return str(e), self.retry_on(str(e))
+        self._notify(task)
+
+        deadline = time.time() + self.timeout
+        errors = 0
+        while task.task.in_progress:
+            if time.time() >= deadline:
+                task.task.abort()
+                return 'Task did not complete within %s seconds' % \
+                    self.timeout, False
+            time.sleep(self.poll_interval)
+            try:
+                task.task = task.task.update_status()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                if errors >= MAX_POLL_ERRORS:
+                    return 'Failed to retrieve task status: %s' % e, False
+                continue
+            if task.task.progress != task.progress:
+                task.progress = task.task.progress
+                task.message = task.task.last_message
+                self._notify(task)
+
+        task.message = task.task.last_message
+        if task.task.success:
+            return None
+        return task.message, self.retry_on(task.message)
+
+    def _deploy(self, task, throttle):
+        task.state = RUNNING
+        self._notify(task)
+        while True:
+            failure = self._attempt(task, throttle)
+            if failure is None:
+                task.state, task.progress = SUCCEEDED, 100
+                break
+            message, retryable = failure
+            task.message = message
+            if not retryable or task.attempts > self.retries:
+                task.state = FAILED
+                logger.error('Deployment to %s failed: %s', task.engine.name,
+                    message)
+                break
+            delay = self.backoff * 2 ** (task.attempts - 1)
+            logger.debug('Retrying deployment to %s in %s seconds: %s',
+                task.engine.name, delay, message)
+            time.sleep(delay)
+        self._notify(task)
+        return task
+
+    def run(self, callback=None):
+        """
+        Run the deployment. Blocks until every wave has completed or the
+        deployment stopped.
+
+        :param callback: optional callable taking a DeploymentTask, called
+            when a task starts, progresses and finishes. Calls are not
+            made concurrently
+        :rtype: DeploymentResult
+        """
+        self._callback = callback
+        throttle = _Throttle(self.rate)
+        waves = self.waves()
+        started = 0
+        for number, wave in enumerate(waves):
+            for task in wave:
+                task.wave = number
+            started += 1
+            for work in concurrent_map(lambda t: self._deploy(t, throttle),
+                                       wave, self.max_concurrent):
+                if not work.ok:  # Unexpected error, i.e. in a callback
+                    work.item.state = FAILED
+                    work.item.message = str(work.exception)
+            failed = sum(1 for task in self.tasks if task.state == FAILED)
+            canary = self.canaries and number == 0
+            if failed and (canary or failed > self.max_failures):
+                logger.error('Stopping deployment after wave %s, %s engines '
+                    'failed', number, failed)
+                for task in self.tasks:
+                    if task.state == PENDING:
+                        task.state = SKIPPED
+                        task.message = 'Skipped after %s failed engines' % failed
+                        self._notify(task)
+                break
+        result = DeploymentResult(list(self.tasks), started)
+        logger.debug('Deployment complete: %s', result)
+        return result
@@ -0,0 +1,481 @@
+"""
+Local index of the IP addresses defined in network elements.
+
+Finding which elements contain an address normally requires a search query
+to the SMC for every address. When reconciling a large number of addresses,
+for example against an IPAM, build an :class:`IPIndex` once and query it
+locally::
+
+    >>> from smc.elements.ip_index import IPIndex
+    >>> index = IPIndex()
+    >>> index.load()
+    IPIndex(elements=5120, entries=5893)
+    >>> index.contains('10.20.30.40')
+    [IndexEntry(element=Network(name=net-10.20.0.0/16), value=10.20.0.0/16),
+     IndexEntry(element=Host(name=web01), value=10.20.30.40)]
+    >>> index.overlaps('10.20.0.0/15')
+    ...
+    >>> index.within('10.20.30.0/24')
+    ...
+    >>> index.exact('10.20.0.0/16')
+    [IndexEntry(element=Network(name=net-10.20.0.0/16), value=10.20.0.0/16)]
+
+Each query takes an IPv4 or IPv6 address, network in CIDR format or an
+address range in the format '10.0.0.1-10.0.0.10'. Queries return
+:class:`IndexEntry` items identifying the element and the address value of
+the element that matched. Elements with multiple addresses (for example a
+host with secondary addresses) have an entry for each address.
+
+The index is built from Host, Router, Network, AddressRange and IPList
+elements by default. Address ranges are stored as a sorted list of
+non-overlapping segments, each holding the entries covering that segment,
+so an address lookup is a binary search.
+
+Call :meth:`IPIndex.refresh` to update the index. Only elements that were
+added or changed since the index was loaded are retrieved again; elements
+are checked for changes by ETag. Elements can also be added or removed
+individually with :meth:`IPIndex.add` and :meth:`IPIndex.discard`.
+"""
+import bisect
+import logging
+import threading
+import collections
+from itertools import chain
+from smc.base.cache import conditional_fetch
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+from smc.elements.network import Host, Router, Network, AddressRange, IPList
+
+logger = logging.getLogger(__name__)
+
+
+#: Element fields holding address values, by element type
+ADDRESS_FIELDS = {
+    'host': ('address', 'ipv6_address', 'secondary'),
+    'router': ('address', 'ipv6_address', 'secondary'),
+    'network': ('ipv4_network', 'ipv6_network'),
+    'address_range': ('ip_range',)}
+
+#: Element classes indexed by default
+DEFAULT_TYPES = (Host, Router, Network, AddressRange, IPList)
+
+_HEX = frozenset('0123456789abcdefABCDEF')
+
+
+def _ipv4_to_int(address):
+    parts = address.split('.')
+    if len(parts) != 4:
+        raise ValueError('Invalid IPv4 address: %r' % address)
+    value = 0
+    for part in parts:
+        if not part.isdigit() or int(part) > 255:
+            raise ValueError('Invalid IPv4 address: %r' % address)
+        value = (value << 8) | int(part)
+    return value
+
+
+def _ipv6_to_int(address):
+    address = address.split('%')[0]
+    if '.' in address:  # Embedded IPv4, i.e. ::ffff:1.2.3.4
+        head, _, ipv4 = address.rpartition(':')
+        ipv4 = _ipv4_to_int(ipv4)
+        address = '%s:%x:%x' % (head, ipv4 >> 16, ipv4 & 0xffff)
+    if address.count('::') > 1:
+        raise ValueError('Invalid IPv6 address: %r' % address)
+    if '::' in address:
+        left, right = address.split('::')
+        left = left.split(':') if left else []
+        right = right.split(':') if right else []
+        missing = 8 - len(left) - len(right)
+        if missing < 1:
+            raise ValueError('Invalid IPv6 address: %r' % address)
+        groups = left + ['0'] * missing + right
+    else:
+        groups = address.split(':')
+    if len(groups) != 8:
+        raise ValueError('Invalid IPv6 address: %r' % address)
+    value = 0
+    for group in groups:
+        if not 1 <= len(group) <= 4 or not _HEX.issuperset(group):
+            raise ValueError('Invalid IPv6 address: %r' % address)
+        value = (value << 16) | int(group, 16)
+    return value
+
+
+def ip_to_int(address):
+    """
+    Convert an IPv4 or IPv6 address to a tuple of (family, int).
+
+    :param str address: IPv4 or IPv6 address
+    :raises ValueError: address is invalid
+    :return: tuple of (4 or 6, int)
+    :rtype: tuple
+    """
+    address = address.strip()
+    if ':' in address:
+        return 6, _ipv6_to_int(address)
+    return 4, _ipv4_to_int(address)
+
+
+def int_to_ip(family, value):
+    """
+    Convert an int to an IPv4 or IPv6 address. IPv6 addresses are
+    returned in compressed form.
+    ::
+
+        >>> int_to_ip(4, 167772161)
+        '10.0.0.1'
+
+    :param int family: 4 or 6
+    :param int value: address as int
+    :rtype: str
+    """
+    if family == 4:
+        return '.'.join(str((value >> shift) & 0xff)
+                        for shift in (24, 16, 8, 0))
+    groups = ['%x' % ((value >> shift) & 0xffff)
+              for shift in range(112, -16, -16)]
+    # Compress the longest run of at least two zero groups
+    start = length = 0
+    for index in range(8):
+        run = 0
+        while index + run < 8 and groups[index + run] == '0':
+            run += 1
+        if run > length:
+            start, length = index, run
+    if length < 2:
+        return ':'.join(groups)
+    return '%s::%s' % (':'.join(groups[:start]),
+                       ':'.join(groups[start + length:]))
+
+
+def ip_range(value):
+    """
+    Convert an address, CIDR network or address range to the first and
+    last address of the range. Host bits set in a CIDR network are
+    ignored.
+    ::
+
+        >>> ip_range('10.0.0.0/24')
+        (4, 167772160, 167772415)
+
+    :param str value: address, network ('10.0.0.0/24') or address
+        range ('10.0.0.1-10.0.0.10')
+    :raises ValueError: value is invalid
+    :return: tuple of (family, first, last)
+    :rtype: tuple
+    """
+    if '-' in value:
+        first, last = value.split('-', 1)
+        family, first = ip_to_int(first)
+        last_family, last = ip_to_int(last)
+        if family != last_family or first > last:
+            raise ValueError('Invalid address range: %r' % value)
+        return family, first, last
+    if '/' in value:
+        address, prefix = value.split('/', 1)
+        family, address = ip_to_int(address)
+        bits = 32 if family == 4 else 128
+        prefix = prefix.strip()
+        if not prefix.isdigit() or int(prefix) > bits:
+            raise ValueError('Invalid network: %r' % value)
+        hostmask = (1 << (bits - int(prefix))) - 1
+        first = address & ~hostmask
+        return family, first, first | hostmask
+    family, address = ip_to_int(value)
+    return family, address, address
+
+
+class IndexEntry(collections.namedtuple(
+        'IndexEntry', 'element value family first last')):
+    """
+    An address value of an indexed element.
+
+    :ivar Element element: element holding the address
+    :ivar str value: address value as defined on the element
+    :ivar int family: 4 for IPv4, 6 for IPv6
+    :ivar int first: first address in the range as int
+    :ivar int last: last address in the range as int
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'IndexEntry(element=%s, value=%s)' % (self.element, self.value)
+
+
+#: Summary of a refresh, each attribute is a list of hrefs
+IndexRefresh = collections.namedtuple('IndexRefresh', 'added updated removed')
+
+
+def element_addresses(typeof, data):
+    """
+    Return the address values held in the element json.
+
+    :param str typeof: element type
+    :param dict data: element json
+    :rtype: list(str)
+    """
+    values = []
+    for field in ADDRESS_FIELDS.get(typeof, ()):
+        value = data.get(field)
+        if isinstance(value, list):
+            values.extend(value)
+        elif value:
+            values.append(value)
+    return values
+
+
+class IPIndex(object):
+    """
+    Local index of element IP addresses supporting containment, overlap
+    and exact match queries for IPv4 and IPv6.
+
+    :param tuple types: element classes to index. Classes must be one of
+        Host, Router, Network, AddressRange or IPList
+    :param int max_workers: maximum number of concurrent requests used
+        when loading elements
+    """
+    def __init__(self, types=DEFAULT_TYPES, max_workers=DEFAULT_WORKERS):
+        self.types = types
+        self.max_workers = max_workers
+        self._entries = {}      # href -> list(IndexEntry)
+        self._etags = {}        # href -> etag when indexed
+        self._exact = None      # (family, first, last) -> list(IndexEntry)
+        self._segments = None   # family -> (bounds, members)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, href):
+        return href in self._entries
+
+    def __repr__(self):
+        return 'IPIndex(elements=%s, entries=%s)' % (
+            len(self._entries), sum(len(e) for e in self._entries.values()))
+
+    def _fetch(self, element, data=None, etag=None):
+        if data is None:
+            data, etag = element.data, element.etag
+        if element.typeof == 'ip_list':
+            values = element.iplist
+        else:
+            values = element_addresses(element.typeof, data)
+        entries = []
+        for value in values:
+            try:
+                entries.append(IndexEntry(element, value, *ip_range(value)))
+            except ValueError:
+                logger.debug('Skipping invalid address %r on element: %s',
+                    value, element)
+        return element, etag, entries
+
+    def _set(self, element, etag, entries):
+        with self._lock:
+            self._entries[element.href] = entries
+            self._etags[element.href] = etag
+            self._exact = self._segments = None
+
+    def _collections(self):
+        return chain.from_iterable(cls.objects.all() for cls in self.types)
+
+    def load(self):
+        """
+        Load all elements of the indexed types. Any existing entries are
+        removed. Element data is retrieved concurrently.
+
+        :raises FetchElementFailed: failed retrieving an IPList
+        :rtype: IPIndex
+        """
+        with self._lock:
+            self._entries, self._etags = {}, {}
+            self._exact = self._segments = None
+        for work in concurrent_map(
+                self._fetch, self._collections(), self.max_workers):
+            if not work.ok:
+                raise work.exception
+            self._set(*work.result)
+        logger.debug('Loaded %s', self)
+        return self
+
+    def refresh(self):
+        """
+        Update the index with elements added, changed or removed since
+        the index was loaded. Existing elements are checked for changes
+        by ETag, only changed elements are retrieved. IPList contents are
+        always retrieved again.
+
+        :raises FetchElementFailed: failed retrieving an IPList
+        :return: hrefs of the elements added, updated and removed
+        :rtype: IndexRefresh
+        """
+        current = {element.href: element for element in self._collections()}
+        removed = [href for href in self._entries if href not in current]
+        for href in removed:
+            self.discard(href)
+
+        def check(element):
+            if element.href not in self._entries:
+                return 'added', self._fetch(element)
+            if element.typeof == 'ip_list':
+                return 'updated', self._fetch(element)
+            result = conditional_fetch(element.href, self._etags[element.href])
+            if result is None:
+                return None, None
+            if not result.json:  # Removed since the listing
+                return 'removed', (element, None, None)
+            return 'updated', self._fetch(element, result.json, result.etag)
+
+        refresh = IndexRefresh([], [], removed)
+        for work in concurrent_map(check, current.values(), self.max_workers):
+            if not work.ok:
+                raise work.exception
+            status, fetched = work.result
+            if status == 'removed':
+                self.discard(fetched[0].href)
+            elif status is not None:
+                self._set(*fetched)
+            if status is not None:
+                getattr(refresh, status).append(work.item.href)
+        logger.debug('Refreshed %s, added: %s, updated: %s, removed: %s',
+            self, len(refresh.added), len(refresh.updated),
+            len(refresh.removed))
+        return refresh
+
+    def add(self, element):
+        """
+        Add or replace a single element in the index.
+
+        :param Element element: element to index
+        :return: None
+        """
+        self._set(*self._fetch(element))
+
+    def discard(self, href):
+        """
+        Remove an element from the index if it exists.
+
+        :param str href: href of the element
+        :return: None
+        """
+        with self._lock:
+            if self._entries.pop(href, None) is not None:
+                self._etags.pop(href, None)
+                self._exact = self._segments = None
+
+    def _build(self):
+        with self._lock:
+            if self._segments is not None:
+                return self._exact, self._segments
+            exact = {}
+            starts, ends = {}, {}
+            for entries in self._entries.values():
+                for entry in entries:
+                    key = (entry.family, entry.first, entry.last)
+                    exact.setdefault(key, []).append(entry)
+                    starts.setdefault((entry.family, entry.first), []).append(entry)
+                    ends.setdefault((entry.family, entry.last + 1), []).append(entry)
+
+            segments = {}
+            for family in (4, 6):
+                points = sorted(set(
+                    point for fam, point in chain(starts, ends) if fam == family))
+                bounds, members = [], []
+                active = {}
+                for point in points:
+                    for entry in ends.get((family, point), ()):
+                        del active[id(entry)]
+                    for entry in starts.get((family, point), ()):
+                        active[id(entry)] = entry
+                    bounds.append(point)
+                    members.append(tuple(active.values()))
+                segments[family] = (bounds, members)
+            self._exact, self._segments = exact, segments
+            return exact, segments
+
+    def _point(self, family, address):
+        bounds, members = self._build()[1][family]
+        index = bisect.bisect_right(bounds, address) - 1
+        return members[index] if index >= 0 else ()
+
+    def _overlapping(self, family, first, last):
+        bounds, members = self._build()[1][family]
+        start = max(0, bisect.bisect_right(bounds, first) - 1)
+        stop = bisect.bisect_right(bounds, last)
+        seen, entries = set(), []
+        for segment in members[start:stop]:
+            for entry in segment:
+                if id(entry) not in seen:
+                    seen.add(id(entry))
+                    entries.append(entry)
+        return entries
+
+    def contains(self, value):
+        """
+        Return entries that contain the address, network or range. An
+        address is contained by a host with the same address, and by any
+        network or range that includes the address.
+
+        :param str value: address, network or address range
+        :raises ValueError: value is invalid
+        :rtype: list(IndexEntry)
+        """
+        family, first, last = ip_range(value)
+        entries = self._point(family, first)
+        if first == last:
+            return list(entries)
+        return [entry for entry in entries
+                if entry.first <= first and entry.last >= last]
+
+    def overlaps(self, value):
+        """
+        Return entries that share any address with the address, network
+        or range.
+
+        :param str value: address, network or address range
+        :raises ValueError: value is invalid
+        :rtype: list(IndexEntry)
+        """
+        return self._overlapping(*ip_range(value))
+
+    def within(self, value):
+        """
+        Return entries that are entirely inside the address, network or
+        range, i.e. all hosts within a network.
+
+        :param str value: address, network or address range
+        :raises ValueError: value is invalid
+        :rtype: list(IndexEntry)
+        """
+        family, first, last = ip_range(value)
+        return [entry for entry in self._overlapping(family, first, last)
+                if entry.first >= first and entry.last <= last]
+
+    def exact(self, value):
+        """
+        Return entries that define exactly the address, network or range.
+        A network and an address range covering the same addresses are
+        both an exact match.
+
+        :param str value: address, network or address range
+        :raises ValueError: value is invalid
+        :rtype: list(IndexEntry)
+        """
+        return list(self._build()[0].get(ip_range(value), ()))
+
+    def elements(self, entries):
+        """
+        Convenience to return the unique elements from a query result.
+        ::
+
+            >>> index.elements(index.contains('10.0.0.1'))
+            [Network(name=net-10.0.0.0/8), Host(name=host-10.0.0.1)]
+
+        :param list entries: entries returned from a query
+        :rtype: list(Element)
+        """
+        seen, elements = set(), []
+        for entry in entries:
+            if entry.element.href not in seen:
+                seen.add(entry.element.href)
+                elements.append(entry.element)
+        return elements
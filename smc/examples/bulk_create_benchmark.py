@@ -0,0 +1,205 @@
+"""
+Example script to measure the throughput of creating host elements with
+``Host.create`` compared to ``Host.bulk_create`` using different numbers
+of worker threads.
+
+Each run creates the specified number of hosts using a unique name prefix
+and removes them afterwards. The output shows one line per run with the
+number of hosts created, the elapsed time and the hosts created per second::
+
+    sequential          <count> hosts in <seconds>s, <rate>/s
+    bulk (workers=4)    <count> hosts in <seconds>s, <rate>/s
+    ...
+
+By default the benchmark runs against :class:`LocalSMC`, a stand-in for the
+SMC connection that keeps hosts in memory and waits ``LATENCY`` seconds per
+request to simulate the round trip to an SMC. This measures the client side
+cost of each approach without an SMC. The stand-in has no server side cost,
+so throughput keeps increasing with the number of workers.
+
+To run against a lab SMC instead, set the SMC_URL and SMC_API_KEY
+environment variables. Do not run this against a production system.
+Throughput will level off once the SMC becomes the bottleneck, so keep the
+number of workers reasonable.
+
+Requirements:
+* smc-python >= 0.6.2
+* Stonesoft Management Center >= 6.2 (only when SMC_URL is set)
+
+"""
+import os
+import time
+import threading
+from smc import session
+from smc.api.entry_point import Resource
+from smc.api.exceptions import SMCOperationFailure
+from smc.api.web import SMCResult
+from smc.elements.network import Host
+from smc.base.pool import concurrent_map
+
+#: Seconds each request to the stand-in takes
+LATENCY = 0.01
+
+
+class _Response(object):
+    """
+    Minimal HTTP response returned by the stand-in
+    """
+    def __init__(self, status_code, data=None, etag=None, location=None):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = ''
+        self._data = data
+        if data is not None:
+            self.headers['content-type'] = 'application/json'
+        if etag:
+            self.headers['ETag'] = etag
+        if location:
+            self.headers['location'] = location
+
+    def json(self):
+        return self._data
+
+
+class LocalSMC(object):
+    """
+    Stand-in for the SMC connection of the session that stores host
+    elements in memory. Supports the requests made by this script:
+    listing, creating, retrieving and deleting hosts.
+
+    :param float latency: seconds each request takes
+    """
+    url = 'http://localhost:8082/6.4'
+
+    def __init__(self, latency=LATENCY):
+        self.latency = latency
+        self.elements = {}  # href -> json
+        self._next = 1
+        self._lock = threading.Lock()
+
+    @property
+    def host_href(self):
+        return '%s/elements/host' % self.url
+
+    @property
+    def elements_href(self):
+        return '%s/elements' % self.url
+
+    def install(self):
+        """
+        Use the stand-in for requests made by the default session
+        """
+        Resource.add([
+            {'href': self.host_href, 'rel': 'host', 'method': 'GET'},
+            {'href': self.elements_href, 'rel': 'elements', 'method': 'GET'}])
+        session._connection = self
+        session._session = self
+
+    def _list(self, params):
+        with self._lock:
+            meta = [{'name': data['name'], 'href': href, 'type': 'host'}
+                    for href, data in sorted(self.elements.items())]
+        if params.get('filter'):
+            meta = [m for m in meta if params['filter'] in m['name']]
+        offset = int(params.get('offset', 0))
+        if params.get('limit'):
+            return meta[offset:offset + int(params['limit'])]
+        return meta[offset:]
+
+    def send_request(self, method, request):
+        time.sleep(self.latency)
+        method = method.upper()
+        href = request.href
+        with self._lock:
+            data = self.elements.get(href)
+        if method == 'GET' and href in (self.host_href, self.elements_href):
+            response = _Response(200, self._list(request.params or {}))
+        elif method == 'POST' and href == self.host_href:
+            with self._lock:
+                name = request.json.get('name')
+                if any(e['name'] == name for e in self.elements.values()):
+                    response = _Response(400, {'message': 'Element name %s is '
+                        'already used' % name})
+                else:
+                    location = '%s/%s' % (self.host_href, self._next)
+                    self._next += 1
+                    self.elements[location] = dict(request.json)
+                    response = _Response(201, location=location)
+        elif data is None:
+            response = _Response(404, {'message': 'Not found: %s' % href})
+        elif method == 'GET':
+            response = _Response(200, data, etag='"%s"' % id(data))
+        elif method == 'DELETE':
+            with self._lock:
+                self.elements.pop(href, None)
+            response = _Response(204)
+        else:
+            response = _Response(405, {'message': 'Unsupported: %s' % method})
+        if response.status_code >= 400:
+            raise SMCOperationFailure(response)
+        return SMCResult(response)
+
+
+def hosts(prefix, count):
+    """
+    Generate keyword arguments for hosts to create
+
+    :param str prefix: prefix for each host name
+    :param int count: number of hosts
+    :rtype: list(dict)
+    """
+    return [{'name': '%s-%s' % (prefix, i),
+             'address': '10.%s.%s.%s' % (i // 65536 % 256, i // 256 % 256, i % 256)}
+            for i in range(count)]
+
+
+def cleanup(elements, max_workers=8):
+    """
+    Delete the hosts created by a run.
+    """
+    for work in concurrent_map(lambda host: host.delete(), elements, max_workers):
+        if not work.ok:
+            print('Failed to delete %s: %s' % (work.item, work.exception))
+
+
+def report(label, count, elapsed):
+    print('%-20s%s hosts in %.1fs, %.1f/s' % (
+        label, count, elapsed, count / elapsed if elapsed else 0))
+
+
+def run_sequential(count):
+    elements = []
+    start = time.time()
+    for kwargs in hosts('bench-seq', count):
+        elements.append(Host.create(**kwargs))
+    report('sequential', count, time.time() - start)
+    cleanup(elements)
+
+
+def run_bulk(count, max_workers):
+    start = time.time()
+    result = Host.bulk_create(hosts('bench-bulk%s' % max_workers, count),
+                              max_workers=max_workers)
+    report('bulk (workers=%s)' % max_workers, len(result.created),
+           time.time() - start)
+    for kwargs, error in result.failed:
+        print('Failed to create %s: %s' % (kwargs['name'], error))
+    cleanup(result.created)
+
+
+if __name__ == '__main__':
+
+    url = os.environ.get('SMC_URL')
+    if url:
+        session.login(url=url, api_key=os.environ.get('SMC_API_KEY'),
+                      timeout=45)
+    else:
+        LocalSMC().install()
+
+    count = 500
+    run_sequential(count)
+    for max_workers in (4, 8, 16):
+        run_bulk(count, max_workers)
+
+    if url:
+        session.logout()
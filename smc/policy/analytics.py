@@ -0,0 +1,309 @@
+"""
+.. versionadded:: 0.6.2
+
+Rule hit counters of a policy collected from many engines.
+
+:meth:`smc.policy.policy.Policy.rule_counters` returns the counters of a single
+engine and time window, and the rule of each counter is retrieved separately
+when accessing :attr:`~smc.policy.policy.RuleCounter.rule`. Use
+:func:`rule_hits` to collect the counters of many engines and time windows
+concurrently and join them to the rules of the policy::
+
+    >>> from smc.policy.analytics import rule_hits
+    >>> hits = rule_hits(FirewallPolicy('Corporate'),
+    ...     engines=list(Engine.objects.all()),
+    ...     windows=('one_day', 'one_month'))
+    >>> hits
+    RuleHits(rules=10204, engines=24, windows=2, failed=0)
+    >>> for rule in hits.zero_hit():
+    ...   print(rule.name, rule.tag)
+    >>> hits.top(2, window='one_month')
+    [(IPv4Rule(name=allow web), 1503002), (IPv4Rule(name=allow dns), 88120)]
+
+The rules of the policy are loaded with a prefetching collection while the
+counters are retrieved. Counters referencing rules that are not in the
+policy, such as template rules, are resolved in bulk with the shared
+:class:`smc.base.cache.ElementResolver`.
+
+Hits are held as one array per engine and time window, each aligned with
+:attr:`RuleHits.rules`, so totals across engines are computed column by
+column instead of rule by rule. Time windows overlap, i.e. one_week includes
+one_day, so hits are summed across engines for a single window.
+
+A time window is a duration type accepted by ``rule_counters``, i.e. one_day,
+one_week, one_month, six_months, one_year or since_last_upload, or a dict of
+``rule_counters`` arguments with a ``name`` for custom windows::
+
+    {'name': 'last hour', 'duration_type': 'custom', 'duration': 3600,
+     'start_time': 1514764800000}
+"""
+import array
+import logging
+from smc.api.exceptions import ActionCommandFailed
+from smc.base.cache import shared_resolver
+from smc.base.pool import concurrent_map, BackgroundCall, DEFAULT_WORKERS
+from smc.compat import string_types
+
+logger = logging.getLogger(__name__)
+
+
+#: Time windows collected by default
+DEFAULT_WINDOWS = ('one_week',)
+
+#: Rule collections joined to counters by default
+DEFAULT_RULE_TYPES = ('fw_ipv4_access_rules',)
+
+#: Array type code for hit counts, 64 bit where supported
+_TYPECODE = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+
+
+def _window(window):
+    """
+    Return (name, rule_counters arguments) for a time window.
+    """
+    if isinstance(window, string_types):
+        return window, {'duration_type': window}
+    window = dict(window)
+    name = window.pop('name', None) or window.get('duration_type', 'custom')
+    return name, window
+
+
+def _column(size):
+    return array.array(_TYPECODE, [0]) * size
+
+
+class RuleHits(object):
+    """
+    Rule hits of a policy for each engine and time window.
+
+    :ivar list rules: rules of the policy in order, followed by rules
+        outside the policy that had counters, i.e. template rules
+    :ivar list columns: tuple (engine name, window name) for each column
+    :ivar list hits: array of hits for each column, aligned with rules
+    :ivar list failed: list of tuple (engine, window name, exception) for
+        counters that could not be retrieved
+    """
+    def __init__(self, rules, columns, hits, failed):
+        self.rules = rules
+        self.columns = columns
+        self.hits = hits
+        self.failed = failed
+        self._index = {rule.href: index for index, rule in enumerate(rules)}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __repr__(self):
+        return 'RuleHits(rules=%s, engines=%s, windows=%s, failed=%s)' % (
+            len(self.rules), len(self.engines), len(self.windows),
+            len(self.failed))
+
+    @property
+    def engines(self):
+        """
+        Names of engines with counters
+
+        :rtype: list(str)
+        """
+        return sorted(set(engine for engine, _ in self.columns))
+
+    @property
+    def windows(self):
+        """
+        Names of time windows with counters, in the order requested
+
+        :rtype: list(str)
+        """
+        windows = []
+        for _, window in self.columns:
+            if window not in windows:
+                windows.append(window)
+        return windows
+
+    def index(self, rule):
+        """
+        Position of a rule in :attr:`rules` and the hit arrays
+
+        :param rule: rule or rule href
+        :raises KeyError: rule has no hits
+        :rtype: int
+        """
+        return self._index[getattr(rule, 'href', rule)]
+
+    def _select(self, engines=None, windows=None):
+        return [self.hits[index] for index, (engine, window) in
+                enumerate(self.columns)
+                if (engines is None or engine in engines) and
+                (windows is None or window in windows)]
+
+    def _sum(self, columns):
+        if not columns:
+            return _column(len(self.rules))
+        if len(columns) == 1:
+            return array.array(_TYPECODE, columns[0])
+        return array.array(_TYPECODE, map(sum, zip(*columns)))
+
+    def totals(self, window=None, engines=None):
+        """
+        Hits of each rule summed across engines for a time window
+
+        :param str window: name of time window, defaults to the first window
+        :param list engines: names of engines to include, defaults to all
+        :return: array of hits aligned with :attr:`rules`
+        :rtype: array
+        """
+        if window is None and self.windows:
+            window = self.windows[0]
+        return self._sum(self._select(engines, (window,)))
+
+    def by_engine(self, window=None):
+        """
+        Hits of each rule for each engine in a time window
+
+        :param str window: name of time window, defaults to the first window
+        :return: engine name to array of hits aligned with :attr:`rules`
+        :rtype: dict
+        """
+        if window is None and self.windows:
+            window = self.windows[0]
+        return {engine: self.hits[index] for index, (engine, name) in
+                enumerate(self.columns) if name == window}
+
+    def rule_hits(self, rule):
+        """
+        Hits of a single rule for each engine and time window
+
+        :param rule: rule or rule href
+        :raises KeyError: rule has no hits
+        :return: tuple (engine name, window name) to hits
+        :rtype: dict
+        """
+        index = self.index(rule)
+        return {column: hits[index]
+                for column, hits in zip(self.columns, self.hits)}
+
+    def zero_hit(self, windows=None, engines=None, include_disabled=False):
+        """
+        Rules without hits on any of the engines in any of the time
+        windows. Rule sections are not included.
+
+        A rule may only be used on an engine whose counters could not be
+        retrieved, so an exception is raised if counters of a selected
+        engine and window failed. Provide the engines to exclude the
+        failed engines.
+
+        :param list windows: names of windows to include, defaults to all
+        :param list engines: names of engines to include, defaults to all
+        :param bool include_disabled: include disabled rules (default: False)
+        :raises ActionCommandFailed: counters of a selected engine and
+            window could not be retrieved
+        :rtype: list
+        """
+        for engine, window, error in self.failed:
+            if (engines is None or engine.name in engines) and \
+                    (windows is None or window in windows):
+                raise ActionCommandFailed('Cannot determine rules without '
+                    'hits, rule counters of engine: %s, window: %s could not '
+                    'be retrieved: %s' % (engine.name, window, error))
+        selected = self._select(engines, windows)
+        if not selected:
+            return []
+        # The maximum is zero only when every column is zero
+        peak = map(max, zip(*selected)) if len(selected) > 1 else selected[0]
+        return [rule for rule, hits in zip(self.rules, peak)
+                if not hits and 'action' in rule.data and
+                (include_disabled or not rule.data.get('is_disabled'))]
+
+    def top(self, count=10, window=None, engines=None):
+        """
+        Rules with the most hits across engines in a time window
+
+        :param int count: number of rules
+        :param str window: name of time window, defaults to the first window
+        :param list engines: names of engines to include, defaults to all
+        :return: list of tuple (rule, hits)
+        :rtype: list
+        """
+        totals = self.totals(window, engines)
+        ranked = sorted(range(len(totals)), key=totals.__getitem__,
+                        reverse=True)[:count]
+        return [(self.rules[index], totals[index]) for index in ranked]
+
+    def to_rows(self):
+        """
+        Hits as one dict per rule suitable for writing reports, i.e. with
+        :class:`csv.DictWriter`. Each column is keyed as 'engine:window'.
+
+        :rtype: list(dict)
+        """
+        keys = ['%s:%s' % column for column in self.columns]
+        rows = []
+        for index, rule in enumerate(self.rules):
+            row = {'name': rule.name, 'tag': rule.data.get('tag'),
+                   'href': rule.href}
+            for key, hits in zip(keys, self.hits):
+                row[key] = hits[index]
+            rows.append(row)
+        return rows
+
+
+def rule_hits(policy, engines, windows=DEFAULT_WINDOWS,
+              rule_types=DEFAULT_RULE_TYPES, max_workers=DEFAULT_WORKERS,
+              resolver=None):
+    """
+    Collect the rule counters of the policy from each engine for each time
+    window concurrently and join them to the rules of the policy.
+
+    :param Policy policy: policy installed on the engines
+    :param list engines: engines to retrieve counters from
+    :param tuple windows: time windows, see the module documentation
+    :param tuple rule_types: rule collections of the policy to join
+        counters to, i.e. 'fw_ipv4_access_rules'
+    :param int max_workers: maximum number of concurrent requests
+    :param ElementResolver resolver: resolver for rules outside the policy,
+        defaults to the shared resolver
+    :raises ResourceNotFound: a rule collection does not exist on the policy
+    :rtype: RuleHits
+    """
+    resolver = resolver or shared_resolver()
+    windows = [_window(window) for window in windows]
+
+    def load_rules():
+        return [rule for rule_type in rule_types for rule in
+                getattr(policy, rule_type).prefetch(max_workers=max_workers)]
+    loading = BackgroundCall(load_rules)
+
+    def fetch(job):
+        engine, (_, kwargs) = job
+        return {counter.rule_ref: counter.hits
+                for counter in policy.rule_counters(engine, **kwargs)}
+
+    jobs = [(engine, window) for engine in engines for window in windows]
+    counters, failed = [], []
+    for work in concurrent_map(fetch, jobs, max_workers, ordered=True):
+        engine, (name, _) = work.item
+        if work.ok:
+            counters.append(((engine.name, name), work.result))
+        else:
+            logger.error('Failed retrieving rule counters for engine: %s, '
+                'window: %s, %s', engine.name, name, work.exception)
+            failed.append((engine, name, work.exception))
+
+    rules = loading.result()
+    known = set(rule.href for rule in rules)
+    unknown = set(href for _, hits in counters for href in hits
+                  if href not in known)
+    if unknown:
+        rules.extend(rule for rule in resolver.resolve_many(
+            sorted(unknown), load=True) if rule is not None)
+
+    result = RuleHits(rules, [column for column, _ in counters], [], failed)
+    for _, hits in counters:
+        column = _column(len(rules))
+        for href, value in hits.items():
+            index = result._index.get(href)
+            if index is not None:
+                column[index] = value or 0
+        result.hits.append(column)
+    logger.debug('Rule hits collected for %s: %s', policy.name, result)
+    return result
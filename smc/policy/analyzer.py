@@ -0,0 +1,246 @@
+"""
+.. versionadded:: 0.6.2
+
+Find shadowed, redundant and overly broad access rules.
+
+The :class:`RuleAnalyzer` works on the rules compiled by a
+:class:`smc.policy.evaluator.PolicyEvaluator`, so rules are analyzed in
+evaluation order including template rules and the rules of sub policies::
+
+    >>> from smc.policy.analyzer import RuleAnalyzer
+    >>> analyzer = RuleAnalyzer(FirewallPolicy('Corporate'))
+    >>> for finding in analyzer.analyze():
+    ...   print(finding)
+    RuleFinding(kind=shadowed, rule=IPv4Rule(name=allow ssh), covered_by=IPv4Rule(name=deny mgmt))
+    RuleFinding(kind=redundant, rule=IPv4Rule(name=web 2), covered_by=IPv4Rule(name=web))
+    RuleFinding(kind=broad, rule=IPv4Rule(name=temp any))
+
+Findings are one of:
+
+* shadowed: every connection the rule matches is matched by an earlier rule
+  with a different action. The rule is never applied.
+* redundant: every connection the rule matches is matched by an earlier rule
+  with the same action. The rule can be removed without changing the policy.
+* broad: an allow rule where at least ``broad_fields`` of the sources,
+  destinations and services are 'any' or cover a large range.
+
+A rule is only reported as shadowed or redundant when a single earlier rule
+covers all of its sources, destinations and services; a rule covered by a
+combination of earlier rules is not reported. Rules with the continue action
+do not shadow other rules, and rules that could not be compiled are ignored.
+
+The sources, destinations and services of all rules are split into non
+overlapping segments holding a bit mask of the rules covering each segment,
+as done by the evaluator. The rules covering a range are the and of the masks
+of its segments, so finding the rules that cover a rule does not compare it
+with every other rule.
+"""
+import bisect
+import logging
+import collections
+from smc.policy.evaluator import PolicyEvaluator, IntervalMasks, ANY, \
+    NON_TERMINAL_ACTIONS
+
+logger = logging.getLogger(__name__)
+
+
+#: Actions of rules that are checked for being too broad
+ALLOW_ACTIONS = ('allow', 'apply_vpn', 'enforce_vpn', 'forward_vpn')
+
+_ADDRESS_BITS = {4: 32, 6: 128}
+
+
+class RuleFinding(collections.namedtuple(
+        'RuleFinding', 'kind rule covered_by')):
+    """
+    A shadowed, redundant or broad rule.
+
+    :ivar str kind: 'shadowed', 'redundant' or 'broad'
+    :ivar CompiledRule rule: the rule
+    :ivar CompiledRule covered_by: for shadowed and redundant rules, the
+        first earlier rule covering the rule
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        """
+        Return the finding as a dict suitable for serializing
+
+        :rtype: dict
+        """
+        finding = {'kind': self.kind, 'rule': self.rule.rule.name,
+                   'href': self.rule.rule.href, 'action': self.rule.action,
+                   'position': self.rule.position}
+        if self.covered_by is not None:
+            finding.update(covered_by=self.covered_by.rule.href,
+                           covered_by_position=self.covered_by.position)
+        return finding
+
+    def __repr__(self):
+        finding = 'RuleFinding(kind=%s, rule=%s' % (self.kind, self.rule.rule)
+        if self.covered_by is not None:
+            finding += ', covered_by=%s' % self.covered_by.rule
+        return finding + ')'
+
+
+def _covering(masks, any_mask, first, last):
+    """
+    Mask of rules covering every value from first to last.
+    """
+    if masks is None:
+        return any_mask
+    index = bisect.bisect_right(masks.starts, first) - 1
+    if index < 0:
+        return any_mask
+    end = bisect.bisect_right(masks.starts, last)
+    mask = -1
+    for position in range(index, end):
+        mask &= masks.masks[position]
+        if not mask:
+            break
+    return mask | any_mask
+
+
+class RuleAnalyzer(object):
+    """
+    Analyze the access rules of a policy.
+
+    :param policy: policy to analyze, or a PolicyEvaluator for the policy
+    :param int broad_fields: number of fields of an allow rule that must be
+        broad for the rule to be reported as broad (default: 2)
+    :param int broad_prefix: address fields covering at least as many
+        addresses as a network of this prefix length are broad
+        (default: 8)
+    :param evaluator_args: keyword arguments for the PolicyEvaluator
+        when a policy is provided
+    """
+    def __init__(self, policy, broad_fields=2, broad_prefix=8,
+                 **evaluator_args):
+        if isinstance(policy, PolicyEvaluator):
+            self.evaluator = policy
+        else:
+            self.evaluator = PolicyEvaluator(policy, **evaluator_args)
+        self.broad_fields = broad_fields
+        self.broad_prefix = broad_prefix
+
+    def __repr__(self):
+        return 'RuleAnalyzer(policy=%s)' % self.evaluator.policy.name
+
+    def _address_broad(self, field):
+        if field == ANY:
+            return True
+        span = collections.defaultdict(int)
+        for family, first, last in field:
+            span[family] += last - first + 1
+        return any(size >= 1 << (_ADDRESS_BITS[family] - self.broad_prefix)
+                   for family, size in span.items())
+
+    @staticmethod
+    def _service_broad(field):
+        if field == ANY:
+            return True
+        return any(protocol in (6, 17) and low == 0 and high == 65535
+                   and src is None for protocol, low, high, src in field)
+
+    def is_broad(self, rule):
+        """
+        Whether a compiled rule is too broad
+
+        :param CompiledRule rule: rule
+        :rtype: bool
+        """
+        if rule.action not in ALLOW_ACTIONS or not rule.resolved:
+            return False
+        broad = sum((self._address_broad(rule.sources),
+                     self._address_broad(rule.destinations),
+                     self._service_broad(rule.services)))
+        return broad >= self.broad_fields
+
+    def _index(self, rules):
+        """
+        Build segment masks of the terminal rules for each field.
+        """
+        entries = [collections.defaultdict(list) for _ in range(3)]
+        any_masks = [0, 0, 0]
+        for rule in rules:
+            for index, field in enumerate(
+                    (rule.sources, rule.destinations, rule.services)):
+                if field == ANY:
+                    any_masks[index] |= 1 << rule.position
+                elif index < 2:
+                    for family, first, last in field:
+                        entries[index][family].append(
+                            (first, last, rule.position))
+                else:
+                    # Services restricted by source port never cover
+                    # another rule
+                    for protocol, low, high, src in field:
+                        if src is None:
+                            entries[index][protocol].append(
+                                (low, high, rule.position))
+        masks = [{key: IntervalMasks(values) for key, values in field.items()}
+                 for field in entries]
+        return masks, any_masks
+
+    def _covered_by(self, rule, masks, any_masks):
+        """
+        Mask of rules covering all sources, destinations and services of
+        the rule.
+        """
+        mask = (1 << rule.position) - 1  # Earlier rules only
+        for index, field in enumerate(
+                (rule.sources, rule.destinations, rule.services)):
+            if field == ANY:
+                mask &= any_masks[index]
+            elif index < 2:
+                for family, first, last in field:
+                    mask &= _covering(masks[index].get(family),
+                                      any_masks[index], first, last)
+                    if not mask:
+                        return 0
+            else:
+                for protocol, low, high, _ in field:
+                    mask &= _covering(masks[index].get(protocol),
+                                      any_masks[index], low, high)
+                    if not mask:
+                        return 0
+            if not mask:
+                return 0
+        return mask
+
+    def analyze(self):
+        """
+        Analyze the policy. The policy is compiled first if the evaluator
+        has not compiled it.
+
+        :return: generator of findings in rule order
+        :rtype: RuleFinding
+        """
+        evaluator = self.evaluator
+        if not evaluator._compiled:
+            evaluator.compile()
+        rules = [rule for rule in evaluator.rules if rule.resolved and
+                 (rule.sources == ANY or rule.sources) and
+                 (rule.destinations == ANY or rule.destinations) and
+                 (rule.services == ANY or rule.services)]
+        terminal = [rule for rule in rules
+                    if rule.action not in NON_TERMINAL_ACTIONS]
+        masks, any_masks = self._index(terminal)
+
+        counts = collections.Counter()
+        for rule in rules:
+            if rule.action not in NON_TERMINAL_ACTIONS:
+                covered = self._covered_by(rule, masks, any_masks)
+                if covered:
+                    first = evaluator.rules[
+                        (covered & -covered).bit_length() - 1]
+                    kind = 'redundant' if first.action == rule.action \
+                        else 'shadowed'
+                    counts[kind] += 1
+                    yield RuleFinding(kind, rule, first)
+                    continue
+            if self.is_broad(rule):
+                counts['broad'] += 1
+                yield RuleFinding('broad', rule, None)
+        logger.debug('Rule analysis of %s complete: %s', evaluator.policy.name,
+            dict(counts))
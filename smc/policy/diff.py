@@ -0,0 +1,323 @@
+"""
+.. versionadded:: 0.6.2
+
+Compare the rules of two states of a policy.
+
+A :class:`PolicySnapshot` holds the rules of each rule collection of a policy
+in order. Snapshots are taken from a live policy, or loaded from a file saved
+by a previous snapshot, and compared with :func:`diff_policies`::
+
+    >>> from smc.policy.diff import PolicySnapshot, diff_policies
+    >>> before = PolicySnapshot.load('/var/backups/corporate-20180101.zip')
+    >>> result = diff_policies(before, FirewallPolicy('Corporate'))
+    >>> result
+    PolicyDiff(added=2, removed=1, moved=1, modified=3)
+    >>> for change in result.modified:
+    ...   print(change.name, change.changes)
+    allow web [Change(path='destinations.dst', kind='added', old=None, new='/elements/host/707')]
+
+To keep a history of a policy, save a snapshot after each change. Snapshots
+are saved as JSON lines, or as a zip archive containing the JSON lines file if
+the filename ends with ``.zip``::
+
+    >>> PolicySnapshot.from_policy(FirewallPolicy('Corporate')).save(
+    ...     '/var/backups/corporate-20180102.zip')
+
+Rule json is normalized as done by :class:`smc.administration.export.JSONExporter`,
+``link`` entries are removed and hrefs are made relative to the SMC API url.
+The ``rank`` of a rule changes when other rules are inserted before it, so it
+is not compared; the position of the rule in its collection is used instead.
+
+Rules are matched by rule tag within each rule collection. Matching and
+comparing are done with dicts, and moved rules are found from the longest
+sequence of matched rules that kept their relative order, so policies with
+many thousands of rules are compared in close to linear time. A rule is
+reported as moved only when its position relative to the other rules changed,
+inserting or removing rules before it does not move it. A rule can be both
+moved and modified.
+
+.. note:: Engine snapshots and policy exports created by the SMC are XML
+    archives and can not be loaded. Use :meth:`PolicySnapshot.save` to keep
+    snapshots that can be compared.
+"""
+import os
+import json
+import bisect
+import logging
+import zipfile
+import collections
+from smc import session
+from smc.administration.export import normalize
+from smc.base.diff import diff, ADDED, REMOVED
+from smc.base.pool import DEFAULT_WORKERS
+from smc.base.util import replace_file
+from smc.compat import string_types
+
+logger = logging.getLogger(__name__)
+
+
+#: Keys removed from rule json before comparing
+VOLATILE_KEYS = ('link', 'rank')
+
+
+def _base_url():
+    return '%s/%s' % (session.url, session.api_version) \
+        if session.url else None
+
+
+def _rule_key(rule):
+    return rule.get('tag') or rule['href']
+
+
+def field_changes(old, new):
+    """
+    Compare two versions of rule json. Unlike :func:`smc.base.diff.diff`,
+    keys only present in the old version are reported as removed.
+
+    :param dict old: previous rule json
+    :param dict new: current rule json
+    :rtype: list(Change)
+    """
+    changes = diff(old, new)
+    # Comparing in reverse reports removed keys as added. Removed list
+    # items are reported by both comparisons.
+    reported = set((change.path, repr(change.old)) for change in changes
+                   if change.kind == REMOVED)
+    changes.extend(change._replace(kind=REMOVED, old=change.new, new=None)
+                   for change in diff(new, old) if change.kind == ADDED and
+                   (change.path, repr(change.new)) not in reported)
+    return changes
+
+
+def _stable(positions):
+    """
+    Indexes of the longest increasing subsequence of positions. Items
+    not in the subsequence changed their relative order.
+    """
+    tails, tail_index = [], []
+    previous = [None] * len(positions)
+    for index, position in enumerate(positions):
+        slot = bisect.bisect_left(tails, position)
+        if slot == len(tails):
+            tails.append(position)
+            tail_index.append(index)
+        else:
+            tails[slot] = position
+            tail_index[slot] = index
+        previous[index] = tail_index[slot - 1] if slot else None
+    stable = set()
+    index = tail_index[-1] if tail_index else None
+    while index is not None:
+        stable.add(index)
+        index = previous[index]
+    return stable
+
+
+class PolicySnapshot(object):
+    """
+    Rules of a policy at a point in time.
+
+    :param str name: name of the policy
+    :param dict rules: mapping of rule collection name, i.e.
+        'fw_ipv4_access_rules', to the list of rules in order. Each rule is
+        a dict with the rule tag, name, href and normalized json as data
+    """
+    def __init__(self, name, rules):
+        self.name = name
+        self.rules = rules
+
+    def __len__(self):
+        return sum(len(rules) for rules in self.rules.values())
+
+    def __repr__(self):
+        return 'PolicySnapshot(name=%s, rules=%s)' % (self.name, len(self))
+
+    @classmethod
+    def from_policy(cls, policy, rule_types=None, max_workers=DEFAULT_WORKERS):
+        """
+        Take a snapshot of a live policy. The rules of each collection are
+        loaded concurrently.
+
+        :param Policy policy: policy to snapshot
+        :param tuple rule_types: rule collections to include, by default
+            every rule collection of the policy
+        :param int max_workers: maximum number of concurrent requests
+        :rtype: PolicySnapshot
+        """
+        if rule_types is None:
+            rule_types = sorted(rel for rel in policy.data.links
+                                if rel.endswith('_rules') and
+                                hasattr(type(policy), rel))
+        base_url = _base_url()
+        rules = {}
+        for rule_type in rule_types:
+            collection = getattr(policy, rule_type)
+            rules[rule_type] = [
+                {'tag': rule.data.get('tag'), 'name': rule.name,
+                 'href': normalize(rule.href, base_url),
+                 'data': normalize(rule.data.data, base_url, VOLATILE_KEYS)}
+                for rule in collection.prefetch(max_workers=max_workers)]
+        snapshot = cls(policy.name, rules)
+        logger.debug('Policy snapshot taken: %s', snapshot)
+        return snapshot
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a snapshot saved with :meth:`save`. Zip archives are read
+        from the first JSON lines file in the archive.
+
+        :param str filename: name of .jsonl or .zip file
+        :raises IOError: failure reading the file
+        :raises ValueError: invalid file
+        :rtype: PolicySnapshot
+        """
+        if filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(filename) as archive:
+                members = [name for name in archive.namelist()
+                           if name.endswith('.jsonl')]
+                if not members:
+                    raise ValueError('No policy snapshot found in archive: %s'
+                        % filename)
+                lines = archive.read(members[0]).decode('utf-8').splitlines()
+        else:
+            with open(filename, 'r') as f:
+                lines = f.readlines()
+        name, rules = None, collections.OrderedDict()
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'policy' in record:
+                name = record['policy']
+                continue
+            rules.setdefault(record.pop('type'), []).append(record)
+        for records in rules.values():
+            records.sort(key=lambda r: r['position'])
+            for record in records:
+                del record['position']
+        return cls(name, dict(rules))
+
+    def save(self, filename):
+        """
+        Save the snapshot as JSON lines. If the filename ends with .zip,
+        the JSON lines file is saved in a zip archive.
+
+        :param str filename: name of file to save to
+        :raises IOError: failure writing the file
+        :return: None
+        """
+        lines = [json.dumps({'policy': self.name})]
+        for rule_type in sorted(self.rules):
+            for position, rule in enumerate(self.rules[rule_type]):
+                lines.append(json.dumps(dict(rule, type=rule_type,
+                    position=position), sort_keys=True))
+        content = '\n'.join(lines) + '\n'
+        tmp = filename + '.tmp'
+        if filename.lower().endswith('.zip'):
+            member = os.path.basename(filename)[:-4] + '.jsonl'
+            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(member, content)
+        else:
+            with open(tmp, 'w') as f:
+                f.write(content)
+        replace_file(tmp, filename)
+
+
+class RuleChange(collections.namedtuple(
+        'RuleChange', 'kind rule_type tag name old_position new_position changes')):
+    """
+    A rule that was added, removed, moved or modified.
+
+    :ivar str kind: 'added', 'removed', 'moved' or 'modified'
+    :ivar str rule_type: rule collection of the rule, i.e.
+        'fw_ipv4_access_rules'
+    :ivar str tag: rule tag
+    :ivar str name: name of the rule, in the new state unless removed
+    :ivar int old_position: position in the old state, None if added
+    :ivar int new_position: position in the new state, None if removed
+    :ivar list changes: for modified rules, the :class:`~smc.base.diff.Change`
+        of each field
+    """
+    __slots__ = ()
+
+
+class PolicyDiff(collections.namedtuple(
+        'PolicyDiff', 'added removed moved modified')):
+    """
+    Differences between two states of a policy. Each attribute is a
+    list of :class:`RuleChange` ordered by rule collection and position.
+    """
+    __slots__ = ()
+
+    @property
+    def changed(self):
+        """
+        Whether any rule was added, removed, moved or modified
+
+        :rtype: bool
+        """
+        return any(self)
+
+    def __repr__(self):
+        return 'PolicyDiff(added=%s, removed=%s, moved=%s, modified=%s)' % (
+            len(self.added), len(self.removed), len(self.moved),
+            len(self.modified))
+
+
+def _snapshot(policy, max_workers):
+    if isinstance(policy, PolicySnapshot):
+        return policy
+    if isinstance(policy, string_types):
+        return PolicySnapshot.load(policy)
+    return PolicySnapshot.from_policy(policy, max_workers=max_workers)
+
+
+def diff_policies(old, new, max_workers=DEFAULT_WORKERS):
+    """
+    Compare two states of a policy. Each state is a :class:`PolicySnapshot`,
+    the filename of a saved snapshot, or a live policy.
+
+    :param old: previous state of the policy
+    :param new: current state of the policy
+    :param int max_workers: maximum number of concurrent requests when
+        taking snapshots of live policies
+    :raises IOError: failure reading a snapshot file
+    :rtype: PolicyDiff
+    """
+    old, new = _snapshot(old, max_workers), _snapshot(new, max_workers)
+    added, removed, moved, modified = [], [], [], []
+    for rule_type in sorted(set(old.rules) | set(new.rules)):
+        old_rules = old.rules.get(rule_type, [])
+        new_rules = new.rules.get(rule_type, [])
+        old_index = {_rule_key(rule): position
+                     for position, rule in enumerate(old_rules)}
+        new_keys = set()
+        matched = []  # (old position, new position)
+        for position, rule in enumerate(new_rules):
+            key = _rule_key(rule)
+            new_keys.add(key)
+            if key not in old_index:
+                added.append(RuleChange('added', rule_type, rule.get('tag'),
+                    rule.get('name'), None, position, []))
+                continue
+            matched.append((old_index[key], position))
+            changes = field_changes(old_rules[old_index[key]]['data'],
+                                    rule['data'])
+            if changes:
+                modified.append(RuleChange('modified', rule_type,
+                    rule.get('tag'), rule.get('name'), old_index[key],
+                    position, changes))
+        for position, rule in enumerate(old_rules):
+            if _rule_key(rule) not in new_keys:
+                removed.append(RuleChange('removed', rule_type, rule.get('tag'),
+                    rule.get('name'), position, None, []))
+        stable = _stable([old_position for old_position, _ in matched])
+        for index, (old_position, position) in enumerate(matched):
+            if index not in stable:
+                rule = new_rules[position]
+                moved.append(RuleChange('moved', rule_type, rule.get('tag'),
+                    rule.get('name'), old_position, position, []))
+    result = PolicyDiff(added, removed, moved, modified)
+    logger.debug('Policy diff of %s complete: %s', new.name, result)
+    return result
@@ -0,0 +1,645 @@
+"""
+.. versionadded:: 0.6.2
+
+Offline evaluation of firewall access rules.
+
+A :class:`PolicyEvaluator` compiles the access rules of a policy into local
+interval structures and returns the first rule that matches a connection,
+without sending a request to the SMC for each connection. This can be used
+to validate a set of expected connections against a policy before a change
+is installed::
+
+    >>> from smc.policy.evaluator import PolicyEvaluator
+    >>> evaluator = PolicyEvaluator(FirewallPolicy('Corporate'))
+    >>> evaluator.compile()
+    PolicyEvaluator(policy=Corporate, rules=10233, unresolved=12)
+    >>> match = evaluator.evaluate('10.1.1.10', '192.168.5.20', 'tcp', 443)
+    >>> match
+    Match(rule=IPv4Rule(name=web access), action=allow, uncertain=False)
+    >>> match.rule.path
+    (IPv4Rule(name=jump to web),)
+
+Rules are compiled in the order the engine evaluates them. Rules of the
+policy template (and its template) are placed around the policy rules at
+the template insert point. Jump rules are expanded to the rules of the sub
+policy, each restricted to the sources, destinations and services of the
+jump rule, so the first matching compiled rule is the rule the engine would
+apply. Disabled rules and rule sections are skipped. Rules with the
+``continue`` action never terminate matching and are reported on the match.
+
+Sources and destinations are compiled from hosts, routers, networks,
+address ranges and groups of these; services from TCP, UDP, IP and ICMP
+services and service groups. A rule referencing other elements (i.e. zones,
+expressions, aliases, domain names or applications) cannot be evaluated
+offline. Such rules are listed in :attr:`PolicyEvaluator.unresolved` and are
+never matched; a match found after an unresolved rule is flagged as
+``uncertain``.
+
+For each field, the compiled ranges of every rule are split into non
+overlapping segments, each holding a bit mask of the rules covering the
+segment. Evaluating a connection is a binary search per field and a bitwise
+and of the masks, where the lowest set bit is the first matching rule.
+
+The :class:`ElementCompiler` used to compile elements caches the compiled
+value of each element and can be shared between evaluators. Elements are
+resolved through :func:`smc.base.cache.shared_resolver`.
+"""
+import bisect
+import logging
+import collections
+from smc.base.cache import shared_resolver, RULE_FIELDS
+from smc.base.model import Element
+from smc.base.pool import DEFAULT_WORKERS
+from smc.elements.ip_index import ip_range, ip_to_int, element_addresses, \
+    ADDRESS_FIELDS
+from smc.compat import string_types
+
+logger = logging.getLogger(__name__)
+
+
+#: Value of a rule field that matches any address or service
+ANY = 'any'
+
+#: Protocol numbers by name
+PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17, 'icmpv6': 58, 'ipv6-icmp': 58}
+
+#: Rule actions that do not terminate rule matching
+NON_TERMINAL_ACTIONS = ('continue',)
+
+_PORTS = (0, 65535)
+
+
+def is_insert_point(data):
+    """
+    Whether template rule json is the insert point for the rules of
+    policies based on the template.
+
+    :param dict data: rule json
+    :rtype: bool
+    """
+    if data.get('insert_point'):
+        return True
+    for field in ('name', 'comment'):
+        value = data.get(field)
+        if isinstance(value, string_types) and \
+                value.strip().lower() == 'insert point':
+            return True
+    return False
+
+
+def rule_action(data):
+    """
+    Return the action of rule json, i.e. 'allow', 'discard' or 'jump'.
+
+    :param dict data: rule json
+    :rtype: str
+    """
+    action = (data.get('action') or {}).get('action')
+    if isinstance(action, list):  # SMC >= 6.6 allows multiple actions
+        action = action[0] if action else None
+    return action
+
+
+def intersect_addresses(first, second):
+    """
+    Intersect two compiled address fields.
+
+    :param first: ANY, None (unresolved) or tuple of (family, first, last)
+    :param second: ANY, None (unresolved) or tuple of (family, first, last)
+    :return: compiled address field
+    """
+    if first is None or second is None:
+        return None
+    if first == ANY:
+        return second
+    if second == ANY:
+        return first
+    return tuple((family, max(lo, lo2), min(hi, hi2))
+                 for family, lo, hi in first
+                 for family2, lo2, hi2 in second
+                 if family == family2 and max(lo, lo2) <= min(hi, hi2))
+
+
+def _intersect_range(first, second):
+    if first is None:
+        return second
+    if second is None:
+        return first
+    low, high = max(first[0], second[0]), min(first[1], second[1])
+    return (low, high) if low <= high else False
+
+
+def intersect_services(first, second):
+    """
+    Intersect two compiled service fields.
+
+    :param first: ANY, None (unresolved) or tuple of (protocol, dst_low,
+        dst_high, src_range), src_range is None or tuple of (low, high)
+    :param second: compiled service field
+    :return: compiled service field
+    """
+    if first is None or second is None:
+        return None
+    if first == ANY:
+        return second
+    if second == ANY:
+        return first
+    services = []
+    for protocol, low, high, src in first:
+        for protocol2, low2, high2, src2 in second:
+            if protocol != protocol2:
+                continue
+            dst = _intersect_range((low, high), (low2, high2))
+            src_range = _intersect_range(src, src2)
+            if dst and src_range is not False:
+                services.append((protocol, dst[0], dst[1], src_range))
+    return tuple(services)
+
+
+class ElementCompiler(object):
+    """
+    Compile network and service elements to address and port ranges.
+    Compiled values are cached by href.
+
+    :param ElementResolver resolver: resolver used to load elements,
+        defaults to the shared resolver
+    """
+    def __init__(self, resolver=None):
+        self.resolver = resolver or shared_resolver()
+        self._loaded = set()
+        self._addresses = {}
+        self._services = {}
+
+    def load(self, hrefs):
+        """
+        Load the elements and all members of groups concurrently so they
+        can be compiled without further requests.
+
+        :param list hrefs: hrefs of elements
+        :return: None
+        """
+        pending = set(href for href in hrefs if href not in self._loaded)
+        while pending:
+            elements = self.resolver.resolve_many(list(pending), load=True)
+            self._loaded.update(pending)
+            members = set()
+            for element in elements:
+                data = self._data(element)
+                if data and element.typeof.endswith('group'):
+                    members.update(data.get('element') or ())
+            pending = members - self._loaded
+
+    def load_rules(self, rules):
+        """
+        Load the elements referenced by the sources, destinations and
+        services of the rules.
+
+        :param list rules: rules
+        :return: None
+        """
+        hrefs = set()
+        for rule in rules:
+            for field, key in RULE_FIELDS:
+                hrefs.update((rule.data.get(field) or {}).get(key, ()))
+        self.load(hrefs)
+
+    @staticmethod
+    def _data(element):
+        try:
+            return element.data if element is not None else None
+        except Exception as e:
+            logger.debug('Failed loading element: %s, %s', element, e)
+            return None
+
+    def _members(self, data, compile_member):
+        values = []
+        for href in data.get('element') or ():
+            value = compile_member(href)
+            if value is None:
+                return None
+            if value == ANY:
+                return ANY
+            values.extend(value)
+        return tuple(values)
+
+    def addresses(self, href):
+        """
+        Compile a network element.
+
+        :param str href: href of element
+        :return: ANY, tuple of (family, first, last), or None if the
+            element cannot be compiled
+        """
+        if href in self._addresses:
+            return self._addresses[href]
+        self._addresses[href] = None  # Guard against group cycles
+        element = self.resolver.resolve(href)
+        data = self._data(element)
+        value = None
+        if data is None:
+            pass
+        elif element.typeof in ADDRESS_FIELDS:
+            try:
+                value = tuple(ip_range(address) for address in
+                              element_addresses(element.typeof, data))
+            except ValueError:
+                value = None
+        elif element.typeof == 'group':
+            value = self._members(data, self.addresses)
+        self._addresses[href] = value
+        return value
+
+    def services(self, href):
+        """
+        Compile a service element.
+
+        :param str href: href of element
+        :return: ANY, tuple of (protocol, dst_low, dst_high, src_range),
+            or None if the element cannot be compiled
+        """
+        if href in self._services:
+            return self._services[href]
+        self._services[href] = None
+        element = self.resolver.resolve(href)
+        data = self._data(element)
+        value = None
+        typeof = element.typeof if element is not None else None
+        if data is None:
+            pass
+        elif typeof in ('tcp_service', 'udp_service'):
+            protocol = PROTOCOLS[typeof.split('_')[0]]
+            dst = self._port_range(data, 'dst') or _PORTS
+            value = ((protocol, dst[0], dst[1], self._port_range(data, 'src')),)
+        elif typeof == 'ip_service':
+            try:
+                value = ((int(data.get('protocol_number')),) + _PORTS + (None,),)
+            except (TypeError, ValueError):
+                value = None
+        elif typeof in ('icmp_service', 'icmp_ipv6_service'):
+            protocol = 1 if typeof == 'icmp_service' else 58
+            icmp_type = data.get('icmp_type')
+            if icmp_type in (None, ''):
+                value = ((protocol, 0, 255, None),)
+            else:
+                value = ((protocol, int(icmp_type), int(icmp_type), None),)
+        elif typeof is not None and typeof.endswith('service_group'):
+            value = self._members(data, self.services)
+        self._services[href] = value
+        return value
+
+    @staticmethod
+    def _port_range(data, prefix):
+        low = data.get('min_%s_port' % prefix)
+        if low in (None, ''):
+            return None
+        high = data.get('max_%s_port' % prefix)
+        return (int(low), int(high) if high not in (None, '') else int(low))
+
+    def field(self, value, key, compile_element):
+        """
+        Compile a rule field, i.e. the ``sources`` json of a rule.
+
+        :param dict value: field json
+        :param str key: key of the element list, i.e. 'src'
+        :param compile_element: :meth:`addresses` or :meth:`services`
+        :return: ANY, tuple of compiled values, or None if an element in
+            the field cannot be compiled
+        """
+        value = value or {}
+        if value.get('any'):
+            return ANY
+        compiled = []
+        for href in value.get(key) or ():
+            element = compile_element(href)
+            if element is None:
+                return None
+            if element == ANY:
+                return ANY
+            compiled.extend(element)
+        return tuple(compiled)
+
+
+class CompiledRule(collections.namedtuple(
+        'CompiledRule', 'position rule action sources destinations services path')):
+    """
+    A rule in evaluation order.
+
+    :ivar int position: position of the rule in evaluation order
+    :ivar Element rule: the rule
+    :ivar str action: rule action
+    :ivar sources: compiled sources
+    :ivar destinations: compiled destinations
+    :ivar services: compiled services
+    :ivar tuple path: jump rules leading to this rule for rules in a
+        sub policy, otherwise empty
+    """
+    __slots__ = ()
+
+    @property
+    def resolved(self):
+        """
+        Whether every element in the rule could be compiled
+
+        :rtype: bool
+        """
+        return None not in (self.sources, self.destinations, self.services)
+
+    def __repr__(self):
+        return 'CompiledRule(position=%s, rule=%s, action=%s)' % (
+            self.position, self.rule, self.action)
+
+
+class Match(collections.namedtuple('Match', 'rule continued uncertain')):
+    """
+    Result of evaluating a connection.
+
+    :ivar CompiledRule rule: first matching rule
+    :ivar list continued: rules with a continue action matched before
+        the rule
+    :ivar list uncertain: rules before the matching rule that could not
+        be evaluated; if any of these match the connection, the result
+        may differ on the engine
+    """
+    __slots__ = ()
+
+    @property
+    def action(self):
+        return self.rule.action
+
+    def __repr__(self):
+        return 'Match(rule=%s, action=%s, uncertain=%s)' % (
+            self.rule.rule, self.rule.action, bool(self.uncertain))
+
+
+class IntervalMasks(object):
+    """
+    Non overlapping segments of integer ranges, each holding a bit mask
+    of the ranges covering the segment.
+
+    :param list entries: list of tuple (first, last, bit)
+    """
+    def __init__(self, entries):
+        events = collections.defaultdict(list)
+        for first, last, bit in entries:
+            events[first].append((bit, 1))
+            events[last + 1].append((bit, -1))
+        counts = collections.defaultdict(int)
+        mask = 0
+        self.starts, self.masks = [], []
+        for position in sorted(events):
+            for bit, delta in events[position]:
+                before = counts[bit]
+                counts[bit] += delta
+                if (before == 0) != (counts[bit] == 0):
+                    mask ^= 1 << bit
+            self.starts.append(position)
+            self.masks.append(mask)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, value):
+        """
+        Return the mask of ranges containing the value
+
+        :param int value: value
+        :rtype: int
+        """
+        index = bisect.bisect_right(self.starts, value) - 1
+        return self.masks[index] if index >= 0 else 0
+
+
+def _address(value):
+    if isinstance(value, tuple):
+        return value
+    return ip_to_int(value)
+
+
+def _protocol(value):
+    if isinstance(value, string_types):
+        try:
+            return PROTOCOLS[value.lower()]
+        except KeyError:
+            return int(value)
+    return value
+
+
+class PolicyEvaluator(object):
+    """
+    Evaluate connections against the access rules of a policy.
+
+    :param Policy policy: policy to evaluate, i.e. FirewallPolicy
+    :param str rule_type: name of the rule collection of the policy
+        (default: 'fw_ipv4_access_rules')
+    :param ElementCompiler compiler: compiler for elements, provide a
+        compiler to share compiled elements between evaluators
+    :param insert_point: callable taking template rule json and
+        returning True for the insert point of the template
+    :param int max_workers: maximum number of concurrent requests used
+        to load rules
+    """
+    def __init__(self, policy, rule_type='fw_ipv4_access_rules', compiler=None,
+                 insert_point=is_insert_point, max_workers=DEFAULT_WORKERS):
+        self.policy = policy
+        self.rule_type = rule_type
+        self.compiler = compiler or ElementCompiler()
+        self.insert_point = insert_point
+        self.max_workers = max_workers
+        self.rules = []
+        self._compiled = False
+
+    def __repr__(self):
+        if not self._compiled:
+            return 'PolicyEvaluator(policy=%s)' % self.policy.name
+        return 'PolicyEvaluator(policy=%s, rules=%s, unresolved=%s)' % (
+            self.policy.name, len(self.rules), len(self.unresolved))
+
+    @property
+    def unresolved(self):
+        """
+        Rules that reference elements that cannot be evaluated
+
+        :rtype: list(CompiledRule)
+        """
+        return [rule for rule in self.rules if not rule.resolved]
+
+    def _load(self, policy):
+        collection = getattr(policy, self.rule_type)
+        rules = list(collection.prefetch(max_workers=self.max_workers))
+        self.compiler.load_rules(rules)
+        return rules
+
+    def policy_rules(self, policy):
+        """
+        Return the rules of the policy in evaluation order, including
+        the rules of its templates.
+
+        :param Policy policy: policy or template policy
+        :rtype: list
+        """
+        rules = self._load(policy)
+        template = policy.data.get('template')
+        if not template:
+            return rules
+        template_rules = self.policy_rules(Element.from_href(template))
+        for index, rule in enumerate(template_rules):
+            if self.insert_point(rule.data):
+                return template_rules[:index] + rules + template_rules[index + 1:]
+        logger.warning('No insert point found in template %s, policy rules '
+            'are evaluated after the template rules', template)
+        return template_rules + rules
+
+    def _flatten(self, rules, conditions, path, compiled):
+        compiler = self.compiler
+        for rule in rules:
+            data = rule.data
+            if data.get('is_disabled') or 'sources' not in data:
+                continue
+            action = rule_action(data)
+            fields = (
+                compiler.field(data.get('sources'), 'src', compiler.addresses),
+                compiler.field(data.get('destinations'), 'dst', compiler.addresses),
+                compiler.field(data.get('services'), 'service', compiler.services))
+            if conditions is not None:
+                fields = (intersect_addresses(conditions[0], fields[0]),
+                          intersect_addresses(conditions[1], fields[1]),
+                          intersect_services(conditions[2], fields[2]))
+            sub_policy = (data.get('action') or {}).get('sub_policy')
+            if action == 'jump' and sub_policy and None not in fields and \
+                    sub_policy not in [p.data['action'].get('sub_policy') for p in path]:
+                sub_rules = self._load(Element.from_href(sub_policy))
+                self._flatten(sub_rules, fields, path + (rule,), compiled)
+                continue
+            compiled.append(CompiledRule(len(compiled), rule, action,
+                                         fields[0], fields[1], fields[2], path))
+
+    def compile(self):
+        """
+        Load and compile the rules of the policy. This is called by
+        :meth:`evaluate` if the policy has not been compiled. Call again
+        to recompile after the policy has changed.
+
+        :rtype: PolicyEvaluator
+        """
+        compiled = []
+        self._flatten(self.policy_rules(self.policy), None, (), compiled)
+        self.rules = compiled
+
+        sources, destinations = collections.defaultdict(list), \
+            collections.defaultdict(list)
+        services = collections.defaultdict(list)
+        self._src_constrained = []
+        self._any = [0, 0, 0]
+        self._terminal = self._continue = 0
+        for rule in compiled:
+            if not rule.resolved:
+                continue
+            bit = 1 << rule.position
+            if rule.action in NON_TERMINAL_ACTIONS:
+                self._continue |= bit
+            else:
+                self._terminal |= bit
+            for index, (field, entries) in enumerate((
+                    (rule.sources, sources), (rule.destinations, destinations))):
+                if field == ANY:
+                    self._any[index] |= bit
+                else:
+                    for family, first, last in field:
+                        entries[family].append((first, last, rule.position))
+            if rule.services == ANY:
+                self._any[2] |= bit
+            else:
+                for protocol, low, high, src in rule.services:
+                    if src is None:
+                        services[protocol].append((low, high, rule.position))
+                    else:
+                        self._src_constrained.append(
+                            (protocol, low, high, src[0], src[1], bit))
+
+        self._sources = {family: IntervalMasks(entries)
+                         for family, entries in sources.items()}
+        self._destinations = {family: IntervalMasks(entries)
+                              for family, entries in destinations.items()}
+        self._services = {protocol: IntervalMasks(entries)
+                          for protocol, entries in services.items()}
+        self._unresolved = [rule.position for rule in compiled
+                            if not rule.resolved]
+        self._compiled = True
+        logger.debug('Compiled policy: %s', self)
+        return self
+
+    def _service_mask(self, protocol, dst_port, src_port):
+        port = dst_port if dst_port is not None else 0
+        mask = self._any[2]
+        masks = self._services.get(protocol)
+        if masks is not None:
+            mask |= masks.lookup(port)
+        if src_port is not None:
+            for proto, low, high, src_low, src_high, bit in self._src_constrained:
+                if proto == protocol and low <= port <= high and \
+                        src_low <= src_port <= src_high:
+                    mask |= bit
+        return mask
+
+    def evaluate(self, source, destination, protocol, dst_port=None,
+                 src_port=None):
+        """
+        Return the first rule matching the connection.
+        ::
+
+            >>> evaluator.evaluate('10.0.0.1', '172.16.0.10', 'udp', 53)
+            Match(rule=IPv4Rule(name=dns), action=allow, uncertain=False)
+
+        :param str source: source IP address, or tuple of (family, int)
+        :param str destination: destination IP address, or tuple of
+            (family, int)
+        :param protocol: protocol name ('tcp', 'udp', 'icmp') or number
+        :param int dst_port: destination port, or ICMP type
+        :param int src_port: source port, only required to match services
+            restricted by source port
+        :raises ValueError: invalid address or protocol
+        :return: the match, or None if no rule matches the connection
+        :rtype: Match
+        """
+        if not self._compiled:
+            self.compile()
+        family, address = _address(source)
+        masks = self._sources.get(family)
+        mask = self._any[0] | (masks.lookup(address) if masks else 0)
+        if not mask:
+            return None
+        family, address = _address(destination)
+        masks = self._destinations.get(family)
+        mask &= self._any[1] | (masks.lookup(address) if masks else 0)
+        if not mask:
+            return None
+        mask &= self._service_mask(_protocol(protocol), dst_port, src_port)
+        terminal = mask & self._terminal
+        if not terminal:
+            return None
+        position = (terminal & -terminal).bit_length() - 1
+        continued = []
+        bits = mask & self._continue & ((1 << position) - 1)
+        while bits:
+            lowest = bits & -bits
+            continued.append(self.rules[lowest.bit_length() - 1])
+            bits ^= lowest
+        uncertain = self._unresolved[:bisect.bisect_left(
+            self._unresolved, position)]
+        return Match(self.rules[position], continued,
+                     [self.rules[p] for p in uncertain])
+
+    def evaluate_many(self, connections):
+        """
+        Evaluate many connections. Each connection is a tuple of the
+        arguments to :meth:`evaluate`.
+
+        :param connections: iterable of tuple (source, destination,
+            protocol, dst_port[, src_port])
+        :return: generator of tuple (connection, Match or None)
+        """
+        if not self._compiled:
+            self.compile()
+        evaluate = self.evaluate
+        for connection in connections:
+            yield connection, evaluate(*connection)
@@ -0,0 +1,492 @@
+"""
+.. versionadded:: 0.6.2
+
+Local search index of the rules of all policies.
+
+:meth:`smc.policy.policy.Policy.search_rule` searches the rules of a single
+policy on the SMC. Finding every rule that references an element requires
+searching each policy. A :class:`RuleIndex` retrieves the rules of all
+policies concurrently and indexes rule names, tags, comments and the hrefs
+and names of referenced elements, so these queries are answered locally::
+
+    >>> from smc.policy.index import RuleIndex
+    >>> index = RuleIndex('/var/tmp/smc-rules.json')
+    >>> index.build()
+    RuleIndex(policies=42, rules=18340, elements=9120)
+    >>> index.save()
+    >>> for rule in index.referencing(Host('web01')):
+    ...   print(rule.policy_name, rule.position, rule.name)
+    Corporate 12 allow web
+    Branch Template 3 web servers
+    >>> index.search('legacy ftp')
+    [IndexedRule(name=legacy ftp, policy=Corporate, position=57)]
+
+Once saved, the index is loaded from disk when created. Call
+:meth:`RuleIndex.refresh` to update the index with changes made since it was
+built. Rule collections are listed again to find added, removed and moved
+rules, and each indexed rule is checked for changes by ETag, so only rules
+that changed are retrieved. Referenced elements are also checked by ETag so
+renamed elements are found by their new name::
+
+    >>> index.refresh()
+    IndexRefresh(added=3, removed=1, updated=5)
+
+Elements can be provided as an element, href or name. To also find rules that
+reference an element through a group, provide a
+:class:`smc.administration.references.ReferenceGraph`::
+
+    >>> index.referencing(Host('web01'), graph=graph)
+"""
+import os
+import re
+import json
+import logging
+import collections
+from smc.administration.references import element_hrefs
+from smc.api.common import SMCRequest
+from smc.api.exceptions import FetchElementFailed
+from smc.base.cache import conditional_fetch
+from smc.base.collection import ElementCollection
+from smc.base.model import Element
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+from smc.base.util import replace_file
+from smc.compat import string_types
+
+logger = logging.getLogger(__name__)
+
+
+#: Policy types indexed by default
+DEFAULT_POLICY_TYPES = ('fw_policy', 'fw_template_policy', 'sub_ipv4_fw_policy')
+
+#: Summary of an index refresh
+IndexRefresh = collections.namedtuple('IndexRefresh', 'added removed updated')
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+
+def terms(text):
+    """
+    Return the lower case search terms of text.
+
+    :param str text: text to split
+    :rtype: set
+    """
+    return set(_TERM.findall(text.lower())) if text else set()
+
+
+class IndexedRule(collections.namedtuple('IndexedRule',
+        'href name type tag comment policy policy_name rule_type position')):
+    """
+    A rule in the index.
+
+    :ivar str href: href of the rule
+    :ivar str name: name of the rule
+    :ivar str type: element type of the rule, i.e. fw_ipv4_access_rule
+    :ivar str tag: rule tag
+    :ivar str comment: rule comment
+    :ivar str policy: href of the policy containing the rule
+    :ivar str policy_name: name of the policy
+    :ivar str rule_type: rule collection of the rule, i.e.
+        fw_ipv4_access_rules
+    :ivar int position: position of the rule in the rule collection
+    """
+    __slots__ = ()
+
+    @property
+    def rule(self):
+        """
+        The rule element. The rule is not retrieved until its data
+        is accessed.
+
+        :rtype: Rule
+        """
+        return Element.from_meta(name=self.name, href=self.href, type=self.type)
+
+    def __repr__(self):
+        return 'IndexedRule(name=%s, policy=%s, position=%s)' % (
+            self.name, self.policy_name, self.position)
+
+
+class RuleIndex(object):
+    """
+    Inverted index of the rules of all policies of the given policy types.
+
+    :param str path: optional file used to save the index. If the file
+        exists, the index is loaded from it
+    :param tuple policy_types: policy types to index
+    :param int max_workers: maximum number of concurrent requests
+    """
+    def __init__(self, path=None, policy_types=DEFAULT_POLICY_TYPES,
+                 max_workers=DEFAULT_WORKERS):
+        self.path = path
+        self.policy_types = tuple(policy_types)
+        self.max_workers = max_workers
+        self._reset()
+        if path and os.path.exists(path):
+            self._load()
+
+    def _reset(self):
+        self._policies = {}         # policy href -> name
+        self._rules = {}            # rule href -> record
+        self._element_names = {}    # element href -> name
+        self._element_etags = {}    # element href -> etag
+        self._elements = {}         # element href -> set of rule hrefs
+        self._terms = {}            # term -> set of rule hrefs
+        self._named = {}            # lower case element name -> hrefs
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __repr__(self):
+        return 'RuleIndex(policies=%s, rules=%s, elements=%s)' % (
+            len(self._policies), len(self._rules), len(self._elements))
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            index = json.load(f)
+        self.policy_types = tuple(index.get('policy_types', self.policy_types))
+        self._policies = index['policies']
+        self._element_names = index['element_names']
+        self._element_etags = index.get('element_etags', {})
+        for name_href in self._element_names.items():
+            self._add_name(*name_href)
+        for href, record in index['rules'].items():
+            self._add(href, record)
+        logger.debug('Loaded rule index: %s, %s', self.path, self)
+
+    def save(self, path=None):
+        """
+        Save the index to disk.
+
+        :param str path: file to save to, defaults to the path provided
+            when the index was created
+        :raises IOError: failure writing the file
+        :return: None
+        """
+        path = path or self.path
+        index = {
+            'version': 1,
+            'policy_types': list(self.policy_types),
+            'policies': self._policies,
+            'rules': self._rules,
+            'element_names': self._element_names,
+            'element_etags': self._element_etags}
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        replace_file(tmp, path)
+
+    def _add_name(self, href, name):
+        if name:
+            self._named.setdefault(name.lower(), set()).add(href)
+
+    def _remove_name(self, href):
+        name = self._element_names.pop(href, None)
+        self._element_etags.pop(href, None)
+        if name:
+            hrefs = self._named.get(name.lower())
+            if hrefs is not None:
+                hrefs.discard(href)
+                if not hrefs:
+                    del self._named[name.lower()]
+
+    def _add(self, href, record):
+        self._rules[href] = record
+        for element in record['elements']:
+            self._elements.setdefault(element, set()).add(href)
+        for term in record['terms']:
+            self._terms.setdefault(term, set()).add(href)
+
+    def _remove(self, href):
+        record = self._rules.pop(href, None)
+        if record is None:
+            return
+        for key, index in (('elements', self._elements),
+                           ('terms', self._terms)):
+            for value in record[key]:
+                hrefs = index.get(value)
+                if hrefs is not None:
+                    hrefs.discard(href)
+                    if not hrefs:
+                        del index[value]
+
+    def _listing(self, policies):
+        """
+        Return the listed policies and whether the listing is complete.
+        """
+        if policies is not None:
+            return {policy.href: policy.name for policy in policies}, True
+        listed, complete = {}, True
+        for typeof in self.policy_types:
+            try:
+                for policy in ElementCollection(
+                        filter_context=typeof).paged():
+                    listed[policy.href] = policy.name
+            except FetchElementFailed as e:
+                logger.error('Failed listing policies of type: %s, rules of '
+                    'policies not listed are kept: %s', typeof, e)
+                complete = False
+        return listed, complete
+
+    def _collections(self, policy):
+        """
+        Return (rule_type, rule metas in order) for each rule collection
+        of the policy.
+        """
+        result = SMCRequest(href=policy).read()
+        if not result.json:
+            raise FetchElementFailed(result.msg)
+        listed = []
+        for link in result.json.get('link', []):
+            if link['rel'].endswith('_rules'):
+                rules = SMCRequest(href=link['href']).read()
+                if rules.msg:
+                    raise FetchElementFailed(rules.msg)
+                listed.append((link['rel'], rules.json or []))
+        return listed
+
+    def _fetch_rule(self, job):
+        href, etag = job
+        if etag:
+            return conditional_fetch(href, etag)
+        return SMCRequest(href=href).read()
+
+    def _resolve_names(self, hrefs):
+        """
+        Retrieve the names of elements. Elements with a known name are
+        only retrieved if they changed since the name was retrieved.
+        Returns the hrefs of elements that were renamed or removed.
+        """
+        def fetch(href):
+            etag = self._element_etags.get(href)
+            if href in self._element_names and etag:
+                return conditional_fetch(href, etag)
+            return SMCRequest(href=href).read()
+
+        changed = set()
+        for work in concurrent_map(fetch, hrefs, self.max_workers):
+            href, result = work.item, work.result
+            if not work.ok or result is None:
+                continue
+            name = (result.json or {}).get('name')
+            if href in self._element_names:
+                if name == self._element_names[href]:
+                    self._element_etags[href] = result.etag
+                    continue
+                self._remove_name(href)
+                changed.add(href)
+            if name:
+                self._element_names[href] = name
+                self._element_etags[href] = result.etag
+                self._add_name(href, name)
+        return changed
+
+    def _rule_terms(self, name, comment, tag, elements):
+        words = terms(name) | terms(comment)
+        if tag:
+            words.add(tag.lower())
+        for element in elements:
+            words |= terms(self._element_names.get(element))
+        return sorted(words)
+
+    def _record(self, meta, data, etag, policy, rule_type, position):
+        elements = sorted(element_hrefs(data))
+        return {'name': data.get('name', meta.get('name')),
+                'type': meta.get('type'), 'tag': data.get('tag'),
+                'comment': data.get('comment'), 'policy': policy,
+                'rule_type': rule_type, 'position': position, 'etag': etag,
+                'elements': elements, 'terms': self._rule_terms(
+                    data.get('name'), data.get('comment'), data.get('tag'),
+                    elements)}
+
+    def build(self, policies=None):
+        """
+        Build the index for the specified policies, or all policies of the
+        index policy types. Any existing index is replaced.
+
+        :param list policies: policies to index
+        :rtype: RuleIndex
+        """
+        self._reset()
+        self.refresh(policies)
+        logger.debug('Built rule index: %s', self)
+        return self
+
+    def refresh(self, policies=None):
+        """
+        Update the index with changes made since it was built. Policies of
+        the index policy types (or the policies provided) and their rule
+        collections are listed to find added, removed and moved rules.
+        Indexed rules are checked for changes by ETag, and only added and
+        changed rules are retrieved. Elements referenced by indexed rules
+        are checked for changes by ETag, and the terms of rules referencing
+        a renamed element are updated. If the policies cannot be listed
+        completely, policies that were not listed and their rules are kept.
+
+        :param list policies: policies to refresh. When provided, only
+            these policies are refreshed and other indexed policies are kept
+        :return: number of rules added, removed and updated
+        :rtype: IndexRefresh
+        """
+        listed, complete = self._listing(policies)
+        removed = updated = 0
+        if policies is None and complete:
+            for policy in [p for p in self._policies if p not in listed]:
+                del self._policies[policy]
+        self._policies.update(listed)
+
+        positions = {}  # rule href -> (meta, policy, rule_type, position)
+        failed = set()
+        for work in concurrent_map(self._collections, list(listed),
+                                   self.max_workers):
+            if not work.ok:
+                logger.error('Failed listing rules of policy: %s, %s',
+                    work.item, work.exception)
+                failed.add(work.item)
+                continue
+            for rule_type, metas in work.result:
+                for position, meta in enumerate(metas):
+                    positions[meta['href']] = (meta, work.item, rule_type,
+                                               position)
+
+        # Rules of policies that could not be listed are kept
+        stale = [href for href, record in self._rules.items()
+                 if href not in positions and record['policy'] not in failed
+                 and ((policies is None and complete) or
+                      record['policy'] in listed)]
+        for href in stale:
+            self._remove(href)
+            removed += 1
+
+        jobs = [(href, self._rules[href]['etag'] if href in self._rules
+                 else None) for href in positions]
+        fetched = []
+        for work in concurrent_map(self._fetch_rule, jobs, self.max_workers):
+            href, etag = work.item
+            if not work.ok:
+                logger.error('Failed retrieving rule: %s, %s', href,
+                    work.exception)
+                continue
+            if work.result is None:  # Unchanged, update position only
+                meta, policy, rule_type, position = positions[href]
+                self._rules[href].update(policy=policy, rule_type=rule_type,
+                                         position=position)
+            elif work.result.json:
+                fetched.append((href, work.result))
+
+        referenced = set(self._elements)
+        for _, result in fetched:
+            referenced.update(element_hrefs(result.json))
+        for href in [h for h in self._element_names if h not in referenced]:
+            self._remove_name(href)
+        renamed = self._resolve_names(list(referenced))
+
+        # Rules not retrieved again that reference a renamed element
+        fetched_hrefs = set(href for href, _ in fetched)
+        for href in set(rule for element in renamed
+                        for rule in self._elements.get(element, ())):
+            if href in fetched_hrefs:
+                continue
+            record = self._rules[href]
+            self._remove(href)
+            record['terms'] = self._rule_terms(record['name'],
+                record['comment'], record['tag'], record['elements'])
+            self._add(href, record)
+            updated += 1
+
+        added = 0
+        for href, result in fetched:
+            if href in self._rules:
+                self._remove(href)
+                updated += 1
+            else:
+                added += 1
+            meta, policy, rule_type, position = positions[href]
+            self._add(href, self._record(meta, result.json, result.etag,
+                                         policy, rule_type, position))
+        refresh = IndexRefresh(added, removed, updated)
+        logger.debug('Refreshed rule index: %s, %s', self, refresh)
+        return refresh
+
+    def _result(self, hrefs):
+        rules = []
+        for href in hrefs:
+            record = self._rules[href]
+            rules.append(IndexedRule(href, record['name'], record['type'],
+                record['tag'], record['comment'], record['policy'],
+                self._policies.get(record['policy']), record['rule_type'],
+                record['position']))
+        rules.sort(key=lambda r: (r.policy_name or '', r.rule_type, r.position))
+        return rules
+
+    def _element_hrefs(self, element):
+        if isinstance(element, Element):
+            return set([element.href])
+        if isinstance(element, string_types) and element.startswith('http'):
+            return set([element])
+        return set(self._named.get((element or '').lower(), ()))
+
+    def referencing(self, element, graph=None):
+        """
+        Return the rules of any policy that reference the element in any
+        field, i.e. sources, destinations, services or a jump to a sub
+        policy.
+
+        :param element: element, element href or element name. A name
+            matches every element with that name
+        :param ReferenceGraph graph: optional reference graph used to also
+            return rules referencing a group or other element that
+            references the element
+        :rtype: list(IndexedRule)
+        """
+        hrefs = self._element_hrefs(element)
+        if graph is not None:
+            for href in list(hrefs):
+                hrefs.update(e.href for e in graph.dependents(href))
+        rules = set()
+        for href in hrefs:
+            rules.update(self._elements.get(href, ()))
+        return self._result(rules)
+
+    def search(self, text):
+        """
+        Return the rules matching every term of the text. Terms are
+        matched against words in rule names, comments and tags, and in
+        the names of elements referenced by the rule.
+
+        :param str text: search text
+        :rtype: list(IndexedRule)
+        """
+        words = terms(text)
+        if not words:
+            return []
+        found = None
+        for word in sorted(words, key=lambda w: len(self._terms.get(w, ()))):
+            found = set(self._terms.get(word, ())) if found is None \
+                else found & self._terms.get(word, set())
+            if not found:
+                return []
+        return self._result(found)
+
+    def by_tag(self, tag):
+        """
+        Return the rule with the rule tag
+
+        :param str tag: rule tag
+        :rtype: IndexedRule or None
+        """
+        for rule in self._result(self._terms.get(tag.lower(), ())):
+            if rule.tag == tag:
+                return rule
+        return None
+
+    def policy_rules(self, policy):
+        """
+        Return the indexed rules of a policy in order
+
+        :param policy: policy or policy href
+        :rtype: list(IndexedRule)
+        """
+        href = getattr(policy, 'href', policy)
+        return self._result(h for h, record in self._rules.items()
+                            if record['policy'] == href)
@@ -43,6 +43,8 @@ from smc.policy.policy import Policy
 from smc.policy.rule import IPv4Rule, IPv6Rule
 from smc.policy.rule_nat import IPv4NATRule, IPv6NATRule
 from smc.base.collection import rule_collection
+from smc.base.pool import DEFAULT_WORKERS
+from smc.policy.rule_import import import_rules
 
                 
 class FirewallRule(object):
@@ -151,6 +153,40 @@ class FirewallPolicy(FirewallRule, Policy):
         except CreateElementFailed as err:
             raise CreatePolicyFailed(err)
 
+    def import_rules(self, rules, add_pos=None, after=None, before=None,
+                     max_workers=DEFAULT_WORKERS):
+        """
+        .. versionadded:: 0.6.2
+
+        Import many IPv4 access rules into this policy. Element names
+        referenced by the rules are resolved in bulk before any rule is
+        created, and rules are inserted concurrently while preserving
+        the order provided. A failure creating a rule does not stop the
+        remaining rules from being created.
+        ::
+
+            >>> policy.import_rules([
+                    {'section': 'Web'},
+                    {'name': 'web', 'sources': 'any', 'destinations': ['web01'],
+                     'services': ['HTTP', 'HTTPS'], 'action': 'allow'}])
+            RuleImportResult(created=2, failed=0)
+
+        See :mod:`smc.policy.rule_import` for the format of rules.
+
+        :param rules: list of dict, or name of a CSV or JSON file
+        :type rules: list(dict) or str
+        :param int add_pos: position to insert the rules, starting at 1. If
+            no position is provided, rules are added to the bottom of the
+            policy. Mutually exclusive with ``after`` and ``before``
+        :param str after: rule tag to insert the rules after
+        :param str before: rule tag to insert the rules before
+        :param int max_workers: maximum number of concurrent requests
+        :raises IOError: failure reading a rules file
+        :rtype: smc.policy.rule_import.RuleImportResult
+        """
+        return import_rules(self.fw_ipv4_access_rules, rules, add_pos,
+                            after, before, max_workers)
+
 
 class FirewallSubPolicy(Policy):
     """
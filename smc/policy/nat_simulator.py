@@ -0,0 +1,304 @@
+"""
+.. versionadded:: 0.6.2
+
+Offline simulation of NAT rule translation.
+
+A :class:`NATSimulator` compiles the NAT rules of a policy and computes how
+connections are translated, without sending a request to the SMC for each
+connection::
+
+    >>> from smc.policy.nat_simulator import NATSimulator
+    >>> simulator = NATSimulator(FirewallPolicy('Corporate'))
+    >>> simulator.translate('10.1.1.10', '203.0.113.80', 'tcp', 80)
+    Translation(rule=IPv4NATRule(name=web dnat), source=10.1.1.10, destination=192.168.5.20, dst_port=8080)
+    >>> for translation in simulator.translate_many(flows):
+    ...   print(translation.flow, translation.source, translation.destination)
+
+NAT rules are matched with a :class:`smc.policy.evaluator.PolicyEvaluator`
+for the NAT rule collection, so rules are matched in the same order and
+with the same compiled sources, destinations and services as access rules,
+including template rules at the template insert point. The first matching
+rule applies; a matching rule without NAT options leaves the connection
+untranslated. Rules applied to a specific engine (``used_on``) are only
+matched when simulating that engine.
+
+Share the :class:`~smc.policy.evaluator.ElementCompiler` of an access rule
+evaluator so elements are loaded and compiled once for both::
+
+    >>> evaluator = PolicyEvaluator(policy)
+    >>> simulator = NATSimulator(policy, compiler=evaluator.compiler)
+
+Translation follows the NAT options of the rule:
+
+* Static source and destination NAT translate the address at the same
+  offset in the translated range as in the original range. Destination
+  ports are translated the same way when port translation is configured.
+* Dynamic source NAT translates the source to the translated address pool
+  and the source port to the translated port range. As the engine selects
+  the address and port at connection time, ``source`` is the pool, i.e.
+  '198.51.100.10-198.51.100.20', and ``src_port`` is a tuple of the first
+  and last port.
+
+A rule with a NAT address that cannot be compiled, i.e. an element type not
+supported by the :class:`~smc.policy.evaluator.ElementCompiler`, is reported
+in ``uncertain`` and leaves the address untranslated.
+"""
+import logging
+import collections
+from smc.elements.ip_index import ip_range, ip_to_int, int_to_ip
+from smc.policy.evaluator import PolicyEvaluator, is_insert_point, ANY
+from smc.base.pool import DEFAULT_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+#: Source ports used by dynamic source NAT when no ports are configured
+DYNAMIC_PORTS = (1024, 65535)
+
+#: NAT options of a rule
+NAT_OPTIONS = ('static_src_nat', 'dynamic_src_nat', 'static_dst_nat')
+
+
+class Translation(collections.namedtuple('Translation',
+        'flow rule source destination dst_port src_port uncertain')):
+    """
+    Result of translating a connection.
+
+    :ivar tuple flow: the connection as provided
+    :ivar CompiledRule rule: the matching NAT rule, None if no rule matched
+    :ivar str source: translated source address, or address range for
+        dynamic source NAT
+    :ivar str destination: translated destination address
+    :ivar int dst_port: translated destination port
+    :ivar src_port: translated source port, or tuple of (first, last) for
+        dynamic source NAT
+    :ivar list uncertain: rules that could not be evaluated before the
+        matching rule, and the matching rule if its NAT options could not
+        be compiled
+    """
+    __slots__ = ()
+
+    @property
+    def translated(self):
+        """
+        Whether a NAT rule with NAT options matched the connection
+
+        :rtype: bool
+        """
+        return self.rule is not None and any(
+            option in (self.rule.rule.data.get('options') or {})
+            for option in NAT_OPTIONS)
+
+    def __repr__(self):
+        return 'Translation(rule=%s, source=%s, destination=%s, dst_port=%s)' % (
+            self.rule.rule if self.rule else None, self.source,
+            self.destination, self.dst_port)
+
+
+def _ports(value):
+    low = value.get('min_port')
+    if low in (None, ''):
+        return None
+    high = value.get('max_port')
+    return int(low), int(high) if high not in (None, '') else int(low)
+
+
+def _offset(value, original, translated):
+    """
+    Map value at its offset in the original range into the translated
+    range. Values outside the translated range map to its start.
+    """
+    if original is None:
+        return translated[0]
+    offset = value - original[0]
+    if 0 <= offset <= translated[1] - translated[0]:
+        return translated[0] + offset
+    return translated[0]
+
+
+class NATSimulator(PolicyEvaluator):
+    """
+    Simulate the translation of connections by the NAT rules of a policy.
+
+    :param Policy policy: policy to simulate, i.e. FirewallPolicy
+    :param str rule_type: name of the NAT rule collection of the policy
+        (default: 'fw_ipv4_nat_rules')
+    :param engine: engine or engine href to simulate. Rules applied to
+        other engines are skipped. By default only rules without
+        ``used_on`` are matched
+    :param ElementCompiler compiler: compiler for elements, provide the
+        compiler of a PolicyEvaluator to share compiled elements
+    :param insert_point: callable taking template rule json and
+        returning True for the insert point of the template
+    :param int max_workers: maximum number of concurrent requests used
+        to load rules
+    """
+    def __init__(self, policy, rule_type='fw_ipv4_nat_rules', engine=None,
+                 compiler=None, insert_point=is_insert_point,
+                 max_workers=DEFAULT_WORKERS):
+        super(NATSimulator, self).__init__(
+            policy, rule_type=rule_type, compiler=compiler,
+            insert_point=insert_point, max_workers=max_workers)
+        self.engine = getattr(engine, 'href', engine)
+        self._translations = []
+
+    def __repr__(self):
+        if not self._compiled:
+            return 'NATSimulator(policy=%s)' % self.policy.name
+        return 'NATSimulator(policy=%s, rules=%s, unresolved=%s)' % (
+            self.policy.name, len(self.rules), len(self.unresolved))
+
+    def policy_rules(self, policy):
+        """
+        Return the NAT rules of the policy in evaluation order, including
+        the rules of its templates. Rules applied to another engine than
+        the simulated engine are excluded.
+
+        :param Policy policy: policy or template policy
+        :rtype: list
+        """
+        return [rule for rule in
+                super(NATSimulator, self).policy_rules(policy)
+                if rule.data.get('used_on') in (None, self.engine)]
+
+    def _address(self, value):
+        """
+        Compile a NAT address value to (family, first, last). Returns
+        False if the value cannot be compiled.
+        """
+        if not value:
+            return None
+        if value.get('ip_descriptor'):
+            try:
+                return ip_range(value['ip_descriptor'])
+            except ValueError:
+                return False
+        if value.get('element'):
+            addresses = self.compiler.addresses(value['element'])
+            if addresses and addresses != ANY:
+                return addresses[0]
+            return False
+        return None
+
+    def _compile_nat(self, data):
+        """
+        Compile the NAT options of rule json to a dict of the source and
+        destination translation. Unresolved is True if a NAT address
+        could not be compiled.
+        """
+        options = data.get('options') or {}
+        nat = {}
+        if 'static_src_nat' in options:
+            static = options['static_src_nat']
+            nat['src'] = ('static', self._address(static.get('original_value')),
+                          self._address(static.get('translated_value')), None)
+        elif 'dynamic_src_nat' in options:
+            values = options['dynamic_src_nat'].get('translation_values') or [{}]
+            nat['src'] = ('dynamic', None, self._address(values[0]),
+                          _ports(values[0]) or DYNAMIC_PORTS)
+        if 'static_dst_nat' in options:
+            static = options['static_dst_nat']
+            original = static.get('original_value') or {}
+            translated = static.get('translated_value') or {}
+            nat['dst'] = (self._address(original), self._address(translated),
+                          _ports(original), _ports(translated))
+        src, dst = nat.get('src'), nat.get('dst')
+        unresolved = (src is not None and (not src[2] or src[1] is False)) or \
+            (dst is not None and (not dst[1] or dst[0] is False))
+        return nat, unresolved
+
+    def _option_hrefs(self, data):
+        options = data.get('options') or {}
+        for option in NAT_OPTIONS:
+            option = options.get(option) or {}
+            values = option.get('translation_values') or \
+                [option.get('original_value'), option.get('translated_value')]
+            for value in values:
+                if value and value.get('element'):
+                    yield value['element']
+
+    def compile(self):
+        """
+        Load and compile the NAT rules of the policy. This is called by
+        :meth:`translate` if the policy has not been compiled. Call again
+        to recompile after the policy has changed.
+
+        :rtype: NATSimulator
+        """
+        super(NATSimulator, self).compile()
+        hrefs = set()
+        for rule in self.rules:
+            hrefs.update(self._option_hrefs(rule.rule.data))
+        self.compiler.load(hrefs)
+        self._translations = [self._compile_nat(rule.rule.data)
+                              for rule in self.rules]
+        return self
+
+    def translate(self, source, destination, protocol, dst_port=None,
+                  src_port=None):
+        """
+        Translate a connection.
+        ::
+
+            >>> simulator.translate('10.0.0.1', '203.0.113.80', 'tcp', 443)
+            Translation(rule=IPv4NATRule(name=web dnat), source=10.0.0.1, destination=192.168.5.20, dst_port=443)
+
+        :param str source: source IP address
+        :param str destination: destination IP address
+        :param protocol: protocol name ('tcp', 'udp', 'icmp') or number
+        :param int dst_port: destination port
+        :param int src_port: source port
+        :raises ValueError: invalid address or protocol
+        :rtype: Translation
+        """
+        flow = (source, destination, protocol, dst_port, src_port)
+        match = self.evaluate(source, destination, protocol, dst_port,
+                              src_port)
+        if match is None:
+            return Translation(flow, None, source, destination, dst_port,
+                               src_port, [])
+        nat, unresolved = self._translations[match.rule.position]
+        uncertain = list(match.uncertain)
+        if unresolved:
+            uncertain.append(match.rule)
+
+        src = nat.get('src')
+        if src is not None and src[2]:
+            kind, original, translated, ports = src
+            family = translated[0]
+            if kind == 'dynamic':
+                first, last = int_to_ip(family, translated[1]), \
+                    int_to_ip(family, translated[2])
+                source = first if first == last else '%s-%s' % (first, last)
+                src_port = ports
+            else:
+                _, address = ip_to_int(source)
+                source = int_to_ip(family, _offset(
+                    address, original[1:] if original else None,
+                    translated[1:]))
+
+        dst = nat.get('dst')
+        if dst is not None and dst[1]:
+            original, translated, original_ports, translated_ports = dst
+            _, address = ip_to_int(destination)
+            destination = int_to_ip(translated[0], _offset(
+                address, original[1:] if original else None, translated[1:]))
+            if translated_ports and dst_port is not None:
+                dst_port = _offset(dst_port, original_ports, translated_ports)
+        return Translation(flow, match.rule, source, destination, dst_port,
+                           src_port, uncertain)
+
+    def translate_many(self, flows):
+        """
+        Translate many connections. Each connection is a tuple of the
+        arguments to :meth:`translate`.
+
+        :param flows: iterable of tuple (source, destination, protocol,
+            dst_port[, src_port])
+        :return: generator of Translation
+        """
+        if not self._compiled:
+            self.compile()
+        translate = self.translate
+        for flow in flows:
+            yield translate(*flow)
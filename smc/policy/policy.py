@@ -24,6 +24,8 @@ import collections
 from smc.api.exceptions import PolicyCommandFailed
 from smc.administration.tasks import Task
 from smc.base.model import Element, lookup_class
+from smc.base.pool import DEFAULT_WORKERS
+from smc.policy.analytics import rule_hits, DEFAULT_WINDOWS
 
 
 class Policy(Element):
@@ -155,12 +157,36 @@ class Policy(Element):
         :rtype: RuleCounter
         """
         json = {'target_ref': engine.href, 'duration_type': duration_type}
+        if duration:
+            json.update(duration=duration)
+        if start_time:
+            json.update(start_time=start_time)
         return [RuleCounter(**rule)
                 for rule in self.make_request(
                     method='create',
                     resource='rule_counter',
                     json=json)]
 
+    def rule_hits(self, engines, windows=DEFAULT_WINDOWS,
+                  max_workers=DEFAULT_WORKERS, **kw):
+        """
+        .. versionadded:: 0.6.2
+            Obtain rule counters from many engines. Requires SMC >= 6.2
+
+        Rule counters are retrieved concurrently for each engine and time
+        window and joined to the rules of this policy without retrieving
+        each rule separately. See :mod:`smc.policy.analytics`.
+
+        :param list engines: engines to obtain rule counters from
+        :param tuple windows: duration types, i.e. one_day, one_week
+        :param int max_workers: maximum number of concurrent requests
+        :param kw: additional arguments for
+            :func:`smc.policy.analytics.rule_hits`
+        :rtype: smc.policy.analytics.RuleHits
+        """
+        return rule_hits(self, engines, windows=windows,
+                         max_workers=max_workers, **kw)
+
 
 class InspectionPolicy(Policy):
     """
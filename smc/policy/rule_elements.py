@@ -2,6 +2,7 @@ from smc.base.model import Element, ElementCreator
 from smc.base.structs import NestedDict
 from smc.api.exceptions import ElementNotFound
 from smc.base.util import element_resolver
+from smc.base.cache import shared_resolver
 
 
 class RuleElement(object):
@@ -164,12 +165,18 @@ class RuleElement(object):
             for sources in rule.sources.all():
                 print('My source: %s' % sources)
 
+        Elements are resolved through the
+        :func:`~smc.base.cache.shared_resolver`, so the same element
+        referenced by many rules is only resolved and loaded once. The
+        data of elements not yet loaded is loaded concurrently and each
+        call returns separate element instances with a copy of the data.
+
         :return: elements by resolved object type
         :rtype: list(Element)
         """
         if not self.is_any and not self.is_none:
-            return [Element.from_href(href)
-                    for href in self.get(self.typeof)]
+            return shared_resolver().resolve_many(
+                self.get(self.typeof), shared=False)
         return []
 
 
@@ -0,0 +1,319 @@
+"""
+.. versionadded:: 0.6.2
+
+Bulk import of access rules into a policy.
+
+Creating rules with ``policy.fw_ipv4_access_rules.create`` sends one request
+per rule, and each element provided by name is searched for separately. When
+migrating a large rule base, use :meth:`smc.policy.layer3.FirewallPolicy.import_rules`
+or :func:`import_rules` for other rule collections::
+
+    >>> policy = FirewallPolicy('Migrated')
+    >>> result = policy.import_rules('/tmp/legacy-rules.csv', max_workers=8)
+    >>> result
+    RuleImportResult(created=3995, failed=5)
+    >>> for index, entry, error in result.failed:
+    ...     print(index, entry.get('name'), error)
+    17 legacy-ftp Element not found or ambiguous: services: ftp-legacy
+
+Rules are provided as a list of dicts, or a CSV or JSON file. Each rule takes
+the keyword arguments of the rule collections ``create`` method, i.e. for a
+layer 3 policy :meth:`smc.policy.rule.IPv4Rule.create`. Sources, destinations
+and services can be 'any', a list of elements or hrefs, or a list of element
+names. A rule with a ``section`` key creates a rule section instead::
+
+    [{'section': 'Web'},
+     {'name': 'web', 'sources': 'any', 'destinations': ['web01', 'web02'],
+      'services': ['HTTP', 'HTTPS'], 'action': 'allow'},
+     {'name': 'deny', 'sources': 'any', 'destinations': 'any',
+      'services': 'any', 'action': 'discard', 'comment': 'cleanup'}]
+
+CSV files use the same keys as column headers. Multiple values in a column
+are separated by a semicolon, and a row with a value in the ``section``
+column creates a rule section::
+
+    section,name,sources,destinations,services,action,comment
+    Web,,,,,,
+    ,web,any,web01;web02,HTTP;HTTPS,allow,
+    ,deny,any,any,any,discard,cleanup
+
+Element names used in any rule are resolved up front with
+:class:`smc.actions.search.NameResolver`; sources and destinations are
+resolved from network elements and services from services. A rule referencing
+a name that is not found, or matches more than one element, is reported as
+failed with :class:`~smc.api.exceptions.CreateRuleFailed` without being sent.
+A rule referencing a name that could not be searched for, i.e. because of a
+transient API error, is reported as failed with
+:class:`~smc.api.exceptions.FetchElementFailed` and can be imported again.
+
+Rules are inserted in the order provided. By default the rules are added to the
+bottom of the policy, use ``add_pos``, ``after`` or ``before`` to insert them
+elsewhere. To insert concurrently, the rules are split into one block per
+worker. The first rule of each block is created in order, then the remaining
+rules of each block are inserted after the first rule of their block with
+the blocks processed concurrently. Set ``max_workers=1`` to insert one rule
+at a time.
+"""
+import csv
+import json
+import logging
+from smc.actions.search import NameResolver
+from smc.api.exceptions import CreateRuleFailed, FetchElementFailed
+from smc.base.pool import concurrent_map, DEFAULT_WORKERS
+from smc.compat import string_types
+
+logger = logging.getLogger(__name__)
+
+
+#: Rule fields containing elements and the filter context used to
+#: resolve element names for the field
+ELEMENT_FIELDS = {
+    'sources': 'network_elements',
+    'destinations': 'network_elements',
+    'services': 'services'}
+
+#: Rule fields containing a single element and the filter context used
+#: to resolve the element name
+REFERENCE_FIELDS = {
+    'sub_policy': 'sub_ipv4_fw_policy',
+    'vpn_policy': 'vpn'}
+
+#: CSV columns that are converted to bool
+BOOLEAN_FIELDS = ('is_disabled', 'mobile_vpn')
+
+
+def load_rules(filename):
+    """
+    Load rules from a CSV or JSON file. The file type is determined by
+    the file extension. JSON files contain a list of rules, each a dict.
+    See the module documentation for the CSV format.
+
+    :param str filename: name of .csv or .json file
+    :raises IOError: failure reading the file
+    :raises ValueError: unsupported file type or invalid json
+    :rtype: list(dict)
+    """
+    if filename.lower().endswith('.json'):
+        with open(filename, 'r') as f:
+            return json.load(f)
+    if not filename.lower().endswith('.csv'):
+        raise ValueError('Rules must be loaded from a .csv or .json file, '
+            'got: %s' % filename)
+    rules = []
+    with open(filename, 'r') as f:
+        for row in csv.DictReader(f):
+            rule = {}
+            for key, value in row.items():
+                value = (value or '').strip()
+                if not key or not value:
+                    continue
+                if key in ELEMENT_FIELDS:
+                    if value.lower() == 'none':
+                        continue
+                    if value.lower() != 'any':
+                        value = [v.strip() for v in value.split(';')
+                                 if v.strip()]
+                elif key in BOOLEAN_FIELDS:
+                    value = value.lower() in ('true', 'yes', '1')
+                rule[key] = value
+            if rule.get('section'):
+                rule = {'section': rule['section']}
+            rules.append(rule)
+    return rules
+
+
+def _is_name(value):
+    return isinstance(value, string_types) and not value.startswith('http')
+
+
+def _field_names(rule):
+    """
+    Return (name, filter_context) for each element name in the rule.
+    """
+    for field, context in ELEMENT_FIELDS.items():
+        values = rule.get(field)
+        if isinstance(values, list):
+            for value in values:
+                if _is_name(value):
+                    yield value, context
+    for field, context in REFERENCE_FIELDS.items():
+        if _is_name(rule.get(field)):
+            yield rule[field], context
+
+
+def _resolve(rule, resolved, failed):
+    """
+    Return a copy of the rule with element names replaced by href.
+
+    :raises FetchElementFailed: element name could not be searched for
+    :raises CreateRuleFailed: element name not found or ambiguous
+    """
+    rule = dict(rule)
+    missing, errors = [], []
+
+    def lookup(field, name, context):
+        href = resolved.get((name, context))
+        if href is None:
+            if (name, context) in failed:
+                errors.append('%s: %s, %s' % (field, name,
+                                              failed[(name, context)]))
+            else:
+                missing.append('%s: %s' % (field, name))
+        return href
+
+    for field, context in ELEMENT_FIELDS.items():
+        values = rule.get(field)
+        if isinstance(values, list):
+            rule[field] = [lookup(field, value, context) if _is_name(value)
+                           else value for value in values]
+    for field, context in REFERENCE_FIELDS.items():
+        if _is_name(rule.get(field)):
+            rule[field] = lookup(field, rule[field], context)
+    if errors:
+        raise FetchElementFailed('Failed to search for element: %s' %
+            '; '.join(errors))
+    if missing:
+        raise CreateRuleFailed('Element not found or ambiguous: %s' %
+            ', '.join(missing))
+    return rule
+
+
+class RuleImportResult(object):
+    """
+    Result of a rule import.
+
+    :ivar list created: list of tuple (index, rule) for each rule or rule
+        section created, where index is the position of the rule in the
+        rules provided
+    :ivar list failed: list of tuple (index, rule, exception) for each
+        rule that could not be created
+    """
+    def __init__(self):
+        self.created = []
+        self.failed = []
+
+    @property
+    def ok(self):
+        """
+        Whether all rules were created
+
+        :rtype: bool
+        """
+        return not self.failed
+
+    @property
+    def search_failed(self):
+        """
+        Failed rules referencing an element name that could not be
+        searched for, as opposed to a name that was not found. Importing
+        these rules again may succeed
+
+        :rtype: list
+        """
+        return [failure for failure in self.failed
+                if isinstance(failure[2], FetchElementFailed)]
+
+    @property
+    def rules(self):
+        """
+        Created rules in the order provided
+
+        :rtype: list
+        """
+        return [rule for _, rule in sorted(self.created, key=lambda c: c[0])]
+
+    def __repr__(self):
+        return 'RuleImportResult(created=%s, failed=%s)' % (
+            len(self.created), len(self.failed))
+
+
+def import_rules(collection, rules, add_pos=None, after=None, before=None,
+                 max_workers=DEFAULT_WORKERS, resolver=None):
+    """
+    Import rules into a rule collection, i.e.
+    ``policy.fw_ipv4_access_rules``. See the module documentation for
+    the format of rules.
+
+    :param collection: rule collection obtained from the policy
+    :param rules: list of dict, or name of a CSV or JSON file
+    :type rules: list(dict) or str
+    :param int add_pos: position to insert the rules, starting at 1. Mutually
+        exclusive with ``after`` and ``before``. If no position is provided,
+        rules are added to the bottom of the policy
+    :param str after: rule tag to insert the rules after
+    :param str before: rule tag to insert the rules before
+    :param int max_workers: maximum number of concurrent requests
+    :param NameResolver resolver: resolver used for element names. Provide
+        a resolver to re-use names resolved by previous imports
+    :raises IOError: failure reading a rules file
+    :rtype: RuleImportResult
+    """
+    if isinstance(rules, string_types):
+        rules = load_rules(rules)
+    result = RuleImportResult()
+    resolver = resolver or NameResolver(max_workers)
+
+    names = set()
+    for rule in rules:
+        names.update(_field_names(rule))
+    resolution = resolver.resolve(list(names))
+
+    entries = []  # (index, rule with hrefs)
+    for index, rule in enumerate(rules):
+        try:
+            entries.append((index, _resolve(rule, resolution.resolved,
+                                            resolution.failed)))
+        except (CreateRuleFailed, FetchElementFailed) as e:
+            result.failed.append((index, rule, e))
+
+    def create(rule, **position):
+        if rule.get('section'):
+            return collection.create_rule_section(
+                name=rule['section'], **position)
+        return collection.create(**dict(rule, **position))
+
+    # The first rule of each block is created sequentially, each after the
+    # previous one. Remaining rules in a block are inserted after the first
+    # rule of the block in reverse order, which leaves them in order.
+    size = max(1, -(-len(entries) // max(1, max_workers)))
+    blocks = [entries[i:i + size] for i in range(0, len(entries), size)]
+    if add_pos is None and after is None and before is None:
+        add_pos = 2 ** 31  # Bottom of the policy
+    position = {'add_pos': add_pos} if add_pos is not None else \
+        {'after': after} if after is not None else {'before': before}
+    anchored = []  # (tag, remaining entries) for each block
+    for block in blocks:
+        while block:
+            (index, rule), block = block[0], block[1:]
+            try:
+                created = create(rule, **position)
+                tag = created.tag
+            except Exception as e:
+                result.failed.append((index, rules[index], e))
+                continue
+            result.created.append((index, created))
+            position = {'after': tag}
+            anchored.append((tag, block))
+            break
+
+    def insert(anchor):
+        tag, block = anchor
+        outcome = []
+        for index, rule in reversed(block):
+            try:
+                outcome.append((index, create(rule, after=tag), None))
+            except Exception as e:
+                outcome.append((index, None, e))
+        return outcome
+
+    for work in concurrent_map(insert, anchored, max_workers):
+        for index, created, error in work.result:
+            if error is None:
+                result.created.append((index, created))
+            else:
+                logger.error('Failed to import rule %s: %s', index, error)
+                result.failed.append((index, rules[index], error))
+
+    result.failed.sort(key=lambda f: f[0])
+    logger.debug('Rule import complete: %s', result)
+    return result